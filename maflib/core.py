@@ -30,24 +30,117 @@ This module contains the core functionality of maf that handles parameterized
 tasks and metanodes.
 """
 
+import bisect
 import collections
 import copy
+import functools
+import hashlib
+import heapq
+import itertools
 import os
 import os.path
+import threading
+import time
 import types
 import inspect
+import json
+import math
+import multiprocessing
+import multiprocessing.connection
+import operator
+import socket
+import sqlite3
+import subprocess
+import sys
+import traceback
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import waflib.Build
+import waflib.ConfigSet
+import waflib.Errors
+import waflib.Logs
+import waflib.Options
+import waflib.Runner
+import waflib.Task
 import waflib.Utils
 from waflib.TaskGen import before_method, feature
 
+_LAYOUT_PATH = 'build/experiment/.maf_layout'
+_COORDINATOR_PATH = 'build/experiment/.maf_coordinator'
+_SPOOL_PATH = 'build/experiment/.maf_spool'
+# Each level of shards is named by two of the 32 hex digits of an MD5 digest.
+_MAX_SHARD_DEPTH = 16
+
+# Rules given to ExperimentContext.__call__, indexed by rule_index of call
+# objects.
+_rules = []
 
 def options(opt):
-    pass
+    opt.add_option(
+        '--lazy-expansion', action='store_true', default=False,
+        help='expand experiment tasks level by level during the build')
+    opt.add_option(
+        '--shard-depth', type='int', default=None,
+        help='number of hashed directory levels (0 to 16) that physical '
+             'nodes of each meta node are fanned out into; fixed on the '
+             'first experiment, and changed by migrate_layout command')
+    opt.add_option(
+        '--schedule', type='choice', choices=['critical-path', 'fifo'],
+        default='critical-path',
+        help='order of running experiment tasks: critical-path runs tasks '
+             'with the longest predicted runtime to the end first, and fifo '
+             'uses the scheduler of waf [default: %default]')
+    opt.add_option(
+        '--memory', default=None,
+        help='memory available to experiment tasks that declare their memory '
+             'usage, e.g. 64G [default: physical memory]')
+    opt.add_option(
+        '--verify-input-signatures', action='store_true', default=False,
+        help='rehash all input files of experiment tasks instead of trusting '
+             'their unchanged stats')
+    opt.add_option(
+        '--process-pool', action='store_true', default=False,
+        help='run function rules of experiment tasks in a pool of processes '
+             'instead of threads; a call object can override it by '
+             'process_pool argument')
+    opt.add_option(
+        '--result-store', action='store_true', default=False,
+        help='also record JSON results of experiment tasks into a store per '
+             'meta node, from which aggregation tasks read them at once; a '
+             'call object can override it by result_store argument')
+    opt.add_option(
+        '--incremental-aggregation', action='store_true', default=False,
+        help='save the state of each input of streaming aggregators, so that '
+             'only changed inputs are read when they are run again; a call '
+             'object can override it by incremental_aggregation argument')
+    opt.add_option(
+        '--input-loaders', type='int', default=1,
+        help='number of threads with which aggregators read their input '
+             'files; a call object can override it by input_loaders argument '
+             '[default: %default]')
+    opt.add_option(
+        '--coordinator', default=None, metavar='[HOST:]PORT',
+        help='run experiment tasks on workers started by waf '
+             'experiment_worker, possibly on other hosts sharing the project '
+             'directory; experiment listens to the address, and '
+             'experiment_worker connects to it [default for workers: the '
+             'address of the running experiment]')
+    opt.add_option(
+        '--batch-queue', type='choice', choices=['spool'], default=None,
+        help='submit experiment tasks as jobs to a queue: spool runs them by '
+             'waf experiment_spool_runner; a wscript can also set '
+             'batch_queue of the context to its own BatchQueue')
+    opt.add_option(
+        '--max-outstanding-jobs', type='int', default=1000,
+        help='maximum number of jobs submitted to the batch queue and not '
+             'finished [default: %default]')
 
 
 def configure(conf):
@@ -64,6 +157,13 @@ class ExperimentContext(waflib.Build.BuildContext):
     def __init__(self, **kw):
         super(ExperimentContext, self).__init__(**kw)
         self._experiment_graph = ExperimentGraph()
+        self._levels = None
+        # Number of tasks handed to the scheduler by the lazy build iterator.
+        self._num_lazy_tasks = 0
+
+        self.batch_queue = None
+        """:py:class:`BatchQueue` to which experiment tasks are submitted,
+        which is given by ``--batch-queue`` or set by a wscript."""
 
         # Callback registered by BuildContext.add_pre_fun is called right after
         # all wscripts are executed.
@@ -73,8 +173,147 @@ class ExperimentContext(waflib.Build.BuildContext):
     def __call__(self, **kw):
         """Main method to generate tasks."""
 
-        call_object = CallObject(**kw)
+        self._add_call_object(CallObject(**kw))
+
+    def _add_call_object(self, call_object):
+        # Processes running function rules are forked when the build starts,
+        # and find the rules by their indexes.
+        call_object.rule_index = len(_rules)
+        _rules.append(getattr(call_object, 'rule', None))
         self._experiment_graph.add_call_object(call_object)
+        return call_object
+
+    def successive_halving(self, pipeline, parameters, budget, budgets, key,
+                           eta=3, maximize=True, result=None):
+        """Sweeps parameters by successive halving.
+
+        All the parameters are first run through the pipeline with the smallest
+        budget. Then only the best ``1 / eta`` of them in terms of ``key`` of
+        the result meta node are run again with the next budget, and so on.
+        Each rung is a copy of the pipeline whose target meta nodes are
+        suffixed by ``.rung<i>``, except for the last rung that produces the
+        meta nodes of the pipeline as they are, e.g. ``model.rung0``,
+        ``model.rung1`` and ``model``.
+
+        Parameters of a rung are chosen right before its tasks run, so the
+        experiment is always expanded lazily (see ``--lazy-expansion``).
+
+        :param pipeline: List of arguments of ``ExperimentContext.__call__``
+            that run one parameter to its result. Only the first call receives
+            the parameters, so it must not have its own ``parameters``.
+        :type pipeline: ``list`` of ``dict``
+        :param parameters: Parameters to sweep.
+        :type parameters: ``list`` of ``dict``
+        :param budget: Name of the parameter that gives the budget.
+        :type budget: ``str``
+        :param budgets: Increasing budgets of the rungs.
+        :type budgets: ``list``
+        :param key: Key of results by which parameters are ranked.
+        :type key: ``str``
+        :param eta: Reduction factor of parameters between rungs.
+        :type eta: ``int``
+        :param maximize: Whether larger results are better.
+        :type maximize: ``bool``
+        :param result: Meta node of the results. The target of the last call
+            of the pipeline by default.
+        :type result: ``str``
+
+        """
+        self._add_sweep(pipeline, [('', parameters, 0)], budget, budgets, key,
+                        eta, maximize, result)
+
+    def hyperband(self, pipeline, sample, budget, budgets, key, eta=3,
+                  maximize=True, result=None):
+        """Sweeps parameters by Hyperband.
+
+        Hyperband runs successive halving in brackets that start with
+        different budgets; the bracket starting with ``budgets[i]`` samples
+        ``ceil(len(budgets) * eta ** (n - i) / (n - i + 1))`` parameters where
+        ``n = len(budgets) - 1``. Rungs of the bracket are suffixed by
+        ``.bracket<i>.rung<j>``, and the parameters promoted to the largest
+        budget by all the brackets are run together by the last rung, which
+        produces the meta nodes of the pipeline as they are.
+
+        :param sample: Function that takes a number and returns that many
+            parameters, e.g. ``lambda n: maflib.util.sample(n, {...})``.
+        :type sample: ``function``
+
+        See :py:meth:`successive_halving` for the other arguments.
+
+        """
+        last = len(budgets) - 1
+        brackets = []
+        for start in range(len(budgets)):
+            rungs = last - start
+            num_samples = int(math.ceil(
+                float(len(budgets)) * eta ** rungs / (rungs + 1)))
+            brackets.append(
+                ('bracket%d.' % start, sample(num_samples), start))
+        self._add_sweep(pipeline, brackets, budget, budgets, key, eta,
+                        maximize, result)
+
+    def optimize(self, pipeline, sampler, key, rounds, batch_size,
+                 maximize=True, result=None):
+        """Sweeps parameters by sequential model-based optimization.
+
+        Each round runs ``batch_size`` parameters proposed by ``sampler`` from
+        the results of all the former rounds through the pipeline. Rounds are
+        copies of the pipeline whose target meta nodes are suffixed by
+        ``.round<i>``, and the results of all the rounds are collected into the
+        result meta node of the pipeline.
+
+        Proposals only depend on the results of former rounds, so increasing
+        ``rounds`` of a finished optimization only runs the new rounds.
+        Proposals already run are dropped, so a round may run fewer
+        parameters than ``batch_size``.
+
+        :param sampler: Function that takes the number of parameters to
+            propose and a list of pairs of a parameter and its score, and
+            returns parameters expected to get larger scores, e.g.
+            :py:class:`maflib.util.GaussianProcessSampler`. Scores are negated
+            results if ``maximize`` is False.
+        :type sampler: ``function``
+        :param rounds: Number of rounds.
+        :type rounds: ``int``
+        :param batch_size: Number of parameters of each round, which can be
+            run in parallel.
+        :type batch_size: ``int``
+
+        See :py:meth:`successive_halving` for the other arguments.
+
+        """
+        pipeline = _Pipeline(pipeline, result)
+        former_rounds = []
+        for i in range(rounds):
+            parameters = ProposedParameters(
+                list(former_rounds), sampler, batch_size, key, maximize)
+            former_rounds.append(
+                pipeline.add(self, parameters, '.round%d' % i))
+            self(source=former_rounds[-1][1], target=pipeline.result,
+                 rule=_copy_result)
+
+    def _add_sweep(self, pipeline, brackets, budget, budgets, key, eta,
+                   maximize, result):
+        pipeline = _Pipeline(pipeline, result)
+        last = len(budgets) - 1
+        promoted = PromotedParameters([], budget, budgets[last], key, eta,
+                                      maximize)
+        for name, parameters, start in brackets:
+            if start == last:
+                promoted.parameters += [dict(p, **{budget: budgets[last]})
+                                        for p in parameters]
+                continue
+            rung = pipeline.add(self, [dict(p, **{budget: budgets[start]})
+                                       for p in parameters],
+                                '.%srung%d' % (name, start))
+            for i in range(start + 1, last):
+                rung = pipeline.add(
+                    self, PromotedParameters([rung], budget, budgets[i], key,
+                                             eta, maximize),
+                    '.%srung%d' % (name, i))
+            promoted.rungs.append(rung)
+        pipeline.add(
+            self, promoted if promoted.rungs else promoted.parameters, '')
 
     def _process_call_objects(self):
         """Callback function called right after all wscripts are executed.
@@ -83,30 +322,278 @@ class ExperimentContext(waflib.Build.BuildContext):
         ExperimentContext.
 
         """
+        self._init_tables()
+        self.input_signature_cache = InputSignatureCache(
+            'build/experiment/.maf_input_signatures',
+            getattr(waflib.Options.options, 'verify_input_signatures', False))
+
+        recorded_depth = self._get_recorded_shard_depth()
+        requested_depth = self._get_requested_shard_depth()
+        if recorded_depth is None:
+            self.shard_depth = requested_depth or 0
+            self._record_shard_depth()
+        elif requested_depth not in (None, recorded_depth):
+            self.fatal('Physical nodes are laid out with shard depth %d; run '
+                       '"waf migrate_layout --shard-depth=%d" to change it' %
+                       (recorded_depth, requested_depth))
+        else:
+            self.shard_depth = recorded_depth
+
         # Run topological sort on dependency graph.
         call_objects = self._experiment_graph.get_sorted_call_objects()
 
+        # Lazy expansion cannot find the task generators of --targets before
+        # the build starts, so we fall back to the eager expansion. Deferred
+        # parameters are chosen by results of former call objects, and always
+        # need the lazy expansion.
+        deferred = any(isinstance(call_object.parameters, DeferredParameters)
+                       for call_object in call_objects)
+        if deferred and self.targets:
+            self.fatal('Sweeps and optimizations cannot be run with --targets')
+        if (getattr(waflib.Options.options, 'lazy_expansion', False) or
+                deferred) and not self.targets:
+            self._levels = self._experiment_graph.get_call_object_levels()
+            return
+
+        try:
+            for call_object in call_objects:
+                self._process_call_object(call_object)
+        finally:
+            self._save_tables()
+
+    def _init_tables(self):
         # TODO(beam2d): Remove this stub file name.
         self._parameter_id_generator = ParameterIdGenerator(
             'build/experiment/.maf_id_table',
             'build/experiment/.maf_id_table.tsv')
+        self._expansion_cache = ExpansionCache(
+            'build/experiment/.maf_expansion_cache',
+            self._parameter_id_generator)
         self._nodes = collections.defaultdict(set)
+        self._empty_nodes = set()
+        self._node_keys = collections.defaultdict(list)
+        self._result_stores = {}
+
+    def _get_recorded_shard_depth(self):
+        """Gets the shard depth of existing physical nodes, or None if no
+        physical node has been generated.
 
+        """
+        if os.path.exists(_LAYOUT_PATH):
+            with open(_LAYOUT_PATH) as f:
+                return int(f.read())
+        # Build directories made before sharding was introduced are flat.
+        if len(self._parameter_id_generator):
+            return 0
+        return None
+
+    def _get_requested_shard_depth(self):
+        depth = getattr(waflib.Options.options, 'shard_depth', None)
+        if depth is not None and not 0 <= depth <= _MAX_SHARD_DEPTH:
+            self.fatal('--shard-depth must be between 0 and %d' %
+                       _MAX_SHARD_DEPTH)
+        return depth
+
+    def _record_shard_depth(self):
+        with _create_file(_LAYOUT_PATH) as f:
+            f.write('%d\n' % self.shard_depth)
+
+    def compile(self):
+        runtime_history = TaskRuntimeHistory('build/experiment/.maf_runtimes')
+        self.batch_submitter = self._create_batch_submitter()
+        self.coordinator = None
+        self.process_pool = None
+        if self.batch_submitter is None:
+            self.coordinator = self._create_coordinator()
+        if self.batch_submitter is None and self.coordinator is None:
+            self.process_pool = self._create_process_pool()
+        try:
+            if getattr(waflib.Options.options, 'schedule', None) == 'fifo':
+                super(ExperimentContext, self).compile()
+            else:
+                memory = getattr(waflib.Options.options, 'memory', None)
+                self._compile(CriticalPathScheduler(
+                    self, self.jobs, runtime_history,
+                    parse_memory(memory) if memory else _get_physical_memory()))
+        finally:
+            if self._levels is not None:
+                self._save_tables()
+            self.input_signature_cache.save()
+            runtime_history.save()
+            for store in self._result_stores.itervalues():
+                store.close()
+            if self.process_pool is not None:
+                self.process_pool.terminate()
+                self.process_pool.join()
+            if self.coordinator is not None:
+                self.coordinator.close()
+                os.remove(_COORDINATOR_PATH)
+            if self.batch_submitter is not None:
+                self.batch_submitter.close()
+
+    def _create_batch_submitter(self):
+        if getattr(waflib.Options.options, 'batch_queue', None) == 'spool':
+            self.batch_queue = FileSpoolQueue(_SPOOL_PATH)
+        if self.batch_queue is None:
+            return None
+        return BatchSubmitter(self.batch_queue, getattr(
+            waflib.Options.options, 'max_outstanding_jobs', 1000))
+
+    def _create_coordinator(self):
+        address = getattr(waflib.Options.options, 'coordinator', None)
+        if address is None:
+            return None
+        host, _, port = address.rpartition(':')
+        coordinator = Coordinator((host, int(port)))
+        # Workers find the coordinator and its key in the shared directory.
+        with _create_file(_COORDINATOR_PATH, 'wb') as f:
+            os.chmod(_COORDINATOR_PATH, 0600)
+            pickle.dump((host or socket.gethostname(), coordinator.address[1],
+                         coordinator.authkey), f)
+        waflib.Logs.info('waiting for workers at %s:%d' %
+                         (host or socket.gethostname(), coordinator.address[1]))
+        return coordinator
+
+    def _create_process_pool(self):
+        # Workers are forked before waf starts its threads, and inherit the
+        # rules defined in wscripts.
+        if not hasattr(os, 'fork'):
+            return None
+        default = getattr(waflib.Options.options, 'process_pool', False)
+        if not any(getattr(call_object, 'process_pool', default)
+                   for call_object
+                   in self._experiment_graph.get_sorted_call_objects()):
+            return None
+        # Workers would inherit the lock of the id table held by the
+        # compaction, and hold it until they are terminated.
+        self._parameter_id_generator._wait_compaction()
+        return multiprocessing.Pool(self.jobs)
+
+    def _compile(self, producer):
+        # Same as waflib.Build.BuildContext.compile except for the producer.
+        waflib.Logs.debug('build: compile()')
+        self.producer = producer
+        self.producer.biter = self.get_build_iterator()
+        self.returned_tasks = []
         try:
+            self.producer.start()
+        except KeyboardInterrupt:
+            self.store()
+            raise
+        else:
+            if self.producer.dirty:
+                self.store()
+        if self.producer.error:
+            raise waflib.Errors.BuildError(self.producer.error)
+
+    def _save_tables(self):
+        # The expansion cache refers to parameter ids, so it must be saved
+        # after the id table.
+        self._parameter_id_generator.save(background=True)
+        self._expansion_cache.save()
+
+    def total(self):
+        # The lazy build iterator empties the groups of former levels, whose
+        # tasks are still counted in the progress of the build.
+        if self._levels is None:
+            return super(ExperimentContext, self).total()
+        return self._num_lazy_tasks
+
+    def get_build_iterator(self):
+        if self._levels is None:
+            return super(ExperimentContext, self).get_build_iterator()
+        return self._get_lazy_build_iterator()
+
+    def _get_lazy_build_iterator(self):
+        """Yields tasks of each topological level of call objects.
+
+        Call objects of a level are expanded to task generators in a new group
+        right before their tasks are handed to the scheduler. The scheduler
+        asks for the next level only after all the tasks of the current level
+        are done, so we release them there; the peak memory then follows the
+        largest level instead of the whole experiment.
+
+        """
+        for call_objects in self._levels:
+            self.add_group()
             for call_object in call_objects:
                 self._process_call_object(call_object)
-        finally:
-            self._parameter_id_generator.save()
+
+            self.cur = self.current_group
+            self.post_group()
+            tasks = self.get_tasks_group(self.cur)
+            waflib.Task.set_file_constraints(tasks)
+            waflib.Task.set_precedence_constraints(tasks)
+            self.cur_tasks = tasks
+            if tasks:
+                self._num_lazy_tasks += len(tasks)
+                yield tasks
+
+            del self.groups[self.cur][:]
+            del self.returned_tasks[:]
+            self.cur_tasks = []
+
+        while True:
+            yield []
 
     def _process_call_object(self, call_object):
         self._set_rule_and_dependson(call_object)
-
-        if hasattr(call_object, 'for_each'):
-            self._generate_aggregation_tasks(call_object, 'for_each')
-        elif hasattr(call_object, 'aggregate_by'):
-            self._generate_aggregation_tasks(call_object, 'aggregate_by')
-        else:
-            self._generate_tasks(call_object)
+        if isinstance(call_object.parameters, DeferredParameters):
+            call_object.parameters = [
+                FrozenParameter(p) for p in
+                call_object.parameters.evaluate(self._read_results)]
+        elif not isinstance(call_object.parameters, list):
+            call_object.parameters = [
+                FrozenParameter(p) for p in call_object.parameters]
+
+        # Expansion of a call object only depends on the call object and the
+        # expansions of upstream call objects, which are identified by the
+        # keys registered to the source nodes.
+        key = _get_expansion_key(
+            call_object, [self._node_keys[node] for node in call_object.source])
+        for node in call_object.target:
+            self._node_keys[node].append(key)
+
+        tasks = None
+        if key is not None:
+            tasks = self._expansion_cache.get(key)
+        if tasks is None:
+            if hasattr(call_object, 'for_each'):
+                tasks = self._generate_aggregation_tasks(
+                    call_object, 'for_each')
+            elif hasattr(call_object, 'aggregate_by'):
+                tasks = self._generate_aggregation_tasks(
+                    call_object, 'aggregate_by')
+            else:
+                tasks = self._generate_tasks(call_object)
+            if key is not None:
+                self._expansion_cache.set(key, tasks)
+        if not tasks:
+            # Targets of no task are meta nodes without physical nodes, e.g.
+            # those of a round of an optimization whose proposals have all
+            # been run, rather than physical nodes.
+            self._empty_nodes.update(
+                node for node in call_object.target if not self._nodes[node])
+
+        template = PhysicalCallObject.create_template(call_object)
+        # Physical tasks of a call object share one task class, since waf
+        # orders tasks by comparing all pairs of task classes.
+        template['experiment_task_class'] = _create_experiment_task_class(
+            _get_call_object_name(call_object),
+            getattr(call_object, 'rule', None))
+        for source_parameter, target_parameter in tasks:
+            self._generate_task(
+                call_object, template, source_parameter, target_parameter)
+
+        # Make new ids persistent before their tasks run, and let other
+        # processes generate ids.
+        self._parameter_id_generator.flush()
+
+    def _read_results(self, node):
+        for parameter in self._nodes[node]:
+            physical_node = self._resolve_meta_node(node, parameter)
+            if os.path.exists(physical_node.abspath()):
+                yield parameter, json.loads(physical_node.read())
 
     def _set_rule_and_dependson(self, call_object):
         # dependson attribute is a variable or a function, changes of which
@@ -124,66 +611,29 @@ class ExperimentContext(waflib.Build.BuildContext):
             call_object.dependson = []
 
     def _generate_tasks(self, call_object):
-        if not call_object.source:
-            for parameter in call_object.parameters:
-                self._generate_task(call_object, [], parameter)
-
-        parameter_lists = []
-
         # Generate all valid list of parameters corresponding to source nodes.
+        # Each list is grown by a hash join with parameters of the next node.
+        parameter_lists = [[]]
         for node in call_object.source:
             node_params = self._nodes[node]
+            if node in self._empty_nodes:
+                return []
             if not node_params:
                 # node is physical. We use empty parameter as a dummy.
-                node_params = {Parameter()}
-
-            if not parameter_lists:
-                for node_param in node_params:
-                    parameter_lists.append([node_param])
-                continue
+                node_params = {FrozenParameter()}
+            parameter_lists = _join_parameters(parameter_lists, node_params)
 
-            new_lists = []
-            for node_param in node_params:
-                for parameter_list in parameter_lists:
-                    if any(p.conflict_with(node_param) for p in parameter_list):
-                        continue
-                    new_list = list(parameter_list)
-                    new_list.append(node_param)
-                    new_lists.append(new_list)
-
-            parameter_lists = new_lists
-
-        for parameter_list in parameter_lists:
-            for parameter in call_object.parameters:
-                if any(p.conflict_with(parameter) for p in parameter_list):
-                    continue
-                self._generate_task(call_object, parameter_list, parameter)
-
-    def _generate_task(self, call_object, source_parameter, parameter):
-        # Create target parameter by merging source parameter and task-gen
+        # The last element of each joined list is the task-gen parameter.
+        # Target parameter is created by merging source parameter and task-gen
         # parameter.
-        target_parameter = Parameter()
-        for p in source_parameter:
-            target_parameter.update(p)
-        target_parameter.update(parameter)
-
-        for node in call_object.target:
-            self._nodes[node].add(target_parameter)
-
-        # Convert source/target meta nodes to physical nodes.
-        physical_source = self._resolve_meta_nodes(
-            call_object.source, source_parameter)
-        physical_target = self._resolve_meta_nodes(
-            call_object.target, target_parameter)
-
-        # Create arguments of BuildContext.__call__.
-        physical_call_object = copy.deepcopy(call_object)
-        physical_call_object.source = physical_source
-        physical_call_object.target = physical_target
-        del physical_call_object.parameters
-
-        self._call_super(
-            physical_call_object, source_parameter, target_parameter)
+        tasks = []
+        for parameter_list in _join_parameters(
+                parameter_lists, call_object.parameters):
+            merged = {}
+            for p in parameter_list:
+                merged.update(p.iteritems())
+            tasks.append((parameter_list[:-1], FrozenParameter(merged)))
+        return tasks
 
     def _generate_aggregation_tasks(self, call_object, key_type):
         # In aggregation tasks, source and target must be only one (meta) node.
@@ -197,47 +647,88 @@ class ExperimentContext(waflib.Build.BuildContext):
             raise InvalidMafArgumentException(
                 "'target' in aggregation must include only one meta node")
 
-        source_node = call_object.source[0]
-        target_node = call_object.target[0]
-
-        source_parameters = self._nodes[source_node]
-        # Mapping from target parameter to list of source parameter.
-        target_to_source = collections.defaultdict(set)
-
-        for source_parameter in source_parameters:
-            target_parameter = Parameter()
-            if key_type == 'for_each':
-                for key in call_object.for_each:
-                    target_parameter[key] = source_parameter[key]
-            elif key_type == 'aggregate_by':
-                for key in source_parameter:
-                    if key not in call_object.aggregate_by:
-                        target_parameter[key] = source_parameter[key]
-            target_to_source[target_parameter].add(source_parameter)
-
-        for target_parameter in target_to_source:
-            source_parameter = target_to_source[target_parameter]
-            source = [self._resolve_meta_node(source_node, parameter)
-                      for parameter in source_parameter]
-            target = self._resolve_meta_node(target_node, target_parameter)
-
-            self._nodes[target_node].add(target_parameter)
-
-            # Create arguments of BuildContext.__call__.
-            physical_call_object = copy.deepcopy(call_object)
-            physical_call_object.source = source
-            physical_call_object.target = target
-            if key_type == 'for_each':
-                del physical_call_object.for_each
-            else:
-                del physical_call_object.aggregate_by
+        # Parameters of a meta node share a few tuples of keys (see
+        # FrozenParameter). Each tuple of keys is projected onto the keys of
+        # target parameters once, and each source parameter is grouped by the
+        # values at the projected positions.
+        projections = {}
+        groups = {}
+        tasks = []
+        for source_parameter in self._nodes[call_object.source[0]]:
+            keys = source_parameter._keys
+            try:
+                target_keys, project = projections[id(keys)]
+            except KeyError:
+                target_keys, project = projections[id(keys)] = (
+                    _get_projection(keys, call_object, key_type))
+            values = project(source_parameter._values)
+            group = groups.get((target_keys, values))
+            if group is None:
+                group = groups[target_keys, values] = []
+                tasks.append((group, FrozenParameter.from_sorted_items(
+                    target_keys, values)))
+            group.append(source_parameter)
+        return tasks
+
+    def _generate_task(self, call_object, template, source_parameter,
+                       target_parameter):
+        for node in call_object.target:
+            self._nodes[node].add(target_parameter)
+
+        # Convert source/target meta nodes to physical nodes. Aggregation task
+        # has physical nodes of one meta node as its source.
+        source = call_object.source
+        if len(source) == 1:
+            physical_source = self._resolve_meta_node_in_bulk(
+                source[0], source_parameter)
+        else:
+            physical_source = self._resolve_meta_nodes(
+                source, source_parameter)
+        physical_target = self._resolve_meta_nodes(
+            call_object.target, target_parameter)
 
-            self._call_super(
-                physical_call_object, source_parameter, target_parameter)
+        # Create arguments of BuildContext.__call__.
+        physical_call_object = PhysicalCallObject(
+            template, physical_source, physical_target)
+
+        taskgen = self._call_super(
+            physical_call_object, source_parameter, target_parameter)
+
+        # Results of the task are recorded into the stores of its targets by
+        # ExperimentTask.post_run, and aggregation tasks read the store of
+        # their source if it has one.
+        if target_parameter and getattr(
+                call_object, 'result_store',
+                getattr(waflib.Options.options, 'result_store', False)):
+            parameter_id = self._parameter_id_generator.get_id(
+                target_parameter)
+            taskgen.result_records = [
+                (self._get_result_store(node), parameter_id)
+                for node in call_object.target]
+        if (hasattr(call_object, 'for_each') or
+                hasattr(call_object, 'aggregate_by')):
+            store = self._result_stores.get(call_object.source[0])
+            if store is not None:
+                taskgen.env.result_store = store.path
+            if getattr(call_object, 'incremental_aggregation', getattr(
+                    waflib.Options.options, 'incremental_aggregation',
+                    False)):
+                taskgen.env.incremental_aggregation = True
+            loaders = getattr(call_object, 'input_loaders', getattr(
+                waflib.Options.options, 'input_loaders', 1))
+            if loaders > 1:
+                taskgen.env.input_loaders = loaders
+
+    def _get_result_store(self, node):
+        store = self._result_stores.get(node)
+        if store is None:
+            store = self._result_stores[node] = ResultStore(os.path.join(
+                self.path.get_bld().abspath(), node, '.maf_results'))
+        return store
 
     def _call_super(self, call_object, source_parameter, target_parameter):
         taskgen = super(ExperimentContext, self).__call__(
-            **call_object.__dict__)
+            **call_object.to_kwargs())
         taskgen.env.source_parameter = source_parameter
         taskgen.env.update(target_parameter.to_str_valued_dict())
 
@@ -245,6 +736,7 @@ class ExperimentContext(waflib.Build.BuildContext):
         taskgen.env.update(dict(zip(depkeys, call_object.dependson)))
 
         taskgen.parameter = target_parameter
+        return taskgen
 
     def _resolve_meta_nodes(self, nodes, parameters):
         if not isinstance(parameters, list):
@@ -255,16 +747,201 @@ class ExperimentContext(waflib.Build.BuildContext):
             physical_nodes.append(self._resolve_meta_node(node, parameter))
         return physical_nodes
 
+    def _resolve_meta_node_in_bulk(self, node, parameters):
+        """Resolves physical nodes of one meta node. Nodes with existing files
+        are looked up under the directory of the meta node, which is found
+        once; the others are resolved by :py:meth:`_resolve_meta_node`.
+
+        """
+        directory = None
+        if node[0] != '/':
+            directory = self.path.get_bld().search_node(node)
+        if directory is None:
+            return [self._resolve_meta_node(node, parameter)
+                    for parameter in parameters]
+
+        suffix = '-' + os.path.basename(node)
+        get_id = self._parameter_id_generator.get_id
+        physical_nodes = []
+        for parameter in parameters:
+            physical_node = None
+            if parameter:
+                parameter_id = get_id(parameter)
+                path = _get_shard_path(parameter_id, self.shard_depth)
+                path = path.split('/') if path else []
+                path.append(parameter_id + suffix)
+                physical_node = directory.search_node(path)
+            if (physical_node is None or
+                    not os.path.isfile(physical_node.abspath())):
+                physical_node = self._resolve_meta_node(node, parameter)
+            physical_nodes.append(physical_node)
+        return physical_nodes
+
     def _resolve_meta_node(self, node, parameter):
         if parameter:
             parameter_id = self._parameter_id_generator.get_id(parameter)
             node = os.path.join(
-                node, '-'.join([parameter_id, os.path.basename(node)]))
+                node, _get_shard_path(parameter_id, self.shard_depth),
+                '-'.join([parameter_id, os.path.basename(node)]))
         if node[0] == '/':
             return self.root.find_resource(node)
         return self.path.find_or_declare(node)
 
 
+class LayoutMigrationContext(ExperimentContext):
+    """Context class of waf migrate_layout, which moves physical nodes of an
+    experiment to the layout given by ``--shard-depth``.
+
+    Tasks are generated in both the current and the new layouts, and the
+    output files and signatures of each task are moved to the new layout, so
+    the migrated tasks are not run again.
+
+    """
+
+    cmd = 'migrate_layout'
+
+    def execute(self):
+        self.restore()
+        if not self.all_envs:
+            self.load_envs()
+        self.recurse([self.run_dir])
+
+        self._init_tables()
+        new_depth = self._get_requested_shard_depth()
+        if new_depth is None:
+            self.fatal('--shard-depth is required by migrate_layout')
+        old_depth = self._get_recorded_shard_depth()
+        if old_depth is None or old_depth == new_depth:
+            self.shard_depth = new_depth
+            self._record_shard_depth()
+            return
+
+        try:
+            old_tasks = self._generate_all_tasks(old_depth)
+            new_tasks = self._generate_all_tasks(new_depth)
+            for old_task, new_task in zip(old_tasks, new_tasks):
+                self._migrate_task(old_task, new_task, old_depth)
+        finally:
+            self._save_tables()
+        self._record_shard_depth()
+        self.store()
+
+    def _generate_all_tasks(self, shard_depth):
+        self.shard_depth = shard_depth
+        self._nodes.clear()
+        self._node_keys.clear()
+        self.add_group()
+        for call_object in self._experiment_graph.get_sorted_call_objects():
+            self._process_call_object(call_object)
+
+        tasks = []
+        for taskgen in self.groups[self.current_group]:
+            taskgen.post()
+            tasks += taskgen.tasks
+        return tasks
+
+    def _migrate_task(self, old_task, new_task, old_depth):
+        for x in ('task_sigs', 'node_deps', 'raw_deps'):
+            table = getattr(self, x)
+            if old_task.uid() in table:
+                table[new_task.uid()] = table.pop(old_task.uid())
+
+        for old_node, new_node in zip(old_task.outputs, new_task.outputs):
+            old_path = old_node.abspath()
+            if old_path == new_node.abspath() or not os.path.exists(old_path):
+                continue
+            new_node.parent.mkdir()
+            os.rename(old_path, new_node.abspath())
+            if hasattr(old_node, 'sig'):
+                new_node.sig = old_node.sig
+            del old_node.parent.children[old_node.name]
+
+            # Remove shard directories left empty.
+            path = os.path.dirname(old_path)
+            for _ in range(old_depth):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    break
+                path = os.path.dirname(path)
+
+
+class ExperimentWorkerContext(ExperimentContext):
+    """Context class of waf experiment_worker, which runs experiment tasks
+    handed by ``waf experiment --coordinator``.
+
+    The worker reads wscripts as experiment does, so that it finds function
+    rules, and runs as many tasks at once as ``-j``. It connects to the
+    coordinator given by ``--coordinator``, or to the one recorded in the
+    build directory, and waits for it to start.
+
+    """
+
+    cmd = 'experiment_worker'
+
+    connect_timeout = 60.0
+    """Seconds to wait for the coordinator."""
+
+    def execute(self):
+        self.restore()
+        if not self.all_envs:
+            self.load_envs()
+        self.recurse([self.run_dir])
+
+        worker = Worker(self.jobs)
+        try:
+            worker.serve(self._connect())
+        finally:
+            worker.close()
+
+    def _connect(self):
+        address = getattr(waflib.Options.options, 'coordinator', None)
+        deadline = time.time() + self.connect_timeout
+        while True:
+            try:
+                # The key is only found in the build directory.
+                with open(_COORDINATOR_PATH, 'rb') as f:
+                    host, port, authkey = pickle.load(f)
+                if address is not None:
+                    host, _, port = address.rpartition(':')
+                return multiprocessing.connection.Client(
+                    (host or 'localhost', int(port)), authkey=authkey)
+            except (IOError, EOFError, pickle.UnpicklingError,
+                    multiprocessing.AuthenticationError):
+                if time.time() > deadline:
+                    self.fatal('no coordinator found; run waf experiment '
+                               'with --coordinator')
+                time.sleep(1)
+
+
+class SpoolRunnerContext(ExperimentContext):
+    """Context class of waf experiment_spool_runner, which runs experiment
+    tasks submitted by ``waf experiment --batch-queue spool``.
+
+    The runner reads wscripts as experiment does, so that it finds function
+    rules, and runs as many tasks at once as ``-j``. It exits when no task
+    is submitted for a while.
+
+    """
+
+    cmd = 'experiment_spool_runner'
+
+    idle_timeout = 60.0
+    """Seconds without tasks after which the runner exits."""
+
+    def execute(self):
+        self.restore()
+        if not self.all_envs:
+            self.load_envs()
+        self.recurse([self.run_dir])
+
+        runner = SpoolRunner(FileSpoolQueue(_SPOOL_PATH), self.jobs)
+        try:
+            runner.serve(self.idle_timeout)
+        finally:
+            runner.close()
+
+
 class CyclicDependencyException(Exception):
     """Exception raised when experiment graph has a cycle."""
     pass
@@ -277,6 +954,15 @@ class InvalidMafArgumentException(Exception):
     pass
 
 
+class RuleProcessException(Exception):
+    """Exception raised when a function rule fails in a process pool.
+
+    The message is the traceback of the rule in the worker process.
+
+    """
+    pass
+
+
 class Parameter(dict):
     """Parameter of maf task.
 
@@ -285,7 +971,8 @@ class Parameter(dict):
 
     """
     def __hash__(self):
-        # TODO(beam2d): Should we cache this value?
+        # The hash is not cached since parameter is mutable; use
+        # FrozenParameter where the hash is computed many times.
         return hash(frozenset(self.iteritems()))
 
     def conflict_with(self, parameter):
@@ -309,6 +996,134 @@ class Parameter(dict):
         return dict([(k, str(self[k])) for k in self])
 
 
+class FrozenParameter(object):
+    """Immutable parameter of maf task.
+
+    This is a read-only counterpart of :py:class:`Parameter` used internally
+    by :py:class:`ExperimentContext`, where parameters are stored in sets and
+    used as keys of dictionaries many times. The items are held by a pair of
+    tuples sorted by keys, and the hash value is computed once on construction.
+    Keys are interned, and the tuple of keys is shared by all parameters with
+    the same set of keys.
+
+    It supports the read-only part of the dict API, and compares equal to (and
+    has the same hash value as) a :py:class:`Parameter` with the same items.
+
+    """
+    __slots__ = ('_keys', '_values', '_hash')
+
+    _key_tuples = {}
+
+    def __init__(self, *args, **kw):
+        items = sorted(dict(*args, **kw).iteritems())
+        keys = tuple(_intern(k) for k, _ in items)
+        self._keys = FrozenParameter._key_tuples.setdefault(keys, keys)
+        self._values = tuple(v for _, v in items)
+        self._hash = hash(frozenset(items))
+
+    @staticmethod
+    def from_sorted_items(keys, values):
+        """Creates a parameter from its keys and values sorted by the keys.
+
+        :param keys: Sorted keys, which must be unique.
+        :type keys: ``tuple``
+        :param values: Values corresponding to keys.
+        :type values: ``tuple``
+        :rtype: :py:class:`FrozenParameter`
+
+        """
+        parameter = FrozenParameter.__new__(FrozenParameter)
+        keys = tuple(_intern(k) for k in keys)
+        parameter._keys = FrozenParameter._key_tuples.setdefault(keys, keys)
+        parameter._values = values
+        parameter._hash = hash(frozenset(itertools.izip(keys, values)))
+        return parameter
+
+    def __reduce__(self):
+        return (FrozenParameter, (dict(self.iteritems()),))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, FrozenParameter):
+            return (self._hash == other._hash and self._keys == other._keys and
+                    self._values == other._values)
+        if isinstance(other, dict):
+            return dict(self.iteritems()) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        i = bisect.bisect_left(self._keys, key)
+        return i < len(self._keys) and self._keys[i] == key
+
+    def __getitem__(self, key):
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            return self._values[i]
+        raise KeyError(key)
+
+    def __repr__(self):
+        return '{%s}' % ', '.join(
+            '%r: %r' % item for item in self.iteritems())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._keys, self._values)
+
+    def iterkeys(self):
+        return iter(self._keys)
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def iteritems(self):
+        return itertools.izip(self._keys, self._values)
+
+    def conflict_with(self, parameter):
+        """Checks whether the parameter conflicts with given other parameter.
+
+        :return: True if self conflicts with parameter, i.e. contains different
+            values corresponding to same key.
+        :rtype: bool
+
+        """
+        return any(key in parameter and parameter[key] != value
+                   for key, value in self.iteritems())
+
+    def to_str_valued_dict(self):
+        """Gets dictionary with stringized values.
+
+        :return: A dictionary with same key and stringized values.
+        :rtype: dict of str key and str value
+
+        """
+        return dict([(k, str(v)) for k, v in self.iteritems()])
+
+
 class Rule(object):
     """A wrapper object of a rule function with associate values,
     which change is tracked on the experiment.
@@ -317,13 +1132,14 @@ class Rule(object):
     :param dependson: list of variable or function, which one wants to track.
         All these variables are later converted to string values, so if
         one wants to pass the variable of user-defined class, that class
-        must provide meaningful `__str__` method.
+        must provide meaningful `__str__` method. Functions are converted to
+        digests of their code (see :py:func:`get_fingerprint`).
 
     """
 
     def __init__(self, fun, dependson=[]):
         self.fun = fun
-        self.dependson = dependson
+        self.dependson = list(dependson)
         self.dependson.append(self.fun)
 
     def add_dependson(self, dependson):
@@ -331,14 +1147,198 @@ class Rule(object):
 
     def stred_dependson(self):
         def to_str(d):
-            # Callable object is converted to its source code as str.
+            # Callable object is converted to the digest of its code.
             if _is_callable(d):
-                return inspect.getsource(d)
+                return get_fingerprint(d)
             else:
                 return str(d)
         return map(to_str, self.dependson)
 
 
+_fingerprints = {}
+
+_LITERAL_TYPES = (
+    types.NoneType, bool, int, long, float, complex, str, unicode, tuple,
+    list, dict, set, frozenset)
+
+
+def get_fingerprint(fun):
+    """Gets a digest of a callable object, which changes when its behavior
+    may change.
+
+    The digest of a function covers its bytecode, constants including nested
+    functions, default arguments, and values of referenced globals and
+    closure cells. Referenced functions are digested recursively, modules
+    and classes are represented by their names, and other values by their
+    representations if they are literal (e.g. numbers, strings and
+    containers of them) or by their types otherwise. A callable object is
+    digested by its ``__call__`` method and its attributes. Line numbers are not
+    included, so editing comments or blank lines does not change the
+    digest. Digests are memoized for each function.
+
+    :param fun: Callable object.
+    :return: Hex digest of the callable.
+    :rtype: ``str``
+
+    """
+    return _get_fingerprint(fun, set())
+
+
+def _get_fingerprint(fun, visiting):
+    if not isinstance(fun, (types.FunctionType, types.MethodType, type,
+                            types.ClassType, types.BuiltinFunctionType)):
+        return _get_object_fingerprint(fun, visiting)
+    if isinstance(fun, types.MethodType):
+        fun = fun.__func__
+    if not isinstance(fun, types.FunctionType):
+        # Class, or function implemented in C.
+        return '%s.%s' % (getattr(fun, '__module__', None),
+                          getattr(fun, '__name__', type(fun).__name__))
+
+    try:
+        return _fingerprints[fun]
+    except KeyError:
+        pass
+
+    if fun in visiting:
+        # Recursive reference is represented by name.
+        return '%s.%s' % (fun.__module__, fun.__name__)
+
+    visiting.add(fun)
+    try:
+        code = fun.__code__
+        h = hashlib.sha1(_get_code_fingerprint(code, visiting))
+        for value in fun.__defaults__ or ():
+            h.update(_get_value_fingerprint(value, visiting))
+        for name in sorted(_get_global_names(code)):
+            if name in fun.__globals__:
+                h.update(name)
+                h.update(_get_value_fingerprint(fun.__globals__[name],
+                                                visiting))
+        for cell in fun.__closure__ or ():
+            try:
+                value = cell.cell_contents
+            except ValueError:  # empty cell
+                value = None
+            h.update(_get_value_fingerprint(value, visiting))
+    finally:
+        visiting.remove(fun)
+
+    fingerprint = h.hexdigest()
+    _fingerprints[fun] = fingerprint
+    return fingerprint
+
+
+def _get_object_fingerprint(obj, visiting):
+    # Callable object is digested by its __call__ method and its attributes,
+    # which are not memoized since they may change.
+    if id(obj) in visiting:
+        return 'object %s.%s' % (type(obj).__module__, type(obj).__name__)
+    call = getattr(obj.__call__, '__func__', None)
+    if not isinstance(call, types.FunctionType):
+        # __call__ implemented in C.
+        return 'object %s.%s' % (type(obj).__module__, type(obj).__name__)
+
+    visiting.add(id(obj))
+    try:
+        h = hashlib.sha1(_get_fingerprint(call, visiting))
+        h.update(_get_value_fingerprint(getattr(obj, '__dict__', {}),
+                                        visiting))
+    finally:
+        visiting.remove(id(obj))
+    return h.hexdigest()
+
+
+def _get_code_fingerprint(code, visiting):
+    h = hashlib.sha1(code.co_code)
+    h.update(repr((code.co_argcount, code.co_flags, code.co_names,
+                   code.co_freevars)))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            h.update(_get_code_fingerprint(const, visiting))
+        else:
+            h.update(repr(const))
+    return h.hexdigest()
+
+
+def _get_global_names(code):
+    """Gets names that code or its nested code may refer as globals."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _get_global_names(const)
+    return names
+
+
+def _get_value_fingerprint(value, visiting):
+    if isinstance(value, (types.FunctionType, types.MethodType)):
+        return _get_fingerprint(value, visiting)
+    if isinstance(value, types.ModuleType):
+        return 'module %s' % value.__name__
+    if isinstance(value, (type, types.ClassType)):
+        return 'class %s.%s' % (value.__module__, value.__name__)
+    if isinstance(value, (dict, set, frozenset, tuple, list)):
+        if id(value) in visiting:
+            # Recursive reference is represented as repr does.
+            return '[...]'
+        visiting.add(id(value))
+        try:
+            if isinstance(value, (tuple, list)):
+                return repr([_get_value_fingerprint(item, visiting)
+                             for item in value])
+            items = value.iteritems() if isinstance(value, dict) else value
+            return repr(sorted(_get_value_fingerprint(item, visiting)
+                               for item in items))
+        finally:
+            visiting.remove(id(value))
+    if isinstance(value, _LITERAL_TYPES):
+        return repr(value)
+    # Representations of other objects may contain their addresses.
+    return 'object %s.%s' % (type(value).__module__, type(value).__name__)
+
+
+class _Pipeline(object):
+    """Calls of ``ExperimentContext.__call__`` that run one parameter to its
+    result, which are copied for each rung or round of a sweep."""
+
+    def __init__(self, pipeline, result=None):
+        self.pipeline = [dict(kw) for kw in pipeline]
+        for kw in self.pipeline:
+            for key in ['source', 'target']:
+                _let_element_to_be_list(kw, key)
+        if 'parameters' in self.pipeline[0]:
+            raise InvalidMafArgumentException(
+                "the first call of a pipeline must not have 'parameters'")
+
+        if result is None:
+            if len(self.pipeline[-1]['target']) != 1:
+                raise InvalidMafArgumentException(
+                    "'result' is required if the pipeline ends with multiple "
+                    "targets")
+            result = self.pipeline[-1]['target'][0]
+        self.result = result
+        self.targets = set(itertools.chain.from_iterable(
+            kw['target'] for kw in self.pipeline))
+
+    def add(self, ctx, parameters, suffix):
+        """Adds a copy of the pipeline whose targets are suffixed.
+
+        :return: The call object receiving the parameters and the result meta
+            node of the copy.
+        :rtype: ``tuple``
+
+        """
+        rename = lambda node: node + suffix if node in self.targets else node
+        call_objects = []
+        for kw in self.pipeline:
+            kw = dict(kw, source=map(rename, kw['source']),
+                      target=map(rename, kw['target']))
+            if not call_objects:
+                kw['parameters'] = parameters
+            call_objects.append(ctx._add_call_object(CallObject(**kw)))
+        return call_objects[0], rename(self.result)
+
+
 class CallObject(object):
     """Object representing one call of ``ExperimentContext.__call__()``."""
 
@@ -362,15 +1362,213 @@ class CallObject(object):
 
         self.__dict__['features'].append('experiment')
         if 'parameters' not in self.__dict__:
-            self.parameters = [Parameter()]
+            self.parameters = [FrozenParameter()]
             """List of parameters indicated by the taskgen call."""
-        else:
-            self.parameters = [Parameter(p) for p in self.parameters]
+        elif isinstance(self.parameters, (list, tuple)):
+            self.parameters = [FrozenParameter(p) for p in self.parameters]
+        # Other iterables, e.g. maflib.util.lazy_product, are iterated and
+        # deferred parameters are chosen right before the call object is
+        # expanded.
 
     def __eq__(self, other):
         return self.__dict__ == other.__dict__
 
 
+class DeferredParameters(object):
+    """Parameters of a call object that are chosen by results of former call
+    objects right before the call object is expanded.
+
+    See :py:meth:`ExperimentContext.successive_halving` and
+    :py:meth:`ExperimentContext.optimize`.
+
+    """
+    @property
+    def nodes(self):
+        """Meta nodes of the results from which the parameters are chosen."""
+        raise NotImplementedError()
+
+    def evaluate(self, read_results):
+        """Chooses the parameters.
+
+        :param read_results: Function that takes a meta node and returns pairs
+            of the parameter of each physical node and its content, which is a
+            JSON object or a list of them.
+        :type read_results: ``function``
+        :return: Parameters of the call object.
+        :rtype: ``list`` of ``dict``
+
+        """
+        raise NotImplementedError()
+
+
+class PromotedParameters(DeferredParameters):
+    """Parameters of a rung of a sweep, which are promoted from former rungs
+    by their results.
+
+    """
+    def __init__(self, rungs, budget, value, key, eta, maximize):
+        """Initializes the parameters.
+
+        :param rungs: Pairs of the call object receiving the parameters of a
+            former rung and the result meta node of the rung.
+        :type rungs: ``list`` of ``tuple``
+        :param budget: Name of the parameter that gives the budget.
+        :type budget: ``str``
+        :param value: Budget of this rung.
+        :param key: Key of results by which parameters are ranked.
+        :type key: ``str``
+        :param eta: Each former rung promotes the best ``1 / eta`` of its
+            parameters.
+        :type eta: ``int``
+        :param maximize: Whether larger results are better.
+        :type maximize: ``bool``
+
+        """
+        self.rungs = rungs
+        self.budget = budget
+        self.value = value
+        self.key = key
+        self.eta = eta
+        self.maximize = maximize
+
+        self.parameters = []
+        """Parameters added to this rung without promotion."""
+
+    @property
+    def nodes(self):
+        return [node for _, node in self.rungs]
+
+    def evaluate(self, read_results):
+        parameters = list(self.parameters)
+        for call_object, node in self.rungs:
+            # Candidates are the parameters of the former rung except for the
+            # budget.
+            candidates = [
+                FrozenParameter((k, v) for k, v in p.iteritems()
+                                if k != self.budget)
+                for p in call_object.parameters]
+            scores = _get_scores(candidates, read_results(node), self.key)
+
+            sign = -1 if self.maximize else 1
+            ranked = sorted((sign * score, i)
+                            for i, score in enumerate(scores)
+                            if score is not None)
+            for _, i in ranked[:max(1, len(candidates) // self.eta)]:
+                parameters.append(
+                    dict(candidates[i], **{self.budget: self.value}))
+        return parameters
+
+
+class ProposedParameters(DeferredParameters):
+    """Parameters of a round of an optimization, which are proposed by a
+    sampler from the results of former rounds.
+
+    """
+    def __init__(self, rounds, sampler, num_samples, key, maximize):
+        """Initializes the parameters.
+
+        :param rounds: Pairs of the call object receiving the parameters of a
+            former round and the result meta node of the round.
+        :type rounds: ``list`` of ``tuple``
+        :param sampler: Function that takes the number of parameters to
+            propose and a list of pairs of a parameter and its score, and
+            returns parameters expected to get larger scores, e.g.
+            :py:class:`maflib.util.GaussianProcessSampler`.
+        :type sampler: ``function``
+        :param num_samples: Number of parameters of this round.
+        :type num_samples: ``int``
+        :param key: Key of results that gives the scores.
+        :type key: ``str``
+        :param maximize: Whether larger results are better.
+        :type maximize: ``bool``
+
+        """
+        self.rounds = rounds
+        self.sampler = sampler
+        self.num_samples = num_samples
+        self.key = key
+        self.maximize = maximize
+
+    @property
+    def nodes(self):
+        return [node for _, node in self.rounds]
+
+    def evaluate(self, read_results):
+        sign = 1 if self.maximize else -1
+        observations = []
+        # Parameters already run, which would be copied again to the same
+        # result node of the optimization.
+        seen = set()
+        for call_object, node in self.rounds:
+            candidates = call_object.parameters
+            scores = _get_scores(candidates, read_results(node), self.key)
+            observations += [(dict(candidate), sign * score)
+                             for candidate, score in zip(candidates, scores)
+                             if score is not None]
+            seen.update(FrozenParameter(candidate) for candidate in candidates)
+        proposals = []
+        for proposal in self.sampler(self.num_samples, observations):
+            frozen = FrozenParameter(proposal)
+            if frozen not in seen:
+                seen.add(frozen)
+                proposals.append(proposal)
+        return proposals
+
+
+class PhysicalCallObject(object):
+    """Arguments of ``BuildContext.__call__`` for one physical task generator.
+
+    Physical call objects generated from one :py:class:`CallObject` share a
+    template, i.e. the arguments of the call object except for those only
+    meaningful to meta nodes (``parameters``, ``for_each`` and
+    ``aggregate_by``). Each physical call object only holds its own physical
+    source and target nodes, so the call object is never copied.
+
+    """
+    __slots__ = ('template', 'source', 'target')
+
+    META_KEYS = frozenset(('parameters', 'for_each', 'aggregate_by'))
+
+    @staticmethod
+    def create_template(call_object):
+        """Creates a template shared by physical call objects.
+
+        :param call_object: Call object from which physical call objects are
+            generated.
+        :type call_object: :py:class:`CallObject`
+        :return: Arguments of the call object except for meta ones.
+        :rtype: ``dict``
+
+        """
+        return dict((key, value) for key, value in
+                    call_object.__dict__.iteritems()
+                    if key not in PhysicalCallObject.META_KEYS)
+
+    def __init__(self, template, source, target):
+        self.template = template
+        self.source = source
+        self.target = target
+
+    def __getattr__(self, name):
+        try:
+            return self.template[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def to_kwargs(self):
+        """Gets arguments of ``BuildContext.__call__``.
+
+        :return: A new dictionary of the template with physical source and
+            target.
+        :rtype: ``dict``
+
+        """
+        kw = dict(self.template)
+        kw['source'] = self.source
+        kw['target'] = self.target
+        return kw
+
+
 class ExperimentGraph(object):
     """Bipartite graph consisting of meta node and call object node."""
 
@@ -388,7 +1586,7 @@ class ExperimentGraph(object):
         index = len(self._call_objects)
         self._call_objects.append(call_object)
 
-        for in_node in call_object.source:
+        for in_node in _get_input_nodes(call_object):
             self._edges[in_node].add(index)
 
         for out_node in call_object.target:
@@ -432,6 +1630,34 @@ class ExperimentGraph(object):
 
         return ret
 
+    def get_call_object_levels(self):
+        """Splits call objects into topological levels.
+
+        Each call object belongs to the level next to the deepest level of the
+        call objects producing its source nodes, so call objects in a level
+        only depend on those in former levels.
+
+        :return: List of levels, each of which is a list of call objects.
+        :rtype: list of list of :py:class:`CallObject`
+
+        """
+        node_levels = {}
+        levels = []
+        for call_object in self.get_sorted_call_objects():
+            level = 0
+            for node in _get_input_nodes(call_object):
+                if node in node_levels:
+                    level = max(level, node_levels[node] + 1)
+            for node in call_object.target:
+                node_levels[node] = max(
+                    node_levels.get(node, 0), level)
+
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(call_object)
+
+        return levels
+
     def _collect_independent_nodes(self):
         nodes = set(self._edges)
         for node in self._edges:
@@ -447,7 +1673,22 @@ class ParameterIdGenerator(object):
     one physical waf node named as 'path/N', where N is a unique name of the
     parameter. The correspondence between parameter and its name must be
     consistent over multiple execution of waf, so we serializes the table to
-    hidden file.
+    hidden files.
+
+    The table is stored in two files. The file at ``path`` is a snapshot of
+    the table, which is a pickled list of dicts whose indices are the ids;
+    it can be read without maflib. Ids generated after the snapshot are
+    appended to the log file at ``path + '.log'`` in batches, each of which
+    is fsync-ed, so existing entries are never rewritten on generating new
+    ids. :py:meth:`save` merges the log into the snapshot, optionally in a
+    background thread. The table is loaded on its first use.
+
+    The table can be shared by multiple processes, e.g. waf executions with
+    different targets running at once. Reading and writing the files are
+    guarded by an exclusive lock of the file at ``path + '.lock'``. Ids are
+    generated in a transaction: on the first unknown parameter the generator
+    takes the lock and reads ids generated by other processes, and it keeps
+    the lock until the new ids are flushed to the log.
 
     This class also dumps the correspondence to a human-readable text file.
     The file is tab-separated line for each correspondence: the first element
@@ -459,6 +1700,10 @@ class ParameterIdGenerator(object):
     exception was raised.
 
     """
+
+    flush_interval = 10000
+    """Number of new ids written to the log at once."""
+
     def __init__(self, path, text_path):
         """Initializes the generator.
 
@@ -474,107 +1719,1792 @@ class ParameterIdGenerator(object):
         self.path = path
         """Path to file that the table is serialized to."""
 
+        self.log_path = path + '.log'
+        """Path to file that ids generated after the snapshot are appended
+        to."""
+
+        self.lock_path = path + '.lock'
+        """Path to file locked on accessing the table files."""
+
         self.text_path = text_path
         """Path to file that the table is dumped to as a human-readable text."""
 
-        if os.path.exists(path):
-            self._table = self._load_table(path)
-        else:
-            self._table = {}
+        self.token_path = path + '.token'
+        """Path to file of the random token identifying the table."""
+
+        self._token = None
+        self._table_cache = None
+        # Inverse of the table, which is built on demand.
+        self._parameters = None
+        # New pairs of parameter and id that are not written to the log yet.
+        self._pending = []
+        # State of the files read so far.
+        self._snapshot_stat = None
+        self._log_offset = 0
+        # Locked file while a transaction is open.
+        self._transaction = None
+        self._compactor = None
+
+    def __len__(self):
+        return len(self._table)
+
+    @property
+    def token(self):
+        """Random token of the table, which changes when the table is removed
+        and created again, so that caches of ids can tell the new table from
+        the old one. The token is renewed while the table is empty."""
+        if self._token is None:
+            lock = _open_locked_file(self.lock_path)
+            try:
+                token = None
+                if len(self) and os.path.exists(self.token_path):
+                    with open(self.token_path) as f:
+                        token = f.read()
+                if not token:
+                    token = os.urandom(16).encode('hex')
+                    with _create_file(self.token_path) as f:
+                        f.write(token)
+            finally:
+                lock.close()
+            self._token = token
+        return self._token
+
+    @property
+    def _table(self):
+        if self._table_cache is None:
+            # Loading does not need the lock: the snapshot is replaced
+            # atomically, and a batch being written by another process is
+            # read later in a transaction.
+            self._table_cache = {}
+            self._update()
+        return self._table_cache
+
+    def flush(self):
+        """Appends the ids generated since the last flush to the log file.
+
+        It also ends the transaction, so other processes can generate ids.
 
-    def save(self):
-        """Serializes the table to the file at self.path."""
+        """
+        if self._transaction is None:
+            return
+
+        try:
+            if self._pending:
+                with _create_file(self.log_path, 'ab') as f:
+                    pickle.dump([(id, dict(param.iteritems()))
+                                 for (param, id) in self._pending],
+                                f, pickle.HIGHEST_PROTOCOL)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self._log_offset = f.tell()
+                self._pending = []
+        finally:
+            self._transaction.close()
+            self._transaction = None
+
+    def save(self, background=False):
+        """Serializes the table to the file at self.path.
+
+        New ids are first flushed to the log, and then the log is merged into
+        the snapshot and the human-readable text file. Nothing is rewritten if
+        the log is empty.
+
+        :param background: If True, the merge runs in a non-daemon thread, so
+            it is completed before the process exits.
+        :type background: bool
 
-        if len(self._table) == 0: return
+        """
+        self.flush()
+        if not os.path.exists(self.log_path):
+            return
+
+        self._wait_compaction()
+        if background:
+            self._compactor = threading.Thread(target=self._compact)
+            self._compactor.start()
+        else:
+            self._compact()
 
-        parameter_ids = [(param, int(id)) for (param, id) in self._table.items()]
-        parameter_ids.sort(key=lambda param_and_id: param_and_id[1])
-        
-        with _create_file(self.path) as f:
+    def _compact(self):
+        # The files are read again instead of using self._table, since the
+        # log may contain ids generated by other processes.
+        lock = _open_locked_file(self.lock_path)
+        try:
             # We don't save the self._table, which type is dict(Parameter,int) directly,
             # instead saves list(dict), which index corresponds to the id of the item.
             # This is for deserializing parameter->id mappings outside of map, without
             # maflib and waflib dependencies. Parameter class is defined in maflib,
             # so user cannot decode original _table object without maflib libraries.
             # When deserializaing, ``self._table`` is load by ``_load_table``.
-            max_param_id = parameter_ids[-1][1]
-            dict_param_list = [None for i in range(max_param_id + 1)]
-            for (param, id) in parameter_ids:
-                dict_param_list[id] = dict(param)
-            pickle.dump(dict_param_list, f)
-
-        with _create_file(self.text_path) as f:
-            for parameter, id in parameter_ids:
-                f.write('%s\t%s\n' % (id, parameter))
-
-    def _load_table(self, path):
-        table = {}
+            dict_param_list = self._read_snapshot()
+            if os.path.exists(self.log_path):
+                with open(self.log_path, 'rb') as f:
+                    for batch in _read_batches(f):
+                        for id, dict_param in batch:
+                            id = int(id)
+                            if id >= len(dict_param_list):
+                                dict_param_list.extend(
+                                    [None] * (id + 1 - len(dict_param_list)))
+                            dict_param_list[id] = dict_param
+
+            # The snapshot is replaced atomically before the log is removed,
+            # so the table is never lost on crash.
+            with _create_file(self.path + '.tmp', 'wb') as f:
+                pickle.dump(dict_param_list, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(self.path + '.tmp', self.path)
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+
+            with _create_file(self.text_path) as f:
+                for id, dict_param in enumerate(dict_param_list):
+                    if dict_param is not None:
+                        f.write('%s\t%s\n' % (id, FrozenParameter(dict_param)))
+        finally:
+            lock.close()
+
+    def _wait_compaction(self):
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+
+    def _begin(self):
+        if self._transaction is not None:
+            return
+        self._wait_compaction()
+        self._transaction = _open_locked_file(self.lock_path)
+        self._update()
+
+    def _update(self):
+        """Reads ids written by others since the last read."""
+        table = self._table_cache
+        snapshot_stat = _get_file_stat(self.path)
+        if snapshot_stat != self._snapshot_stat:
+            # The snapshot has been created or merged with the log.
+            for i, dict_param in enumerate(self._read_snapshot()):
+                if dict_param is not None:
+                    table[FrozenParameter(dict_param)] = str(i)
+            self._snapshot_stat = snapshot_stat
+            self._log_offset = 0
+
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r+b') as f:
+                f.seek(self._log_offset)
+                for batch in _read_batches(f):
+                    for id, dict_param in batch:
+                        table[FrozenParameter(dict_param)] = id
+                    self._log_offset = f.tell()
+                if self._transaction is not None:
+                    # No one is writing the log, so the rest is a batch
+                    # partially written on crash.
+                    f.truncate(self._log_offset)
+        self._parameters = None
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.path):
+            return []
         try:
-            with open(path) as f:
-                dict_param_list = pickle.load(f)
-                for i, dict_param in enumerate(dict_param_list):
-                    if dict_param is not None: table[Parameter(dict_param)] = str(i)
-        except EOFError: pass
-        return table
+            with open(self.path, 'rb') as f:
+                return pickle.load(f)
+        except EOFError:
+            return []
 
     def get_id(self, parameter):
         """Gets the id of given parameter.
 
         :param parameter: Parameter object.
-        :type parameter: :py:class:`Parameter`
+        :type parameter: :py:class:`FrozenParameter` or :py:class:`Parameter`
         :return: Identifier of given parameter. The id may be generated in this
             method if necessary.
         :rtype: str
 
         """
-        if parameter in self._table:
-            return self._table[parameter]
-
-        new_id = str(len(self._table))
-        self._table[parameter] = new_id
+        table = self._table
+        if parameter in table:
+            return table[parameter]
+
+        # Other processes may have generated the id.
+        self._begin()
+        if parameter in table:
+            return table[parameter]
+
+        if not isinstance(parameter, FrozenParameter):
+            parameter = FrozenParameter(parameter)
+        new_id = str(len(table))
+        table[parameter] = new_id
+        if self._parameters is not None:
+            self._parameters[new_id] = parameter
+
+        self._pending.append((parameter, new_id))
+        if len(self._pending) >= self.flush_interval:
+            self.flush()
 
         return new_id
 
+    def get_parameter(self, parameter_id):
+        """Gets the parameter of given id.
 
-class ExperimentTask(waflib.Task.Task):
-    """A task class specific for ExperimentContext.
+        :param parameter_id: Identifier of a parameter.
+        :type parameter_id: str
+        :return: The parameter of given id, or None if the id is not generated
+            yet.
+        :rtype: :py:class:`FrozenParameter`
 
-    The purpose of this class is to bring the parameter as an attribute.
-    The base class (:py:class:`waflib.Task.Task`) doesn't bring attributes
-    except ``env``, but the env must be a string-valued dictionary, which is
-    problematic when we want to use the parameter in an object as it is. For
-    example, a float value once converted to string lose some information.
+        """
+        if self._parameters is None:
+            self._parameters = dict(
+                (id, param) for (param, id) in self._table.iteritems())
+        return self._parameters.get(parameter_id)
 
-    Another motivation for this task is to control the hash value of a task:
-    It is calculated based on the env, in which key is registered in ``vars``
-    or ``dep_vars``. In ``__init__``, this task registers necessary keys to
-    dep_vars.
 
-    """
+class ExpansionCache(object):
+    """Persistent cache of call objects expanded into physical tasks.
 
-    shell = True
-    """support pipe style rule str in default"""
+    Each entry corresponds to one call object and holds the pairs of source
+    parameters and target parameter of its physical tasks. Parameters are
+    stored by their ids given by :py:class:`ParameterIdGenerator`, so the
+    cache is discarded when the token of the id table differs from that on
+    saving the cache, i.e. when the table has been removed, even if a new
+    table has grown as large as the old one.
+    Entries are keyed by expansion keys, which cover the call object and the
+    keys of all upstream call objects; see :py:func:`_get_expansion_key`.
 
-    def __init__(self, env, generator):
-        """Initializes the task.
+    Only the entries used in the current execution are saved, so the cache
+    does not grow with stale entries.
 
-        :param env: Environmental variables.
-        :param generator: Generator function.
+    """
+    def __init__(self, path, id_generator):
+        """Initializes the cache.
 
-        """
+        :param path: Path to persistent file of the cache.
+        :type path: str
+        :param id_generator: Generator of parameter ids that entries refer to.
+        :type id_generator: :py:class:`ParameterIdGenerator`
 
-        super(ExperimentTask, self).__init__(env=env, generator=generator)
+        """
+        self.path = path
+        """Path to file that the cache is serialized to."""
 
-        self.parameter = generator.parameter
-        """Parameter whose values are not stringized."""
+        self._id_generator = id_generator
+        self._entries = {}
+        self._used_entries = {}
 
-        if not hasattr(self, 'dep_vars'): self.dep_vars = []
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    token, entries = pickle.load(f)
+                if token == id_generator.token:
+                    self._entries = entries
+            except (EOFError, ValueError, pickle.UnpicklingError):
+                pass
+
+    def get(self, key):
+        """Gets the physical tasks of a call object.
+
+        :param key: Expansion key of the call object.
+        :type key: str
+        :return: List of pairs of source parameter list and target parameter,
+            or None if the cache does not have a valid entry.
+        :rtype: ``list`` of ``tuple``
+
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        def resolve(parameter_id):
+            if parameter_id is None:
+                return FrozenParameter()
+            return self._id_generator.get_parameter(parameter_id)
+
+        tasks = []
+        for source_ids, target_id in entry:
+            source_parameter = [resolve(i) for i in source_ids]
+            target_parameter = resolve(target_id)
+            if target_parameter is None or None in source_parameter:
+                return None
+            tasks.append((source_parameter, target_parameter))
+
+        self._used_entries[key] = entry
+        return tasks
+
+    def set(self, key, tasks):
+        """Sets the physical tasks of a call object.
+
+        :param key: Expansion key of the call object.
+        :type key: str
+        :param tasks: List of pairs of source parameter list and target
+            parameter.
+        :type tasks: ``list`` of ``tuple``
+
+        """
+        def get_id(parameter):
+            if not parameter:
+                return None
+            return self._id_generator.get_id(parameter)
+
+        self._used_entries[key] = [
+            (tuple(get_id(p) for p in source_parameter),
+             get_id(target_parameter))
+            for source_parameter, target_parameter in tasks]
+
+    def save(self):
+        """Serializes the used entries to the file at self.path.
+
+        The ids must be flushed by the id generator before calling this
+        method.
+
+        """
+        with _create_file(self.path, 'wb') as f:
+            pickle.dump((self._id_generator.token, self._used_entries),
+                        f, pickle.HIGHEST_PROTOCOL)
+
+
+class InputSignatureCache(object):
+    """Persistent cache of signatures of input files.
+
+    Waf hashes the content of each source file on every build. This cache
+    keeps the hash with the inode number, the size and the modification time
+    of the file, and hashes the file again only when one of them changes, so
+    a no-op build over large datasets only reads file metadata. The hash is
+    same as that of waf, so using the cache does not change task signatures.
+
+    A file modified within a second before hashing is not cached, since its
+    modification time may not change on the next modification. In the
+    verification mode, all files are hashed again and the cache is updated.
+
+    """
+    def __init__(self, path, verify=False):
+        """Initializes the cache.
+
+        :param path: Path to persistent file of the cache.
+        :type path: str
+        :param verify: If True, cached signatures are not used.
+        :type verify: bool
+
+        """
+        self.path = path
+        """Path to file that the cache is serialized to."""
+
+        self.verify = verify
+        """Whether files are hashed regardless of their stats."""
+
+        self._entries = {}
+        self._modified = False
+        # Paths whose signatures are already checked in this execution.
+        self._checked = set()
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    self._entries = pickle.load(f)
+            except (EOFError, ValueError, pickle.UnpicklingError):
+                pass
+
+    def get_signature(self, path):
+        """Gets the signature of a file.
+
+        :param path: Absolute path to the file.
+        :type path: str
+        :return: MD5 digest of the file content.
+        :rtype: str
+
+        """
+        if path in self._checked:
+            return self._entries[path][1]
+
+        st = os.stat(path)
+        stat = (st.st_ino, st.st_size,
+                getattr(st, 'st_mtime_ns', st.st_mtime))
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != stat or self.verify:
+            entry = (stat, waflib.Utils.h_file(path))
+            if time.time() - st.st_mtime < 1:
+                # Modification within the same tick would not change stat.
+                entry = (None, entry[1])
+            self._entries[path] = entry
+            self._modified = True
+        self._checked.add(path)
+        return entry[1]
+
+    def save(self):
+        """Serializes the cache to the file at self.path if it is updated."""
+        if not self._modified:
+            return
+        with _create_file(self.path, 'wb') as f:
+            pickle.dump(self._entries, f, pickle.HIGHEST_PROTOCOL)
+
+
+class TaskRuntimeHistory(object):
+    """Persistent record of wall times of experiment tasks.
+
+    A runtime is recorded under the name of the call object and the id of the
+    target parameter of the task (see :py:meth:`ExperimentTask.runtime_key`).
+    The runtime of a task is predicted by its last record, or by the mean of
+    the records of its call object if the task has never run.
+
+    """
+    def __init__(self, path):
+        """Initializes the history.
+
+        :param path: Path to persistent file of the history.
+        :type path: str
+
+        """
+        self.path = path
+        """Path to file that the history is serialized to."""
+
+        # Dict of call object name to dict of parameter id to runtime.
+        self._records = {}
+        self._totals = {}
+        self._modified = False
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    self._records = pickle.load(f)
+            except (EOFError, ValueError, pickle.UnpicklingError):
+                pass
+        for name, records in self._records.iteritems():
+            self._totals[name] = sum(records.itervalues())
+
+    def predict(self, key):
+        """Predicts the runtime of a task.
+
+        :param key: Runtime key of the task.
+        :type key: ``tuple``
+        :return: Predicted runtime in seconds, or 0 if the call object of the
+            task has never run.
+        :rtype: ``float``
+
+        """
+        name, parameter_id = key
+        records = self._records.get(name)
+        if not records:
+            return 0.0
+        try:
+            return records[parameter_id]
+        except KeyError:
+            return self._totals[name] / len(records)
+
+    def record(self, key, runtime):
+        """Records the runtime of a task.
+
+        :param key: Runtime key of the task.
+        :type key: ``tuple``
+        :param runtime: Wall time of the task in seconds.
+        :type runtime: ``float``
+
+        """
+        name, parameter_id = key
+        records = self._records.setdefault(name, {})
+        self._totals[name] = (self._totals.get(name, 0.0) + runtime -
+                              records.get(parameter_id, 0.0))
+        records[parameter_id] = runtime
+        self._modified = True
+
+    def save(self):
+        """Serializes the history to the file at self.path if it is updated."""
+        if not self._modified:
+            return
+        with _create_file(self.path, 'wb') as f:
+            pickle.dump(self._records, f, pickle.HIGHEST_PROTOCOL)
+
+
+class ResultStore(object):
+    """Columnar store of JSON results of physical nodes of one meta node.
+
+    Each result is recorded as rows of a sqlite table, one row per element
+    of a list of dicts, indexed by the parameter id of the physical node;
+    each key of the dicts gets its own column. Aggregation tasks read all the
+    results of their source meta node by one query instead of opening and
+    parsing every file.
+
+    The size and modification time of the file are recorded with its rows,
+    so a reader can tell whether the rows are still those of the file.
+
+    """
+
+    def __init__(self, path):
+        """Initializes the store.
+
+        :param path: Path to the sqlite file of the store.
+        :type path: str
+
+        """
+        self.path = path
+        """Path to the sqlite file of the store."""
+
+        self._connection = None
+        self._columns = None
+        self._lock = threading.Lock()
+
+    def record(self, parameter_id, path):
+        """Records the result of a physical node, replacing its former rows.
+        A file other than a JSON dict or a JSON list of dicts is only removed
+        from the store.
+
+        :param parameter_id: Parameter id of the physical node.
+        :type parameter_id: str
+        :param path: Path to the result file.
+        :type path: str
+
+        """
+        st = os.stat(path)
+        with open(path) as f:
+            content = f.read()
+        rows = None
+        if content.lstrip()[:1] in ('{', '['):
+            try:
+                rows = json.loads(content)
+            except ValueError:
+                pass
+        if isinstance(rows, dict):
+            rows = [rows]
+        if (not isinstance(rows, list) or
+                not all(isinstance(row, dict) for row in rows)):
+            rows = None
+
+        with self._lock:
+            connection = self._connect()
+            if rows is not None:
+                for row in rows:
+                    for key in row:
+                        self._add_column(key)
+            connection.execute(
+                'DELETE FROM records WHERE id = ?', (parameter_id,))
+            if rows is not None:
+                for position, row in enumerate(rows):
+                    columns = [self._columns[key] for key in row]
+                    connection.execute(
+                        'INSERT INTO records (id, position, mtime, size%s) '
+                        'VALUES (?, ?, ?, ?%s)' % (
+                            ''.join(', ' + column for column in columns),
+                            ', ?' * len(columns)),
+                        [parameter_id, position, st.st_mtime, st.st_size] +
+                        [_encode_stored_value(value)
+                         for value in row.itervalues()])
+            connection.commit()
+
+    def read(self, parameter_ids=None):
+        """Reads results in the store.
+
+        :param parameter_ids: Parameter ids of the physical nodes to read, or
+            None to read all the results.
+        :return: Dict from parameter id to a tuple of the size and the
+            modification time of the file and its list of dicts.
+        :rtype: ``dict``
+
+        """
+        if not os.path.exists(self.path):
+            return {}
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            keys = _read_stored_keys(connection)
+            if parameter_ids is None:
+                return _read_stored_results(connection.execute(
+                    'SELECT * FROM records ORDER BY id, position'), keys)
+            parameter_ids = list(parameter_ids)
+            results = {}
+            # sqlite limits the number of parameters of a query.
+            for i in xrange(0, len(parameter_ids), 500):
+                chunk = parameter_ids[i:i + 500]
+                results.update(_read_stored_results(connection.execute(
+                    'SELECT * FROM records WHERE id IN (%s) '
+                    'ORDER BY id, position' % ', '.join('?' * len(chunk)),
+                    chunk), keys))
+            return results
+        finally:
+            connection.close()
+
+    def get(self, parameter_id):
+        """Reads the result of a physical node.
+
+        :param parameter_id: Parameter id of the physical node.
+        :type parameter_id: str
+        :return: Tuple of the size and the modification time of the file and
+            its list of dicts, or None if it is not recorded.
+        :rtype: ``tuple``
+
+        """
+        with self._lock:
+            if self._connection is None and not os.path.exists(self.path):
+                return None
+            connection = self._connect()
+            results = _read_stored_results(
+                connection.execute(
+                    'SELECT * FROM records WHERE id = ? ORDER BY position',
+                    (parameter_id,)),
+                _read_stored_keys(connection))
+        return results.get(parameter_id)
+
+    def close(self):
+        """Closes the connection to the sqlite file."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            dirname = os.path.dirname(self.path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False)
+            # The store is a cache of result files, which are always
+            # rewritten by their tasks, so it need not survive a crash.
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS records (id TEXT NOT NULL, '
+                'position INTEGER NOT NULL, mtime REAL, size INTEGER)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS records_id ON records (id)')
+            # Column names of sqlite are case-insensitive, so keys are given
+            # numbered columns by this table.
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS columns '
+                '(number INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE)')
+            connection.commit()
+            self._connection = connection
+            self._columns = {}
+        return self._connection
+
+    def _add_column(self, key):
+        if key in self._columns:
+            return
+        connection = self._connection
+        connection.execute(
+            'INSERT OR IGNORE INTO columns (key) VALUES (?)', (key,))
+        connection.commit()
+        number, = connection.execute(
+            'SELECT number FROM columns WHERE key = ?', (key,)).fetchone()
+        column = 'c%d' % number
+        try:
+            connection.execute('ALTER TABLE records ADD COLUMN ' + column)
+        except sqlite3.OperationalError as e:
+            if 'duplicate column name' not in str(e):
+                raise
+            # Another process or a former build has added the column.
+        self._columns[key] = column
+
+
+class CriticalPathScheduler(waflib.Runner.Parallel):
+    """Producer of tasks that runs ready tasks in descending order of their
+    critical paths, i.e. the longest predicted runtime from the task to the
+    end of its build group, packing them into available resources.
+
+    Unlike :py:class:`waflib.Runner.Parallel`, which waits for all running
+    tasks before retrying the tasks not ready yet, a task becomes ready as
+    soon as the tasks it runs after are done. A ready task is handed to a
+    consumer only when the consumer is free, so the task with the longest
+    critical path always starts first. Runtimes of experiment tasks are
+    predicted by and recorded to :py:class:`TaskRuntimeHistory`; other tasks
+    are predicted to finish instantly.
+
+    Tasks are also packed by their CPUs and memory (see
+    :py:attr:`ExperimentTask.cpus` and :py:attr:`ExperimentTask.memory`),
+    where the number of jobs is the number of CPUs. If the task with the
+    longest critical path does not fit into free resources, resources are
+    reserved for it at the earliest time predicted, and other tasks are run
+    only if they finish before that time or fit beside the reservation
+    (i.e. EASY backfilling). A task demanding more than available resources
+    is run alone.
+
+    """
+
+    backfill_window = 32
+    """Number of tasks at the front of each heap of ready tasks searched for
+    backfilling."""
+    def __init__(self, bld, j, runtime_history, memory=float('inf')):
+        super(CriticalPathScheduler, self).__init__(bld, j)
+        self.runtime_history = runtime_history
+        self.memory = memory
+        """Memory in bytes available to tasks."""
+
+        # Heaps of ready tasks ordered by their critical paths, grouped by
+        # their demands of resources.
+        self._ready = {}
+        # Tasks taken by backfilling, which are removed from heaps lazily.
+        self._taken = set()
+        self._sequence = itertools.count()
+        self._priorities = {}
+        self._runtimes = {}
+        self._successors = {}
+        # Tasks waiting for others to the number of the others.
+        self._num_waiting = {}
+        self._completed = False
+        # Running tasks to their predicted end time and demands.
+        self._running = {}
+        self._used_cpus = 0
+        self._used_memory = 0
+
+    def refill_task_list(self):
+        # Tasks submitted to the batch queue do not hold consumers.
+        batch_submitter = getattr(self.bld, 'batch_submitter', None)
+        while self.count - len(batch_submitter or ()) >= self.numjobs:
+            self.get_out()
+        while not self.outstanding:
+            tsk = self._pop_ready() if self._ready else None
+            if tsk is not None:
+                self.outstanding.append(tsk)
+            elif self._ready:
+                # Wait for resources.
+                self.get_out()
+            elif self.frozen and self._completed:
+                self._completed = False
+                self.outstanding += self.frozen
+                self.frozen = []
+            elif self.count:
+                self.get_out()
+            elif self._num_waiting:
+                # Tasks after failed ones are not released; runnable_status
+                # of waf decides what to do with them.
+                self.outstanding += self._num_waiting.keys()
+                self._num_waiting.clear()
+            elif self.frozen:
+                raise waflib.Errors.WafError(
+                    'Deadlock detected: %s' % ''.join(
+                        '%r\t-> %r' % (tsk, [id(x) for x in tsk.run_after])
+                        for tsk in self.frozen))
+            else:
+                tasks = self.biter.next()
+                self.total = self.bld.total()
+                if not tasks:
+                    break
+                self._add_tasks(tasks)
+
+    def add_task(self, tsk):
+        demand = self._get_demand(tsk)
+        self._running[tsk] = (time.time() + self._runtimes.get(tsk, 0.0),
+                              demand)
+        self._used_cpus += demand[0]
+        self._used_memory += demand[1]
+        if self._is_batch_task(tsk):
+            # Submitted at once, which does not wait for the job.
+            tsk.process()
+        else:
+            super(CriticalPathScheduler, self).add_task(tsk)
+
+    def get_out(self):
+        tsk = super(CriticalPathScheduler, self).get_out()
+        self._completed = True
+        if tsk in self._running:
+            _, (cpus, memory) = self._running.pop(tsk)
+            self._used_cpus -= cpus
+            self._used_memory -= memory
+        self._release(tsk)
+        runtime = getattr(tsk, 'runtime', None)
+        if runtime is not None:
+            self.runtime_history.record(tsk.runtime_key(), runtime)
+        return tsk
+
+    def add_more_tasks(self, tsk):
+        super(CriticalPathScheduler, self).add_more_tasks(tsk)
+        # Called also for skipped tasks.
+        self._release(tsk)
+
+    def _add_tasks(self, tasks):
+        task_set = set(tasks)
+        for tsk in tasks:
+            predecessors = [t for t in getattr(tsk, 'run_after', ())
+                            if t in task_set and not t.hasrun]
+            self._num_waiting[tsk] = len(predecessors)
+            for t in predecessors:
+                self._successors.setdefault(t, []).append(tsk)
+
+        # Topological sort to compute critical paths from the end.
+        num_waiting = dict(self._num_waiting)
+        order = [tsk for tsk in tasks if not num_waiting[tsk]]
+        for tsk in order:
+            for succ in self._successors.get(tsk, ()):
+                num_waiting[succ] -= 1
+                if not num_waiting[succ]:
+                    order.append(succ)
+        for tsk in reversed(order):
+            self._runtimes[tsk] = self._predict(tsk)
+            self._priorities[tsk] = self._runtimes[tsk] + max(
+                [self._priorities[s] for s in self._successors.get(tsk, ())]
+                or [0.0])
+
+        for tsk in tasks:
+            if not self._num_waiting[tsk]:
+                del self._num_waiting[tsk]
+                self._push(tsk)
+
+    def _predict(self, tsk):
+        if isinstance(tsk, ExperimentTask):
+            return self.runtime_history.predict(tsk.runtime_key())
+        return 0.0
+
+    def _push(self, tsk):
+        heap = self._ready.setdefault(self._get_demand(tsk), [])
+        heapq.heappush(heap, (-self._priorities.pop(tsk, 0.0),
+                              next(self._sequence), tsk))
+
+    def _pop_ready(self):
+        """Pops the ready task to run next, or returns None if every ready
+        task has to wait for resources.
+
+        """
+        for demand in self._ready.keys():
+            self._purge(demand)
+        if not self._ready:
+            return None
+
+        top = min(self._ready, key=lambda demand: self._ready[demand][0])
+        if self._fits(top):
+            return self._pop_ready_of(top)
+
+        # Earliest time that the top task fits and resources left then.
+        end_time = float('inf')
+        free_cpus = self.numjobs - self._used_cpus
+        free_memory = self.memory - self._used_memory
+        for end_time, (cpus, memory) in sorted(self._running.itervalues()):
+            free_cpus += cpus
+            free_memory += memory
+            if top[0] <= free_cpus and top[1] <= free_memory:
+                break
+        spare = (free_cpus - top[0], free_memory - top[1])
+
+        # Find a task to backfill from the front of each heap.
+        now = time.time()
+        best = None
+        for demand, heap in self._ready.iteritems():
+            if not self._fits(demand):
+                continue
+            fits_spare = demand[0] <= spare[0] and demand[1] <= spare[1]
+            for entry in heap[:self.backfill_window]:
+                if ((best is None or entry < best) and
+                        entry[2] not in self._taken and
+                        (fits_spare or
+                         now + self._runtimes.get(entry[2], 0.0) <= end_time)):
+                    best = entry
+        if best is None:
+            return None
+        self._taken.add(best[2])
+        return best[2]
+
+    def _pop_ready_of(self, demand):
+        tsk = heapq.heappop(self._ready[demand])[2]
+        self._purge(demand)
+        return tsk
+
+    def _purge(self, demand):
+        """Removes tasks already taken from the top of the heap."""
+        heap = self._ready[demand]
+        while heap and heap[0][2] in self._taken:
+            self._taken.remove(heapq.heappop(heap)[2])
+        if not heap:
+            del self._ready[demand]
+
+    def _fits(self, demand):
+        return (self._used_cpus + demand[0] <= self.numjobs and
+                self._used_memory + demand[1] <= self.memory)
+
+    def _is_batch_task(self, tsk):
+        return (getattr(self.bld, 'batch_submitter', None) is not None and
+                isinstance(tsk, ExperimentTask))
+
+    def _get_demand(self, tsk):
+        # Tasks submitted to the batch queue use resources of the queue.
+        if self._is_batch_task(tsk):
+            return (0, 0)
+        # Demands are bounded so that any task can run alone.
+        return (min(max(getattr(tsk, 'cpus', 1), 1), self.numjobs),
+                min(getattr(tsk, 'memory', 0), self.memory))
+
+    def _release(self, tsk):
+        for succ in self._successors.pop(tsk, ()):
+            n = self._num_waiting.get(succ)
+            if n == 1:
+                del self._num_waiting[succ]
+                self._push(succ)
+            elif n is not None:
+                self._num_waiting[succ] = n - 1
+
+
+class Coordinator(object):
+    """Coordinator handing jobs of experiment tasks to workers over TCP.
+
+    Workers (:py:class:`Worker`) connect to the coordinator and tell how many
+    jobs they run at once. A job is a pair of a picklable function and its
+    arguments, which is run by :py:meth:`apply` on a worker with enough free
+    slots. Workers send heartbeats; the jobs of a worker that disconnects or
+    stops sending heartbeats are queued again and run by other workers.
+
+    The coordinator is thread-safe; each waf thread waits for its own job.
+
+    """
+
+    heartbeat_timeout = 30.0
+    """Seconds without heartbeats after which a worker is regarded as dead."""
+
+    max_retries = 3
+    """Number of times a job lost by dead workers is queued again."""
+
+    def __init__(self, address=('', 0), authkey=None):
+        """Starts listening to workers.
+
+        :param address: Pair of the host and the port to listen; port 0
+            selects a free port.
+        :param authkey: Key shared with workers, which is generated if not
+            given.
+
+        """
+        self.authkey = authkey or os.urandom(20)
+        self._listener = multiprocessing.connection.Listener(
+            address, authkey=self.authkey)
+        self.address = self._listener.address
+        """Address the coordinator listens to."""
+
+        self._condition = threading.Condition()
+        self._jobs = collections.deque()
+        self._workers = []
+        self._job_ids = itertools.count()
+        self._closed = False
+
+        for target in [self._accept, self._watch]:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def apply(self, func, args=(), cpus=1):
+        """Runs a function on a worker and waits for the result.
+
+        :param func: Function defined at the top level of a module.
+        :param args: Arguments of the function.
+        :param cpus: Number of slots of a worker the job occupies.
+        :return: Return value of the function.
+
+        """
+        job = _Job(next(self._job_ids), func, args, cpus)
+        with self._condition:
+            self._jobs.append(job)
+            self._dispatch()
+        job.done.wait()
+        if job.error is not None:
+            raise RuleProcessException(job.error)
+        return job.result
+
+    def close(self):
+        """Stops workers and the coordinator."""
+        with self._condition:
+            self._closed = True
+            for worker in self._workers:
+                worker.send(('stop',))
+            del self._workers[:]
+        self._listener.close()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+                _, slots, host = conn.recv()
+            except (EOFError, IOError, multiprocessing.AuthenticationError):
+                continue
+            except Exception:
+                # The listener is closed.
+                return
+            worker = _WorkerConnection(conn, slots, host)
+            with self._condition:
+                self._workers.append(worker)
+                self._dispatch()
+            waflib.Logs.info('worker %s joined with %d slots' % (host, slots))
+            thread = threading.Thread(target=self._receive, args=(worker,))
+            thread.daemon = True
+            thread.start()
+
+    def _receive(self, worker):
+        while True:
+            try:
+                message = worker.conn.recv()
+            except (EOFError, IOError):
+                break
+            with self._condition:
+                if worker not in self._workers:
+                    break
+                worker.last_seen = time.time()
+                if message[0] == 'done':
+                    _, job_id, succeeded, value = message
+                    job = worker.jobs.pop(job_id)
+                    worker.used -= min(job.cpus, worker.slots)
+                    if succeeded:
+                        job.result = value
+                    else:
+                        job.error = value
+                    job.done.set()
+                    self._dispatch()
+        self._remove(worker, 'disconnected')
+
+    def _watch(self):
+        while not self._closed:
+            time.sleep(self.heartbeat_timeout / 4)
+            now = time.time()
+            for worker in list(self._workers):
+                if now - worker.last_seen > self.heartbeat_timeout:
+                    self._remove(worker, 'stopped sending heartbeats')
+
+    def _remove(self, worker, reason):
+        with self._condition:
+            if worker not in self._workers:
+                return
+            self._workers.remove(worker)
+            worker.conn.close()
+            for job in sorted(worker.jobs.values(), key=lambda job: job.id,
+                              reverse=True):
+                job.retries += 1
+                if job.retries > self.max_retries:
+                    job.error = 'job was lost by %d workers' % job.retries
+                    job.done.set()
+                else:
+                    self._jobs.appendleft(job)
+            self._dispatch()
+        waflib.Logs.warn('worker %s %s; %d jobs are queued again' %
+                         (worker.host, reason, len(worker.jobs)))
+
+    def _dispatch(self):
+        # Runs jobs in the queued order, skipping those that fit no worker.
+        # It must be called with the condition acquired.
+        for job in list(self._jobs):
+            candidates = [worker for worker in self._workers
+                          if worker.free() >= min(job.cpus, worker.slots)]
+            if not candidates:
+                continue
+            worker = max(candidates, key=lambda worker: worker.free())
+            if not worker.send(('run', job.id, job.func, job.args)):
+                continue
+            self._jobs.remove(job)
+            worker.jobs[job.id] = job
+            worker.used += min(job.cpus, worker.slots)
+
+
+class _Job(object):
+    """Job waiting for its result in :py:class:`Coordinator`."""
+
+    def __init__(self, id, func, args, cpus):
+        self.id = id
+        self.func = func
+        self.args = args
+        self.cpus = max(1, cpus)
+        self.retries = 0
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _WorkerConnection(object):
+    """State of a worker connected to :py:class:`Coordinator`."""
+
+    def __init__(self, conn, slots, host):
+        self.conn = conn
+        self.slots = slots
+        self.host = host
+        self.used = 0
+        self.jobs = {}
+        self.last_seen = time.time()
+
+    def free(self):
+        return self.slots - self.used
+
+    def send(self, message):
+        try:
+            self.conn.send(message)
+            return True
+        except (IOError, EOFError, OSError):
+            # The receiving thread removes the worker.
+            return False
+
+
+class Worker(object):
+    """Worker running jobs handed by :py:class:`Coordinator`.
+
+    Jobs run in a pool of processes, so a worker runs as many jobs as its
+    slots at once. The pool is forked when the worker is created, so functions
+    of jobs must be importable by the worker or be defined before that.
+
+    """
+
+    heartbeat_interval = 5.0
+    """Seconds between heartbeats sent to the coordinator."""
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._pool = multiprocessing.Pool(slots, _exit_with_parent)
+        self._send_lock = threading.Lock()
+
+    def close(self):
+        """Terminates the pool of processes."""
+        self._pool.terminate()
+        self._pool.join()
+
+    def serve(self, conn):
+        """Runs jobs until the coordinator stops the worker or goes away.
+
+        :param conn: Connection to the coordinator, which is closed at the end.
+        :type conn: ``multiprocessing.connection.Connection``
+
+        """
+        try:
+            self._send(conn, ('hello', self.slots, socket.gethostname()))
+            stopped = threading.Event()
+            thread = threading.Thread(
+                target=self._send_heartbeats, args=(conn, stopped))
+            thread.daemon = True
+            thread.start()
+            try:
+                while True:
+                    try:
+                        message = conn.recv()
+                    except (EOFError, IOError):
+                        break
+                    if message[0] == 'stop':
+                        break
+                    _, job_id, func, args = message
+                    self._pool.apply_async(
+                        _call_job, (func, args),
+                        callback=lambda result, job_id=job_id: self._send(
+                            conn, ('done', job_id) + result))
+            finally:
+                stopped.set()
+        finally:
+            conn.close()
+
+    def _send(self, conn, message):
+        with self._send_lock:
+            try:
+                conn.send(message)
+            except (IOError, EOFError, OSError):
+                pass
+
+    def _send_heartbeats(self, conn, stopped):
+        while not stopped.wait(self.heartbeat_interval):
+            self._send(conn, ('heartbeat',))
+
+
+def _exit_with_parent():
+    """Makes a process of the pool of :py:class:`Worker` or of a job of
+    :py:class:`SpoolRunner` exit when its parent is killed, which leaves the
+    process waiting for jobs forever or running a job taken back.
+
+    """
+    parent = os.getppid()
+
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(1)
+
+    thread = threading.Thread(target=watch)
+    thread.daemon = True
+    thread.start()
+
+
+def _call_job(func, args):
+    """Runs a job in a worker process of :py:class:`Worker`.
+
+    :return: Pair of whether the job succeeded and its return value or the
+        traceback of the exception.
+
+    """
+    try:
+        result = func(*args)
+        # An unpicklable result would be lost on the way to the coordinator.
+        pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        return True, result
+    except (Exception, SystemExit):
+        return False, traceback.format_exc()
+
+
+class BatchQueue(object):
+    """Interface of an external queue that experiment tasks are submitted to
+    as jobs, e.g. a scheduler of a cluster.
+
+    A job is a pair of a picklable function and its arguments. A queue runs
+    the job somewhere sharing the project directory and reports its result,
+    i.e. the pair of whether the job succeeded and its return value or the
+    traceback of the exception (see :py:func:`_call_job`). Jobs are submitted
+    and polled in batches by :py:class:`BatchSubmitter`, so a queue can save
+    calls to the scheduler.
+
+    """
+
+    poll_interval = 10.0
+    """Seconds between polls of running jobs."""
+
+    max_batch_size = 100
+    """Maximum number of jobs submitted at once."""
+
+    def submit(self, jobs):
+        """Submits jobs.
+
+        :param jobs: List of jobs.
+        :return: List of the ids of the jobs.
+
+        """
+        raise NotImplementedError
+
+    def poll(self, job_ids):
+        """Gets the results of jobs finished.
+
+        :param job_ids: Ids of jobs running.
+        :return: Dictionary from the ids of jobs finished to their results.
+
+        """
+        raise NotImplementedError
+
+    def cancel(self, job_ids):
+        """Cancels jobs not finished yet."""
+        pass
+
+
+class FileSpoolQueue(BatchQueue):
+    """Queue of jobs spooled to files, which are run by ``waf
+    experiment_spool_runner`` (see :py:class:`SpoolRunner`).
+
+    A job is a file in ``queue`` directory of the spool. A runner claims the
+    job by moving it to ``running`` directory under a name suffixed by the
+    runner, and writes its result to ``done`` directory. Runners on several
+    hosts sharing the spool can run jobs together.
+
+    A runner holds a lease on its jobs by touching their files. A job whose
+    lease has expired, i.e. whose runner has died, is queued again, and fails
+    after it has been lost by more than :py:attr:`max_retries` runners.
+
+    """
+
+    poll_interval = 1.0
+
+    lease_timeout = 60.0
+    """Seconds without touches after which a running job is regarded as lost
+    by its runner."""
+
+    max_retries = 3
+    """Number of times a job lost by runners is queued again."""
+
+    def __init__(self, path):
+        self.path = path
+        for name in ['queue', 'running', 'done']:
+            if not os.path.exists(os.path.join(path, name)):
+                os.makedirs(os.path.join(path, name))
+        # Ids are ordered by the submission.
+        self._prefix = '%010d-%d-' % (time.time(), os.getpid())
+        self._sequence = itertools.count()
+        self._retries = collections.defaultdict(int)
+
+    def submit(self, jobs):
+        job_ids = []
+        for job in jobs:
+            job_id = '%s%08d' % (self._prefix, next(self._sequence))
+            self._write(os.path.join('queue', job_id), job)
+            job_ids.append(job_id)
+        return job_ids
+
+    def poll(self, job_ids):
+        done = set(os.listdir(os.path.join(self.path, 'done')))
+        running = {}
+        for name in os.listdir(os.path.join(self.path, 'running')):
+            job_id, _, owner = name.partition('@')
+            if owner:
+                running[job_id] = name
+        now = time.time()
+        results = {}
+        for job_id in job_ids:
+            if job_id in done:
+                path = os.path.join(self.path, 'done', job_id)
+                with open(path, 'rb') as f:
+                    results[job_id] = pickle.load(f)
+                os.remove(path)
+                self._retries.pop(job_id, None)
+            elif job_id in running:
+                result = self._expire(job_id, running[job_id], now)
+                if result is not None:
+                    results[job_id] = result
+        return results
+
+    def cancel(self, job_ids):
+        for job_id in job_ids:
+            try:
+                os.remove(os.path.join(self.path, 'queue', job_id))
+            except OSError:
+                pass
+
+    def _expire(self, job_id, name, now):
+        # Takes the job back from a runner whose lease has expired.
+        path = os.path.join(self.path, 'running', name)
+        retries = self._retries[job_id] + 1
+        try:
+            if now - os.stat(path).st_mtime <= self.lease_timeout:
+                return None
+            if retries > self.max_retries:
+                os.remove(path)
+            else:
+                os.rename(path, os.path.join(self.path, 'queue', job_id))
+        except OSError:
+            # The runner has just finished the job.
+            return None
+        if retries > self.max_retries:
+            del self._retries[job_id]
+            return False, 'job was lost by %d runners' % retries
+        self._retries[job_id] = retries
+        waflib.Logs.warn('runner %s lost job %s; it is queued again' %
+                         (name.partition('@')[2], job_id))
+        return None
+
+    def _write(self, name, obj):
+        # Files appear atomically, so runners never read partial ones.
+        path = os.path.join(self.path, name)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+
+
+class SpoolRunner(object):
+    """Runner of jobs spooled by :py:class:`FileSpoolQueue`.
+
+    Jobs are claimed in the submitted order and each runs in a process forked
+    by the runner, so a runner runs as many jobs as its slots at once. The
+    runner touches the files of its jobs every :py:attr:`heartbeat_interval`
+    seconds, and a job whose process exits without a result, e.g. killed for
+    lack of memory, fails.
+
+    """
+
+    poll_interval = 0.5
+    """Seconds between scans of the spool."""
+
+    heartbeat_interval = 10.0
+    """Seconds between touches of the files of running jobs."""
+
+    def __init__(self, queue, slots):
+        self.queue = queue
+        self.slots = slots
+        self.owner = '%s-%d' % (socket.gethostname(), os.getpid())
+        """Suffix of the names of the files of jobs claimed by the runner."""
+
+        self._processes = {}
+
+    def close(self):
+        """Terminates the processes of running jobs."""
+        for process in self._processes.itervalues():
+            process.terminate()
+            process.join()
+        self._processes.clear()
+
+    def serve(self, idle_timeout):
+        """Runs jobs until no job is found for a while.
+
+        :param idle_timeout: Seconds without jobs after which the runner
+            exits.
+
+        """
+        last_active = last_heartbeat = time.time()
+        while self._processes or time.time() - last_active < idle_timeout:
+            for job_id, process in self._processes.items():
+                if not process.is_alive():
+                    process.join()
+                    del self._processes[job_id]
+                    self._finish(job_id, process.exitcode)
+            claimed = False
+            if len(self._processes) < self.slots:
+                job = self._claim()
+                if job is not None:
+                    job_id, func, args = job
+                    process = multiprocessing.Process(
+                        target=_run_spooled_job,
+                        args=(self.queue, job_id, func, args))
+                    process.daemon = True
+                    process.start()
+                    self._processes[job_id] = process
+                    claimed = True
+            now = time.time()
+            if now - last_heartbeat >= self.heartbeat_interval:
+                for job_id in self._processes:
+                    self._touch(job_id)
+                last_heartbeat = now
+            if self._processes:
+                last_active = now
+            if not claimed:
+                time.sleep(self.poll_interval)
+
+    def _claim(self):
+        queue_path = os.path.join(self.queue.path, 'queue')
+        for job_id in sorted(os.listdir(queue_path)):
+            if job_id.endswith('.tmp'):
+                continue
+            path = self._running_path(job_id)
+            try:
+                # Only one runner succeeds in moving the job. The file keeps
+                # the time it was queued, so it is touched at once.
+                os.rename(os.path.join(queue_path, job_id), path)
+                os.utime(path, None)
+                with open(path, 'rb') as f:
+                    func, args = pickle.load(f)
+                return job_id, func, args
+            except (OSError, IOError):
+                # Another runner has claimed the job, or the submitter has
+                # taken it back.
+                pass
+        return None
+
+    def _finish(self, job_id, exitcode):
+        # The process exits with 0 only after it has written the result.
+        if exitcode != 0:
+            self.queue._write(os.path.join('done', job_id), (
+                False, 'job process exited with code %s' % exitcode))
+        try:
+            os.remove(self._running_path(job_id))
+        except OSError:
+            # The submitter has taken the job back.
+            pass
+
+    def _touch(self, job_id):
+        try:
+            os.utime(self._running_path(job_id), None)
+        except OSError:
+            pass
+
+    def _running_path(self, job_id):
+        return os.path.join(
+            self.queue.path, 'running', '%s@%s' % (job_id, self.owner))
+
+
+def _run_spooled_job(queue, job_id, func, args):
+    """Runs a job in a process forked by :py:class:`SpoolRunner`."""
+    _exit_with_parent()
+    queue._write(os.path.join('done', job_id), _call_job(func, args))
+
+
+class BatchSubmitter(object):
+    """Submitter of jobs to a :py:class:`BatchQueue`.
+
+    Jobs are submitted and polled in batches by one thread, which calls back
+    when each job is finished, so no thread waits for each running job. The
+    number of jobs submitted but not finished is capped.
+
+    """
+
+    def __init__(self, queue, max_outstanding):
+        """Starts the thread submitting jobs.
+
+        :param queue: Queue to which jobs are submitted.
+        :type queue: :py:class:`BatchQueue`
+        :param max_outstanding: Maximum number of jobs submitted to the queue
+            and not finished.
+
+        """
+        self.queue = queue
+        self.max_outstanding = max_outstanding
+        self._condition = threading.Condition()
+        self._pending = collections.deque()
+        self._outstanding = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, func, args, callback):
+        """Submits a job.
+
+        :param func: Function of the job defined at the top level of a module.
+        :param args: Arguments of the function.
+        :param callback: Function called with whether the job succeeded and
+            its return value or the traceback of the exception.
+
+        """
+        with self._condition:
+            self._pending.append(((func, args), callback))
+            self._condition.notify()
+
+    def __len__(self):
+        """Gets the number of jobs not finished."""
+        return len(self._pending) + len(self._outstanding)
+
+    def close(self):
+        """Cancels jobs not finished and stops the thread."""
+        with self._condition:
+            self._closed = True
+            self._pending.clear()
+            self._condition.notify()
+        self._thread.join()
+        if self._outstanding:
+            self.queue.cancel(list(self._outstanding))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not (self._closed or self._outstanding or
+                           self._pending):
+                    self._condition.wait()
+                if self._closed:
+                    return
+                batch = []
+                while (self._pending and len(batch) < self.queue.max_batch_size
+                       and len(self._outstanding) + len(batch) <
+                       self.max_outstanding):
+                    batch.append(self._pending.popleft())
+
+            if batch:
+                self._submit(batch)
+            elif self._outstanding:
+                self._poll()
+                with self._condition:
+                    if not self._closed and not (
+                            self._pending and len(self._outstanding) <
+                            self.max_outstanding):
+                        self._condition.wait(self.queue.poll_interval)
+
+    def _submit(self, batch):
+        try:
+            job_ids = self.queue.submit([job for job, _ in batch])
+        except Exception:
+            error = traceback.format_exc()
+            for _, callback in batch:
+                callback(False, error)
+            return
+        for job_id, (_, callback) in zip(job_ids, batch):
+            self._outstanding[job_id] = callback
+
+    def _poll(self):
+        try:
+            results = self.queue.poll(list(self._outstanding))
+        except Exception:
+            waflib.Logs.warn('failed to poll jobs:\n' + traceback.format_exc())
+            return
+        for job_id, (succeeded, value) in results.iteritems():
+            self._outstanding.pop(job_id)(succeeded, value)
+
+
+class ExperimentTask(waflib.Task.Task):
+    """A task class specific for ExperimentContext.
+
+    The purpose of this class is to bring the parameter as an attribute.
+    The base class (:py:class:`waflib.Task.Task`) doesn't bring attributes
+    except ``env``, but the env must be a string-valued dictionary, which is
+    problematic when we want to use the parameter in an object as it is. For
+    example, a float value once converted to string lose some information.
+
+    Another motivation for this task is to control the hash value of a task:
+    It is calculated based on the env, in which key is registered in ``vars``
+    or ``dep_vars``. In ``__init__``, this task registers necessary keys to
+    dep_vars.
+
+    """
+
+    shell = True
+    """support pipe style rule str in default"""
+
+    def __init__(self, env, generator):
+        """Initializes the task.
+
+        :param env: Environmental variables.
+        :param generator: Generator function.
+
+        """
+
+        super(ExperimentTask, self).__init__(env=env, generator=generator)
+
+        # Parameters are frozen inside ExperimentContext; rules receive
+        # ordinary dicts.
+        self.parameter = Parameter(generator.parameter)
+        """Parameter whose values are not stringized."""
+
+        self.env.source_parameter = [
+            Parameter(p) for p in env.source_parameter]
+
+        if not hasattr(self, 'dep_vars'): self.dep_vars = []
         self.dep_vars += self.parameter.keys()
         self.dep_vars += filter(lambda k: k.startswith("dependson"), env.keys())
 
         self.inputs = [ExperimentNode(s) for s in self.inputs]
         self.outputs = [ExperimentNode(s) for s in self.outputs]
 
+        self.cpus = int(_get_resource(generator, 'cpus', 1, self.parameter))
+        """Number of CPUs used by the task, which is given by ``cpus``
+        argument of the call object."""
+
+        self.memory = parse_memory(
+            _get_resource(generator, 'memory', 0, self.parameter))
+        """Bytes of memory used by the task, which is given by ``memory``
+        argument of the call object."""
+
+        # The run method of the class is kept as it is, since its source code
+        # is a part of the signature of the task.
+        if getattr(generator.bld, 'coordinator', None) is not None:
+            self.run = self._run_on_worker
+        elif (getattr(generator.bld, 'process_pool', None) is not None and
+                _runs_in_process_pool(generator)):
+            self.run = self._run_in_process_pool
+
+    def _get_job(self):
+        """Gets the job running the rule of the task in another process.
+
+        :return: Tuple of the function of the job, its arguments and the
+            function converting the result of the job to the return value of
+            ``run``.
+
+        """
+        if _get_function_rule(self.generator) is not None:
+            return (_run_rule, (self.generator.rule_index, RuleTask(self)),
+                    _get_rule_return)
+
+        # The command of a string rule is taken by running the rule without
+        # executing the command.
+        commands = []
+        def exec_command(cmd, **kw):
+            bld = self.generator.bld
+            cwd = kw.get('cwd') or getattr(bld, 'cwd', bld.variant_dir)
+            commands.append((cmd, cwd, kw.get('env')))
+            return 0
+        self.exec_command = exec_command
+        try:
+            type(self).run(self)
+        finally:
+            del self.exec_command
+        return _run_command, commands[0], _get_command_return
+
+    def _run_in_process_pool(self):
+        func, args, get_return = self._get_job()
+        return get_return(self.generator.bld.process_pool.apply(func, args))
+
+    def _run_on_worker(self):
+        func, args, get_return = self._get_job()
+        return get_return(
+            self.generator.bld.coordinator.apply(func, args, self.cpus))
+
+    def _submit(self, batch_submitter):
+        # Same as waflib.Task.Task.process before running the task, which is
+        # submitted as a job instead; _complete does the rest.
+        m = self.master
+        if m.stop:
+            m.out.put(self)
+            return
+        bld = self.generator.bld
+        try:
+            del bld.task_sigs[self.uid()]
+        except KeyError:
+            pass
+        try:
+            bld.returned_tasks.append(self)
+            self.log_display(bld)
+            func, args, get_return = self._get_job()
+        except Exception:
+            self._complete(None, False, waflib.Utils.ex_stack())
+            return
+        batch_submitter.submit(
+            func, args, functools.partial(self._complete, get_return))
+
+    def _complete(self, get_return, succeeded, value):
+        # Same as waflib.Task.Task.process after running the task.
+        m = self.master
+        try:
+            if not succeeded:
+                raise RuleProcessException(value)
+            ret = get_return(value)
+        except Exception:
+            self.err_msg = waflib.Utils.ex_stack()
+            self.hasrun = waflib.Task.EXCEPTION
+            m.error_handler(self)
+            m.out.put(self)
+            return
+        if ret:
+            self.err_code = ret
+            self.hasrun = waflib.Task.CRASHED
+        else:
+            try:
+                self.post_run()
+            except waflib.Errors.WafError:
+                pass
+            except Exception:
+                self.err_msg = waflib.Utils.ex_stack()
+                self.hasrun = waflib.Task.EXCEPTION
+            else:
+                self.hasrun = waflib.Task.SUCCESS
+        if self.hasrun != waflib.Task.SUCCESS:
+            m.error_handler(self)
+        m.out.put(self)
+
+    def runtime_key(self):
+        """Gets the key of the runtime of the task in
+        :py:class:`TaskRuntimeHistory`.
+
+        :return: Pair of the name of the call object and the id of the target
+            parameter (empty if the parameter is empty).
+        :rtype: ``tuple``
+
+        """
+        try:
+            return self.runtime_key_
+        except AttributeError:
+            parameter = self.generator.parameter
+            parameter_id = ''
+            if parameter:
+                parameter_id = self.generator.bld._parameter_id_generator.get_id(
+                    parameter)
+            self.runtime_key_ = (self.__class__.__name__, parameter_id)
+            return self.runtime_key_
+
+    def process(self):
+        self.start_time = time.time()
+        batch_submitter = getattr(self.generator.bld, 'batch_submitter', None)
+        if batch_submitter is None:
+            super(ExperimentTask, self).process()
+        else:
+            self._submit(batch_submitter)
+
+    def post_run(self):
+        # Wall time of the task, which is recorded by CriticalPathScheduler.
+        self.runtime = time.time() - self.start_time
+        ret = super(ExperimentTask, self).post_run()
+        self._record_results()
+        return ret
+
+    def _record_results(self):
+        records = getattr(self.generator, 'result_records', ())
+        for (store, parameter_id), node in zip(records, self.outputs):
+            try:
+                store.record(parameter_id, node.abspath())
+            except (IOError, OSError, sqlite3.Error) as e:
+                # Aggregation tasks read the file instead.
+                waflib.Logs.warn('cannot record %s into the result store: %s' %
+                                 (node.abspath(), e))
+
+    def uid(self):
+        """Computes the identifier of the task.
+
+        Waf identifies a task by its class name and nodes. Experiment tasks
+        of a call object share a class, so the name of the task generator is
+        used instead; it was the name of the class before classes were
+        shared.
+
+        """
+        try:
+            return self.uid_
+        except AttributeError:
+            m = waflib.Utils.md5()
+            m.update(self.generator.name)
+            for node in self.inputs + self.outputs:
+                m.update(node.abspath())
+            self.uid_ = m.digest()
+            return self.uid_
+
+    def sig_explicit_deps(self):
+        """Computes the signature of input nodes.
+
+        Signatures of source files are taken from the input signature cache
+        of the context, so unchanged files are not read again.
+
+        """
+        bld = self.generator.bld
+        cache = getattr(bld, 'input_signature_cache', None)
+        if cache is not None:
+            for node in self.inputs + self.dep_nodes:
+                # Same condition as waflib.Node.get_bld_sig hashes the file.
+                if (not hasattr(node, 'cache_sig') and
+                        (not node.is_bld() or bld.bldnode is bld.srcnode)):
+                    node.sig = node.cache_sig = cache.get_signature(
+                        node.abspath())
+        return super(ExperimentTask, self).sig_explicit_deps()
+
 
 class ExperimentNode(object):
     """A wrapper of Node object used in ExperimentTasks for replacement of
@@ -621,6 +3551,57 @@ class ExperimentNode(object):
     def abspath(self):
         return self.abspath_
 
+    def signature(self):
+        """Gets the signature that waf gives to the node, which changes when
+        the content of the node may change.
+
+        :return: Hex digest of the signature, or None if the node is a dummy
+            one or has no signature yet.
+        :rtype: ``str``
+
+        """
+        try:
+            return self.signature_
+        except AttributeError:
+            sig = getattr(getattr(self, 'node', None), 'sig', None)
+            return sig.encode('hex') if sig else None
+
+    def __getstate__(self):
+        # Only the path and the signature are passed to processes running
+        # rules.
+        return {'abspath_': self.abspath_, 'signature_': self.signature()}
+
+
+class RuleTask(object):
+    """A picklable copy of an experiment task, which is passed to a function
+    rule run in a process pool.
+
+    It has ``inputs``, ``outputs``, ``env``, ``parameter``, ``cpus`` and
+    ``memory`` of the task. Nodes are :py:class:`ExperimentNode` objects that
+    only know their paths, and ``env`` is flattened into one ConfigSet.
+
+    """
+    def __init__(self, task):
+        self.inputs = [ExperimentNode(node) for node in task.inputs]
+        self.outputs = [ExperimentNode(node) for node in task.outputs]
+        self.env = waflib.ConfigSet.ConfigSet()
+        self.env.table = task.env.get_merged_dict()
+        self.parameter = task.parameter
+        self.cpus = task.cpus
+        self.memory = task.memory
+
+    # ConfigSet cannot be unpickled since it answers to any attribute, so env
+    # is pickled as a dictionary.
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['env'] = self.env.table
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.env = waflib.ConfigSet.ConfigSet()
+        self.env.table = state['env']
+
 
 @feature('experiment')
 @before_method('process_rule')
@@ -662,22 +3643,124 @@ def register_experiment_task_with_rule(self):
     This snippet search for a task from cache_rule_attr dictionary first,
     so we set that dictionary beforehand.
 
+    The task class is shared by all task generators of one call object; it is
+    given by :py:class:`ExperimentContext` as ``experiment_task_class``
+    attribute, and registered to waf with the name of each task generator.
+
     """
     self.name = str(getattr(self, 'name', None) or self.target or getattr(self.rule, '__name__', self.rule))
+
+    cls = getattr(self, 'experiment_task_class', None)
+    if cls is None:
+        cls = _create_experiment_task_class(self.name, self.rule)
+    waflib.Task.classes[self.name] = cls
+
+    try:
+        cache = self.bld.cache_rule_attr
+    except AttributeError:
+        cache = self.bld.cache_rule_attr = {}
+    cache[(self.name, self.rule)] = cls
+
+
+def _create_experiment_task_class(name, rule):
+    """Defines ExperimentTask with a user-defined rule (string or function)."""
     params = {}
-    if isinstance(self.rule, str):
-        params['run_str'] = self.rule
+    if isinstance(rule, str):
+        params['run_str'] = rule
     else:
-        params['run'] = self.rule
+        params['run'] = rule
+    return type(waflib.Task.Task)(name, (ExperimentTask,), params)
 
-    # define ExperimentTask with a user-defined rule (string or function)
-    cls = type(waflib.Task.Task)(self.name, (ExperimentTask,), params)
-    waflib.Task.classes[self.name] = cls
 
-    self.bld.cache_rule_attr = {(self.name, self.rule):cls}
+def _get_call_object_name(call_object):
+    """Gets the name of a call object in the same way as waf names a task
+    generator.
 
+    """
+    rule = getattr(call_object, 'rule', None)
+    return str(getattr(call_object, 'name', None) or
+               ' '.join(call_object.target) or
+               getattr(rule, '__name__', rule))
+
+
+def _get_function_rule(generator):
+    """Gets the function rule given to the call object of a task generator.
+
+    :return: Function or :py:class:`Rule`, or None if the rule is a string.
+
+    """
+    rule = _rules[generator.rule_index] if hasattr(
+        generator, 'rule_index') else None
+    if isinstance(rule, str):
+        return None
+    return rule
 
-def _create_file(path):
+
+def _runs_in_process_pool(generator):
+    """Checks if the function rule of a task generator runs in the process
+    pool; string rules always run in threads.
+
+    """
+    if _get_function_rule(generator) is None:
+        return False
+    return getattr(generator, 'process_pool',
+                   getattr(waflib.Options.options, 'process_pool', False))
+
+
+def _run_rule(rule_index, task):
+    """Runs a function rule in a worker process of the process pool.
+
+    :return: Pair of the return value of the rule and the traceback of the
+        exception raised by the rule (None if it succeeded).
+
+    """
+    rule = _rules[rule_index]
+    if isinstance(rule, Rule):
+        rule = rule.fun
+    try:
+        return rule(task), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _get_rule_return(result):
+    """Gets the return value of a function rule from the result of
+    :py:func:`_run_rule`.
+
+    """
+    ret, error = result
+    if error is not None:
+        raise RuleProcessException(error)
+    return ret
+
+
+def _get_command_return(result):
+    """Gets the exit status of a command from the result of
+    :py:func:`_run_command`, writing its outputs as waf does.
+
+    """
+    ret, out, err = result
+    if out:
+        sys.stdout.write(out)
+    if err:
+        sys.stderr.write(err)
+    return ret
+
+
+def _run_command(cmd, cwd, env):
+    """Runs a command of a string rule in a worker process.
+
+    :return: Tuple of the exit status and the outputs to stdout and stderr.
+
+    """
+    process = subprocess.Popen(
+        cmd, shell=isinstance(cmd, str), cwd=cwd, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    return (process.returncode, out, err)
+
+
+def _create_file(path, mode='w'):
     """Opens file in write mode. It also creates intermediate directories if
     necessary.
 
@@ -686,7 +3769,267 @@ def _create_file(path):
     dirname = os.path.dirname(path)
     if not os.path.exists(dirname):
         os.makedirs(dirname)
-    return open(path, 'w')
+    return open(path, mode)
+
+
+def _join_parameters(parameter_lists, parameters):
+    """Extends each list of parameters by every parameter not conflicting with
+    it.
+
+    This is a hash join. Parameters are grouped by their key sets, and each
+    group is indexed by the values of the keys it shares with a list, so only
+    compatible pairs are enumerated instead of checking all pairs by
+    :py:meth:`Parameter.conflict_with`.
+
+    :param parameter_lists: Lists of parameters, each of which consists of
+        mutually non-conflicting parameters.
+    :type parameter_lists: ``list`` of ``list`` of :py:class:`Parameter`
+    :param parameters: Parameters to be joined to the lists.
+    :type parameters: iterable of :py:class:`Parameter`
+    :return: Joined lists, each of which is a list in ``parameter_lists``
+        followed by a parameter not conflicting with it.
+    :rtype: ``list`` of ``list`` of :py:class:`Parameter`
+
+    """
+    schemas = collections.defaultdict(list)
+    for parameter in parameters:
+        schemas[frozenset(parameter)].append(parameter)
+
+    # Index of each group of parameters keyed by the (group, shared keys) pair.
+    indices = {}
+    joined = []
+    for parameter_list in parameter_lists:
+        merged = {}
+        for p in parameter_list:
+            merged.update(p.iteritems())
+        merged_keys = frozenset(merged)
+
+        for schema, group in schemas.iteritems():
+            shared = tuple(sorted(merged_keys & schema))
+            index = indices.get((schema, shared))
+            if index is None:
+                index = collections.defaultdict(list)
+                for p in group:
+                    index[tuple(p[key] for key in shared)].append(p)
+                indices[(schema, shared)] = index
+
+            values = tuple(merged[key] for key in shared)
+            for p in index.get(values, ()):
+                joined.append(parameter_list + [p])
+
+    return joined
+
+
+def _get_projection(keys, call_object, key_type):
+    """Gets the keys of target parameters of an aggregation for source
+    parameters with given keys, and a function taking the tuple of values of
+    the target keys from the tuple of values of a source parameter.
+
+    """
+    if key_type == 'for_each':
+        target_keys = sorted(set(call_object.for_each))
+        for key in target_keys:
+            if key not in keys:
+                raise KeyError(key)
+    else:
+        target_keys = [key for key in keys
+                       if key not in call_object.aggregate_by]
+    indices = [keys.index(key) for key in target_keys]
+    if len(indices) == 1:
+        i = indices[0]
+        project = lambda values: (values[i],)
+    elif indices:
+        project = operator.itemgetter(*indices)
+    else:
+        project = lambda values: ()
+    return tuple(target_keys), project
+
+
+def _get_expansion_key(call_object, source_node_keys):
+    """Computes a key that identifies the expansion of a call object.
+
+    The expansion depends on the source, target, parameters and aggregation
+    keys of the call object, and on the parameters of the source nodes. The
+    latter are identified by the keys of the call objects producing them. The
+    call object is fingerprinted through its pickle so that user-defined
+    parameter values are compared by content.
+
+    :param call_object: Call object to be expanded.
+    :type call_object: :py:class:`CallObject`
+    :param source_node_keys: List of expansion keys of call objects producing
+        each source node.
+    :type source_node_keys: ``list`` of ``list`` of ``str``
+    :return: Expansion key, or None if the expansion cannot be identified.
+    :rtype: ``str``
+
+    """
+    if any(None in keys for keys in source_node_keys):
+        return None
+
+    spec = (call_object.source, call_object.target, call_object.parameters,
+            getattr(call_object, 'for_each', None),
+            getattr(call_object, 'aggregate_by', None),
+            [sorted(keys) for keys in source_node_keys])
+    try:
+        return hashlib.sha1(
+            pickle.dumps(spec, pickle.HIGHEST_PROTOCOL)).hexdigest()
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return None
+
+
+_MEMORY_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_memory(memory):
+    """Parses the size of memory.
+
+    :param memory: Number of bytes, or string of a number followed by a unit
+        K, M, G or T (e.g. ``'512M'`` or ``'1.5G'``).
+    :type memory: ``int`` or ``str``
+    :return: Number of bytes.
+    :rtype: ``int``
+
+    """
+    if isinstance(memory, basestring):
+        memory = memory.strip().upper().rstrip('B')
+        if memory and memory[-1] in _MEMORY_UNITS:
+            return int(float(memory[:-1]) * _MEMORY_UNITS[memory[-1]])
+        return int(float(memory))
+    return int(memory)
+
+
+def _get_resource(generator, key, default, parameter):
+    """Gets resource declared in the call object, which may be a function of
+    the parameter.
+
+    """
+    value = getattr(generator, key, default)
+    if _is_callable(value):
+        value = value(parameter)
+    return value
+
+
+def _get_physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return float('inf')
+
+
+def _get_shard_path(parameter_id, shard_depth):
+    """Gets the path of directories that the physical node of given id is put
+    in. Each level is named by two hex digits of the hash of the id.
+
+    """
+    digest = hashlib.md5(parameter_id).hexdigest()
+    return '/'.join(digest[2 * i:2 * i + 2] for i in range(shard_depth))
+
+
+def _open_locked_file(path):
+    """Opens file and locks it exclusively. The lock is released on closing
+    the file.
+
+    """
+    f = _create_file(path, 'a')
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    return f
+
+
+def _get_file_stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+def _read_stored_keys(connection):
+    try:
+        return dict(('c%d' % number, key) for number, key
+                    in connection.execute('SELECT number, key FROM columns'))
+    except sqlite3.OperationalError:
+        # The store has no record yet.
+        return {}
+
+
+def _read_stored_results(cursor, keys):
+    # The first four columns are id, position, mtime and size; keys maps the
+    # names of the others to the keys of the results.
+    names = [column[0] for column in cursor.description][4:]
+    results = {}
+    for row in cursor:
+        parameter_id = row[0]
+        result = results.get(parameter_id)
+        if result is None:
+            result = results[parameter_id] = (row[3], row[2], [])
+        result[2].append(dict(
+            (keys[name], _decode_stored_value(value))
+            for name, value in zip(names, row[4:]) if value is not None))
+    return results
+
+
+def _encode_stored_value(value):
+    """Converts a JSON value to a value of sqlite. Booleans, which sqlite
+    cannot tell from integers, nulls and values out of the range of sqlite
+    are stored as JSON in blobs.
+
+    """
+    if isinstance(value, bool):
+        pass
+    elif isinstance(value, (int, long)):
+        if -2 ** 63 <= value < 2 ** 63:
+            return value
+    elif isinstance(value, float):
+        if not math.isinf(value) and not math.isnan(value):
+            return value
+    elif isinstance(value, unicode):
+        return value
+    return buffer(json.dumps(value))
+
+
+def _decode_stored_value(value):
+    if isinstance(value, buffer):
+        return json.loads(str(value))
+    return value
+
+
+def _read_batches(f):
+    """Reads pickled batches from file until its end or a broken batch."""
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+        except (pickle.UnpicklingError, ValueError, IndexError, KeyError):
+            return
+
+
+def _copy_result(task):
+    task.outputs[0].write(task.inputs[0].read())
+
+
+def _get_scores(candidates, results, key):
+    # Averages the results of each candidate, i.e. of the parameters that
+    # include the candidate. None is given to the candidates without results.
+    keysets = set(tuple(sorted(c.keys())) for c in candidates)
+    values = collections.defaultdict(list)
+    for parameter, content in results:
+        if not isinstance(content, list):
+            content = [content]
+        for keys in keysets:
+            if all(k in parameter for k in keys):
+                candidate = FrozenParameter((k, parameter[k]) for k in keys)
+                values[candidate] += [c[key] for c in content]
+    return [float(sum(values[c])) / len(values[c]) if values[c] else None
+            for c in candidates]
+
+
+def _get_input_nodes(call_object):
+    # Deferred parameters are chosen by the results of former call objects.
+    if isinstance(call_object.parameters, DeferredParameters):
+        return call_object.source + call_object.parameters.nodes
+    return call_object.source
 
 
 def _let_element_to_be_list(d, key):
@@ -696,5 +4039,11 @@ def _let_element_to_be_list(d, key):
         d[key] = waflib.Utils.to_list(d[key])
 
 
+def _intern(key):
+    if type(key) is str:
+        return intern(key)
+    return key
+
+
 def _is_callable(o):
     return isinstance(o, types.FunctionType) or hasattr(o, '__call__')
@@ -25,7 +25,6 @@
 
 import bz2
 import collections
-import copy
 import gzip
 import json
 import os.path
@@ -95,7 +94,9 @@ def max(key):
     """Creates an aggregator to select the max value of given key.
 
     The created aggregator chooses the result with the maximum value of
-    ``key``, and writes the JSON object to the output node.
+    ``key``, and writes the JSON object to the output node. The first one is
+    chosen if there are two or more maxima. It reads inputs one by one (see
+    :py:func:`maflib.util.streaming_aggregator`).
 
     :param key: A key to be used for selection of maximum value.
     :type key: ``str``
@@ -103,19 +104,18 @@ def max(key):
     :rtype: :py:class:`maflib.core.Rule`
 
     """
-    @maflib.util.json_aggregator
-    def body(values, outpath, parameter):
-        if len(values) == 0:
-            return json.dumps({})
-
-        max_value = values[0][key]
-        argmax = values[0]
-        for value in values[1:]:
-            if max_value < value[key]:
-                max_value = value[key]
-                argmax = value
-        return argmax
-
+    def select(state, value):
+        if state is None or state[key] < value[key]:
+            return value
+        return state
+
+    def merge(state, other):
+        if other is None:
+            return state
+        return select(state, other)
+
+    body = maflib.util.streaming_aggregator(
+        lambda: None, select, merge, _finalize_selection)
     return maflib.core.Rule(fun=body, dependson=[max, key])
 
 
@@ -123,7 +123,9 @@ def min(key):
     """Creates an aggregator to select the minimum value of given key.
 
     The created aggregator chooses the result with the minimum value of
-    ``key``, and writes the JSON object to the output node.
+    ``key``, and writes the JSON object to the output node. The first one is
+    chosen if there are two or more minima. It reads inputs one by one (see
+    :py:func:`maflib.util.streaming_aggregator`).
 
     :param key: A key to be used for selection of minimum value.
     :type key: ``str``
@@ -131,40 +133,92 @@ def min(key):
     :rtype: :py:class:`maflib.core.Rule`
 
     """
-    @maflib.util.json_aggregator
-    def body(values, outpath, parameter):
-        if len(values) == 0:
-            return json.dumps({})
-
-        min_value = values[0][key]
-        argmin = values[0]
-        for value in values[1:]:
-            if min_value > value[key]:
-                min_value = value[key]
-                argmin = value
-        return argmin
-
+    def select(state, value):
+        if state is None or state[key] > value[key]:
+            return value
+        return state
+
+    def merge(state, other):
+        if other is None:
+            return state
+        return select(state, other)
+
+    body = maflib.util.streaming_aggregator(
+        lambda: None, select, merge, _finalize_selection)
     return maflib.core.Rule(fun=body, dependson=[min, key])
 
 
-@maflib.util.json_aggregator
-def average(values, output, parameter):
-    """Aggregator that calculates the average value for each key.
-
-    The result contains all keys that some inputs contain. Each value is an
-    average value of the corresponding key through all the inputs. If there
-    is a value that cannot be passed to ``float()``, it omits the corresponding
-    key from the result.
-
-    """
-    scheme = copy.deepcopy(values[0])
-    for key in scheme:
-        try:
-            scheme[key] = sum(
-                float(v[key]) for v in values) / float(len(values))
-        except:
-            pass
-    return scheme
+def _finalize_selection(state, parameter):
+    if state is None:
+        return {}
+    return state
+
+
+def _init_average():
+    return None
+
+
+def _update_average(state, value):
+    # State is a list of the first object, the number of objects and the sum
+    # of each key of the first object (None if some value is not a number).
+    if state is None:
+        return [value, 1, dict((key, _to_float(v))
+                               for key, v in value.iteritems())]
+    sums = state[2]
+    for key, total in sums.iteritems():
+        if total is not None:
+            try:
+                sums[key] = total + float(value[key])
+            except (KeyError, TypeError, ValueError):
+                sums[key] = None
+    state[1] += 1
+    return state
+
+
+def _merge_average(state, other):
+    if state is None:
+        return other
+    if other is None:
+        return state
+    sums = state[2]
+    other_sums = other[2]
+    for key, total in sums.iteritems():
+        if total is not None:
+            v = other_sums.get(key)
+            sums[key] = None if v is None else total + v
+    state[1] += other[1]
+    return state
+
+
+def _finalize_average(state, parameter):
+    if state is None:
+        return {}
+    first, count, sums = state
+    result = dict(first)
+    for key, total in sums.iteritems():
+        if total is not None:
+            result[key] = total / float(count)
+    return result
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+average = maflib.util.streaming_aggregator(
+    _init_average, _update_average, _merge_average, _finalize_average)
+"""Aggregator that calculates the average value for each key.
+
+The result contains all keys of the first input. Each value is an average
+value of the corresponding key through all the inputs. If there is an input
+without the key or a value that cannot be passed to ``float()``, the value of
+the first input is used instead. It reads inputs one by one (see
+:py:func:`maflib.util.streaming_aggregator`).
+
+"""
 
 
 def convert_libsvm_accuracy(task):
@@ -83,8 +83,8 @@ class TestTask(object):
             self.list = []
 
         def __getitem__(self, index):
-            if index <= len(self.list):
-                for i in range(len(self.list) - index + 1):
+            if index >= len(self.list):
+                for i in range(index - len(self.list) + 1):
                     self.list.append(maflib.core.ExperimentNode())
             return self.list[index]
 
@@ -24,12 +24,19 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import functools
+import gc
 import itertools
 import json
+import math
+import multiprocessing.pool
 import numpy.random
+import os.path
+import re
 import types
 import numpy as np
 
+import maflib.core
+
 def aggregator(callback_body):
     """Creates an aggregator using function ``callback_body`` independent from
     waf.
@@ -52,6 +59,16 @@ def aggregator(callback_body):
     See :py:mod:`maflib.rules` or :py:mod:`maflib.plot` to get
     examples of ``callback_body``.
 
+    If the source meta node has a result store (see
+    :py:class:`maflib.core.ResultStore`), the contents of input files are read
+    from the store at once. Files modified after they are recorded are read
+    directly.
+
+    Input files are read one by one by default. With ``--input-loaders``
+    option of ``waf experiment`` (or ``input_loaders`` of the call object),
+    they are read and parsed concurrently by the given number of threads,
+    which helps when reading files is slow, e.g. on a network file system.
+
     :param callback_body: A function or a callable object that takes three
         arguments: ``values``, ``abspath``, and ``parameter``. ``values`` is an
         array of dictionaries that represents the content of input files.
@@ -67,8 +84,8 @@ def aggregator(callback_body):
     @functools.wraps(callback_body)
     def callback(task):
         values = []
-        for node, parameter in zip(task.inputs, task.env.source_parameter):
-            content = json.loads(node.read())
+        for content, parameter in zip(_load_results(task),
+                                      task.env.source_parameter):
             if not isinstance(content, list):
                 content = [content]
             for element in content:
@@ -111,18 +128,294 @@ def json_aggregator(callback_body):
     @functools.wraps(callback_body)
     @aggregator
     def callback(values, abspath, parameter):
-        def to_jsonable(v):
-            try:
-                json.dumps(v)
-                return v
-            except:
-                return str(v)
-        parameter = dict([(k, to_jsonable(parameter[k])) for k in parameter])
-        result = callback_body(values, abspath, parameter)
+        result = callback_body(
+            values, abspath, _to_jsonable_parameter(parameter))
         return json.dumps(result)
     
     return callback
-    
+
+
+def streaming_aggregator(init, update, merge, finalize):
+    """Creates an aggregator that folds input JSON objects one by one.
+
+    Unlike :py:func:`aggregator`, the created rule never holds all the
+    contents of input files. Each input file is read by a streaming JSON
+    reader, and its objects (each updated by the parameter of the input node)
+    are folded into a state by ``update``. The states of input nodes are
+    combined by ``merge``, and ``finalize`` converts the combined state into
+    a JSON-serializable result, which is written to the output node. The
+    memory usage is bounded by the size of a state and of one JSON object.
+
+    With ``--incremental-aggregation`` option of ``waf experiment`` (or
+    ``incremental_aggregation=True`` of the call object), the state of each
+    input node is saved with the signature of the node. When the task is run
+    again, only the inputs with changed signatures are read, and the saved
+    states of the others are merged again. Saved states are discarded if
+    ``init``, ``update`` or ``merge`` is changed.
+
+    States must be made of JSON-serializable values. See
+    :py:func:`maflib.rules.max` or :py:data:`maflib.rules.average` for
+    examples.
+
+    :param init: A function that takes no argument and returns the state of
+        no object.
+    :type init: ``function``
+    :param update: A function that takes a state and a dictionary, and
+        returns the state updated by the dictionary. It may modify the given
+        state.
+    :type update: ``function``
+    :param merge: A function that takes two states and returns the state of
+        the objects of both, which precede those of the second. It may modify
+        the first state.
+    :type merge: ``function``
+    :param finalize: A function that takes a state and the parameter of the
+        output node, and returns the result.
+    :type finalize: ``function``
+    :return: An aggregator.
+    :rtype: ``function``
+
+    """
+    def callback(task):
+        store = None
+        if task.env.result_store:
+            store = maflib.core.ResultStore(task.env.result_store)
+        states_path = None
+        if task.env.incremental_aggregation:
+            states_path = _get_states_path(task.outputs[0].abspath())
+            rule_key = '.'.join(
+                maflib.core.get_fingerprint(f) for f in (init, update, merge))
+            states = _load_states(states_path, rule_key)
+            new_states = {}
+        try:
+            state = init()
+            for node, parameter in zip(task.inputs, task.env.source_parameter):
+                signature = _get_signature(node) if states_path else None
+                # Saved states are kept as JSON, since merge may modify them.
+                input_state = None
+                if signature is not None:
+                    saved = states.get(node.abspath())
+                    if saved is not None and saved[0] == signature:
+                        input_state = saved[1]
+                if input_state is None:
+                    input_state = init()
+                    for value in _iter_result(node, store):
+                        value.update(parameter)
+                        input_state = update(input_state, value)
+                    input_state = json.dumps(input_state)
+                if signature is not None:
+                    new_states[node.abspath()] = (signature, input_state)
+                state = merge(state, json.loads(input_state))
+        finally:
+            if store is not None:
+                store.close()
+        result = finalize(state, _to_jsonable_parameter(task.parameter))
+        task.outputs[0].write(json.dumps(result))
+        if states_path is not None:
+            _save_states(states_path, rule_key, new_states)
+
+    return callback
+
+
+def _get_signature(node):
+    # Rules run in threads are given nodes of waf.
+    if not isinstance(node, maflib.core.ExperimentNode):
+        node = maflib.core.ExperimentNode(node)
+    return node.signature()
+
+
+def _get_states_path(output_path):
+    # States are saved into a hidden file beside the output node.
+    dirname, basename = os.path.split(output_path)
+    return os.path.join(dirname, '.%s.maf_states' % basename)
+
+
+def _load_states(path, rule_key):
+    """Loads the states of input nodes saved by an aggregator, which are
+    discarded if the functions of the aggregator are changed.
+
+    """
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if saved.get('rule') != rule_key:
+        return {}
+    return saved['states']
+
+
+def _save_states(path, rule_key, states):
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'rule': rule_key, 'states': states}, f)
+    os.rename(path + '.tmp', path)
+
+
+def _to_jsonable_parameter(parameter):
+    def to_jsonable(v):
+        try:
+            json.dumps(v)
+            return v
+        except:
+            return str(v)
+    return dict([(k, to_jsonable(parameter[k])) for k in parameter])
+
+
+def _load_results(task):
+    """Loads the contents of all input files of a task, in the order of the
+    inputs.
+
+    """
+    paths = [node.abspath() for node, _
+             in zip(task.inputs, task.env.source_parameter)]
+    stored_results = {}
+    if task.env.result_store:
+        stored_results = maflib.core.ResultStore(task.env.result_store).read(
+            _get_parameter_id(path) for path in paths)
+    results = []
+    # Pairs of the index and the path of inputs read from files.
+    unstored = []
+    for path in paths:
+        result = _check_stored_result(
+            path, stored_results.get(_get_parameter_id(path)))
+        if result is None:
+            unstored.append((len(results), path))
+        results.append(result)
+
+    loaded = _map_inputs(
+        _load_json_file, [path for _, path in unstored],
+        task.env.input_loaders or 1)
+    for (i, _), result in zip(unstored, loaded):
+        results[i] = result
+    return results
+
+
+def _map_inputs(func, paths, loaders):
+    """Applies a function to paths of inputs in a pool of threads, and
+    returns the results in order.
+
+    """
+    loaders = min(loaders, len(paths))
+    if loaders <= 1:
+        return map(func, paths)
+    pool = multiprocessing.pool.ThreadPool(loaders)
+    try:
+        return pool.map(func, paths)
+    finally:
+        # Threads exit by themselves; joining them would wait for the polling
+        # interval of the pool.
+        pool.close()
+
+
+def _load_json_file(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _iter_result(node, store):
+    """Iterates over the objects of a JSON object or array in an input file,
+    which are read from the result store if recorded.
+
+    """
+    path = node.abspath()
+    if store is not None:
+        result = _check_stored_result(path, store.get(_get_parameter_id(path)))
+        if result is not None:
+            return iter(result)
+    return _iter_json(path)
+
+
+def _get_parameter_id(path):
+    # Physical nodes are named by their parameter ids.
+    return os.path.basename(path).split('-', 1)[0]
+
+
+def _check_stored_result(path, result):
+    """Gets the objects of a stored result if the file is not modified after
+    it is recorded.
+
+    """
+    if result is None:
+        return None
+    st = os.stat(path)
+    if (st.st_size, st.st_mtime) != result[:2]:
+        return None
+    return result[2]
+
+
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_BEGIN, _JSON_FIRST_VALUE, _JSON_VALUE, _JSON_DELIMITER, _JSON_END = (
+    range(5))
+
+
+def _iter_json(path, chunk_size=1 << 16):
+    """Iterates over the elements of a JSON array in a file, reading the file
+    chunk by chunk. A file of another JSON value yields the value itself.
+
+    """
+    decode = _JSON_DECODER.raw_decode
+    skip = _JSON_WHITESPACE.match
+    with open(path) as f:
+        buf = ''
+        pos = 0
+        eof = False
+        size = chunk_size
+        # Expected token: '[' at the beginning, a value or ']' after '[', ','
+        # or ']' after a value, and a value after ','.
+        state = _JSON_BEGIN
+        while True:
+            pos = skip(buf, pos).end()
+            if pos < len(buf):
+                c = buf[pos]
+                if state == _JSON_BEGIN:
+                    if c != '[':
+                        yield json.loads(buf[pos:] + f.read())
+                        return
+                    pos += 1
+                    state = _JSON_FIRST_VALUE
+                    continue
+                if state == _JSON_DELIMITER:
+                    pos += 1
+                    if c == ']':
+                        state = _JSON_END
+                    elif c == ',':
+                        state = _JSON_VALUE
+                    else:
+                        raise ValueError('Expecting , delimiter in %s' % path)
+                    continue
+                if state == _JSON_FIRST_VALUE and c == ']':
+                    pos += 1
+                    state = _JSON_END
+                    continue
+                if state == _JSON_END:
+                    raise ValueError('Extra data in %s' % path)
+                try:
+                    value, end = decode(buf, pos)
+                    # A number at the end of the buffer may continue.
+                    if end < len(buf) or eof:
+                        pos = end
+                        size = chunk_size
+                        state = _JSON_DELIMITER
+                        yield value
+                        continue
+                except ValueError:
+                    if eof:
+                        raise
+            elif eof:
+                if state != _JSON_END:
+                    raise ValueError('Unexpected end of JSON in %s' % path)
+                return
+
+            chunk = f.read(size)
+            if chunk:
+                buf = buf[pos:] + chunk
+                pos = 0
+                # Grow the chunk so that a large value is not decoded many
+                # times.
+                size *= 2
+            else:
+                eof = True
+
 
 def product(parameter):
     """Generates a direct product of given listed parameters.
@@ -150,6 +443,109 @@ def product(parameter):
     return [dict(zip(keys, vals)) for vals in values_product]
 
 
+def lazy_product(space, where=None):
+    """Lazily generates a product of parameters with conditional and nested
+    axes.
+
+    Unlike :py:func:`product`, parameters are generated one by one whenever
+    the returned object is iterated, and those not satisfying ``where`` are
+    dropped on the fly. The object can be given to ``parameters`` of
+    ``ExperimentContext.__call__``, which expands it when the tasks are
+    generated.
+
+    .. code-block:: python
+
+        maflib.util.lazy_product({
+            's': [0, 1, 2, 3],
+            'C': [0.1, 1, 10],
+            # B only exists for s = 0 and 1.
+            'B': lambda p: [1, -1] if p['s'] in (0, 1) else None,
+            # lr exists for both optimizers, and momentum only for sgd.
+            'optimizer': {'sgd': {'lr': [0.1, 0.01], 'momentum': [0, 0.9]},
+                          'adagrad': {'lr': [0.1, 0.01]}}},
+            where=lambda p: p['C'] < 10 or p['s'] != 3)
+
+    :param space: Dictionary from parameter names to axes, or a list of them
+        whose products are concatenated. An axis is one of following:
+
+        **List of values**
+            The parameter takes each value.
+        **Dictionary**
+            The parameter takes each key, and the space given as its value
+            (a dictionary, a list of them or None) is nested, i.e. it adds
+            axes only for that key.
+        **Function**
+            The function takes the parameter of the other axes that are not
+            functions, and of the functions of smaller names, and returns the
+            axis. If it returns None, the parameter does not exist.
+    :type space: ``dict`` or ``list`` of ``dict``
+    :param where: Function or list of functions that take a parameter and
+        return whether the parameter is generated.
+    :type where: ``function`` or ``list`` of ``function``
+    :return: Iterable of parameters.
+    :rtype: iterable of ``dict``
+
+    """
+    if where is None:
+        where = []
+    elif not isinstance(where, list):
+        where = [where]
+    return _LazyProduct(space, where)
+
+
+class _LazyProduct(object):
+    def __init__(self, space, where):
+        self.space = space
+        self.where = where
+
+    def __iter__(self):
+        parameter = {}
+        for axes in _get_axes(self.space):
+            for _ in _expand_axes(axes, parameter):
+                if all(predicate(parameter) for predicate in self.where):
+                    yield dict(parameter)
+
+
+def _get_axes(space):
+    # Lists of pairs of a key and an axis for each space to be concatenated.
+    # Function axes come last, since they may depend on the other axes.
+    if space is None:
+        return [[]]
+    if isinstance(space, list):
+        return [axes for s in space for axes in _get_axes(s)]
+    keys = sorted(space, key=lambda key: (callable(space[key]), key))
+    return [[(key, space[key]) for key in keys]]
+
+
+def _expand_axes(axes, parameter):
+    # Sets each combination of values to ``parameter`` in place, and yields
+    # once for each.
+    if not axes:
+        yield
+        return
+
+    key, axis = axes[0]
+    if key in parameter:
+        raise ValueError('parameter %r is given twice' % (key,))
+    if callable(axis):
+        axis = axis(parameter)
+    if axis is None:
+        for _ in _expand_axes(axes[1:], parameter):
+            yield
+        return
+
+    for value in (sorted(axis) if isinstance(axis, dict) else axis):
+        parameter[key] = value
+        if isinstance(axis, dict):
+            for nested in _get_axes(axis[value]):
+                for _ in _expand_axes(nested + axes[1:], parameter):
+                    yield
+        else:
+            for _ in _expand_axes(axes[1:], parameter):
+                yield
+        del parameter[key]
+
+
 def sample(num_samples, distribution):
     """Randomly samples parameters from given distributions.
 
@@ -174,6 +570,9 @@ def sample(num_samples, distribution):
             ``f`` can be used for an arbitrary generator of values. Multiple
             calls of ``f()`` should generate random samples of user-defined
             distribution.
+        **Interval**
+            :py:class:`Interval` specifies a uniform distribution on an
+            interval on log scale or of integers.
     :return: A list of sampled parameters.
     :rtype: ``list`` of ``dict``.
 
@@ -197,6 +596,10 @@ def sample(num_samples, distribution):
             gen = lambda mult_ks=distribution[key]: mult_ks[
                 numpy.random.randint(0,len(mult_ks))]
 
+        elif isinstance(distribution[key], Interval):
+            gen = lambda interval=distribution[key]: interval.from_unit(
+                numpy.random.random_sample(1))[0]
+
         # Any random generating function
         elif isinstance(distribution[key], types.FunctionType):
             gen = distribution[key]
@@ -214,6 +617,427 @@ def sample(num_samples, distribution):
 
     return sampled
 
+
+class Interval(object):
+    """Interval of numbers to sample from, which may be on log scale or only
+    contain integers.
+
+    """
+    def __init__(self, begin, end, log=False, integer=False):
+        """Initializes the interval.
+
+        :param begin: Lower bound.
+        :param end: Upper bound, which is excluded unless ``integer`` is True.
+        :param log: Whether to sample uniformly on log scale.
+        :type log: ``bool``
+        :param integer: Whether to sample integers from ``begin`` to ``end``
+            inclusive.
+        :type integer: ``bool``
+
+        """
+        self.begin = begin
+        self.end = end
+        self.log = log
+        self.integer = integer
+
+    def from_unit(self, units):
+        """Maps numbers in [0, 1) to the interval.
+
+        :param units: Array of numbers in [0, 1).
+        :type units: ``numpy.ndarray``
+        :return: Numbers in the interval.
+        :rtype: ``list``
+
+        """
+        begin, end = self._bounds()
+        values = begin + units * (end - begin)
+        if self.log:
+            values = np.exp(values)
+        if self.integer:
+            values = np.clip(np.floor(values), self.begin, self.end)
+            return values.astype(int).tolist()
+        return values.tolist()
+
+    def to_unit(self, values):
+        """Maps numbers in the interval to [0, 1).
+
+        :param values: Numbers in the interval.
+        :type values: ``list``
+        :return: Numbers in [0, 1).
+        :rtype: ``numpy.ndarray``
+
+        """
+        begin, end = self._bounds()
+        values = np.asarray(values, dtype=float)
+        if self.log:
+            values = np.log(values)
+        return (values - begin) / (end - begin)
+
+    def _bounds(self):
+        begin, end = float(self.begin), float(self.end)
+        if self.integer:
+            end += 1
+        if self.log:
+            return np.log(begin), np.log(end)
+        return begin, end
+
+
+def quasi_sample(num_samples, distribution, method='sobol', seed=0):
+    """Samples parameters that cover the space more evenly than
+    :py:func:`sample`.
+
+    Each interval and list of ``distribution`` is an axis of the unit
+    hypercube, from which points are drawn at once by one of the following
+    methods.
+
+    ``'sobol'``
+        Sobol sequence, with a random digital shift. It supports up to 40
+        axes, and is the most even when ``num_samples`` is a power of 2.
+    ``'halton'``
+        Halton sequence, with a random shift.
+    ``'latin_hypercube'``
+        Latin hypercube sampling, i.e. each axis is divided into
+        ``num_samples`` strata, each of which contains one point.
+
+    The same arguments always give the same parameters.
+
+    :param num_samples: Number of samples.
+    :type num_samples: ``int``
+    :param distribution: Dictionary from parameter names to distributions in
+        the same form as :py:func:`sample`. :py:class:`Interval` gives an
+        interval on log scale or of integers, e.g.
+        ``maflib.util.Interval(1e-3, 1e3, log=True)``.
+    :type distribution: ``dict``
+    :param method: ``'sobol'``, ``'halton'`` or ``'latin_hypercube'``.
+    :type method: ``str``
+    :param seed: Seed of the randomization.
+    :type seed: ``int``
+    :return: A list of sampled parameters.
+    :rtype: ``list`` of ``dict``
+
+    """
+    random = np.random.RandomState(seed)
+    num_axes = _count_axes(distribution)
+    if method == 'sobol':
+        units = _sobol(num_samples, num_axes, random)
+    elif method == 'halton':
+        units = _halton(num_samples, num_axes, random)
+    elif method == 'latin_hypercube':
+        units = _latin_hypercube(num_samples, num_axes, random)
+    else:
+        raise ValueError('unknown sampling method: %s' % method)
+    return _from_unit(num_samples, distribution, units)
+
+
+def _to_interval(value):
+    if isinstance(value, tuple):
+        return Interval(*value)
+    return value
+
+
+def _count_axes(distribution):
+    return sum(1 for value in distribution.itervalues()
+               if isinstance(value, (tuple, list, Interval)))
+
+
+def _from_unit(num_samples, distribution, units):
+    # Maps each column of units to an axis of the distribution in the order of
+    # keys.
+    keys = sorted(distribution)
+    if not keys:
+        return [{} for _ in xrange(num_samples)]
+    columns = []
+    axis = 0
+    for key in keys:
+        value = _to_interval(distribution[key])
+        if isinstance(value, Interval):
+            columns.append(value.from_unit(units[:, axis]))
+            axis += 1
+        elif isinstance(value, list):
+            indices = (units[:, axis] * len(value)).astype(int)
+            columns.append([value[i] for i in indices.tolist()])
+            axis += 1
+        elif isinstance(value, types.FunctionType):
+            columns.append([value() for _ in xrange(num_samples)])
+        else:
+            columns.append([value] * num_samples)
+
+    # Dictionaries cannot make cycles, but a lot of them trigger the cyclic
+    # garbage collector many times.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return [dict(itertools.izip(keys, row))
+                for row in itertools.izip(*columns)]
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# Primitive polynomials and initial direction numbers of the Sobol sequence
+# for the second and later axes, by S. Joe and F. Y. Kuo, "Constructing Sobol
+# sequences with better two-dimensional projections" (2008).
+_SOBOL_DIRECTIONS = [
+    (3, (1,)),
+    (7, (1, 3)),
+    (11, (1, 3, 1)),
+    (13, (1, 1, 1)),
+    (19, (1, 1, 3, 3)),
+    (25, (1, 3, 5, 13)),
+    (37, (1, 1, 5, 5, 17)),
+    (41, (1, 1, 5, 5, 5)),
+    (47, (1, 1, 7, 11, 19)),
+    (55, (1, 1, 5, 1, 1)),
+    (59, (1, 1, 1, 3, 11)),
+    (61, (1, 3, 5, 5, 31)),
+    (67, (1, 3, 3, 9, 7, 49)),
+    (91, (1, 1, 1, 15, 21, 21)),
+    (97, (1, 3, 1, 13, 27, 49)),
+    (103, (1, 1, 1, 15, 7, 5)),
+    (109, (1, 3, 1, 15, 13, 25)),
+    (115, (1, 1, 5, 5, 19, 61)),
+    (131, (1, 3, 7, 11, 23, 15, 103)),
+    (137, (1, 3, 7, 13, 13, 15, 69)),
+    (143, (1, 1, 3, 13, 7, 35, 63)),
+    (145, (1, 3, 5, 9, 1, 25, 53)),
+    (157, (1, 3, 1, 13, 9, 35, 107)),
+    (167, (1, 3, 1, 5, 27, 61, 31)),
+    (171, (1, 1, 5, 11, 19, 41, 61)),
+    (185, (1, 3, 5, 3, 3, 13, 69)),
+    (191, (1, 1, 7, 13, 1, 19, 1)),
+    (193, (1, 3, 7, 5, 13, 19, 59)),
+    (203, (1, 1, 3, 9, 25, 29, 41)),
+    (211, (1, 3, 5, 13, 23, 1, 55)),
+    (213, (1, 3, 7, 3, 13, 59, 17)),
+    (229, (1, 3, 1, 3, 5, 53, 69)),
+    (239, (1, 1, 5, 5, 23, 33, 13)),
+    (241, (1, 1, 7, 7, 1, 61, 123)),
+    (247, (1, 1, 7, 9, 13, 61, 49)),
+    (253, (1, 3, 3, 5, 3, 55, 33)),
+    (285, (1, 3, 1, 15, 31, 13, 49, 245)),
+    (299, (1, 3, 5, 15, 31, 59, 63, 97)),
+    (301, (1, 3, 1, 11, 11, 11, 77, 249)),
+]
+
+_SOBOL_BITS = 52
+
+
+def _sobol_direction_numbers(num_axes):
+    # Direction numbers v[axis, bit] scaled by 2 ** _SOBOL_BITS.
+    if num_axes > len(_SOBOL_DIRECTIONS) + 1:
+        raise ValueError('Sobol sequence supports up to %d axes' %
+                         (len(_SOBOL_DIRECTIONS) + 1))
+    v = np.zeros((num_axes, _SOBOL_BITS), dtype=np.uint64)
+    for axis in range(num_axes):
+        if axis == 0:
+            m = [1] * _SOBOL_BITS
+        else:
+            poly, m = _SOBOL_DIRECTIONS[axis - 1]
+            degree = poly.bit_length() - 1
+            m = list(m)
+            for i in range(degree, _SOBOL_BITS):
+                value = m[i - degree] ^ (m[i - degree] << degree)
+                for k in range(1, degree):
+                    if poly >> (degree - k) & 1:
+                        value ^= m[i - k] << k
+                m.append(value)
+        for i in range(_SOBOL_BITS):
+            v[axis, i] = m[i] << (_SOBOL_BITS - 1 - i)
+    return v
+
+
+def _sobol(num_samples, num_axes, random):
+    v = _sobol_direction_numbers(num_axes)
+    indices = np.arange(num_samples, dtype=np.uint64)
+    points = np.zeros((num_samples, num_axes), dtype=np.uint64)
+    for bit in range(max(num_samples - 1, 1).bit_length()):
+        mask = (indices >> np.uint64(bit)) & np.uint64(1)
+        points ^= mask[:, np.newaxis] * v[:, bit]
+    shift = random.randint(0, 1 << 26, (2, num_axes)).astype(np.uint64)
+    points ^= (shift[0] << np.uint64(26)) | shift[1]
+    return points.astype(float) / float(1 << _SOBOL_BITS)
+
+
+def _primes(num_primes):
+    primes = []
+    candidate = 2
+    while len(primes) < num_primes:
+        if all(candidate % p for p in primes):
+            primes.append(candidate)
+        candidate += 1
+    return primes
+
+
+def _halton(num_samples, num_axes, random):
+    units = np.zeros((num_samples, num_axes))
+    for axis, base in enumerate(_primes(num_axes)):
+        # Radical inverse of indices in the base.
+        indices = np.arange(num_samples)
+        scale = 1.0
+        while indices.any():
+            scale /= base
+            units[:, axis] += indices % base * scale
+            indices //= base
+    return (units + random.random_sample(num_axes)) % 1.0
+
+
+def _latin_hypercube(num_samples, num_axes, random):
+    units = np.empty((num_samples, num_axes))
+    for axis in range(num_axes):
+        units[:, axis] = random.permutation(num_samples)
+    return (units + random.random_sample(units.shape)) / num_samples
+
+
+class GaussianProcessSampler(object):
+    """Adaptive sampler of parameters by Bayesian optimization.
+
+    The sampler fits a Gaussian process to the scores of parameters observed
+    so far, and proposes the parameters of the largest expected improvement
+    among random candidates. A batch of parameters is proposed by pretending
+    that each proposed parameter gets the predicted score (the kriging
+    believer), so the batch does not concentrate on one point. Without
+    observations, it just samples parameters at random.
+
+    The sampler is given to :py:meth:`maflib.core.ExperimentContext.optimize`.
+
+    .. code-block:: python
+
+        exp.optimize(pipeline,
+                     maflib.util.GaussianProcessSampler({'C': (0.0, 10.0)}),
+                     key='accuracy', rounds=10, batch_size=4)
+
+    Proposals are deterministic for the same observations.
+
+    """
+    def __init__(self, distribution, num_candidates=1000, seed=0):
+        """Initializes the sampler.
+
+        :param distribution: Dictionary from parameter names to distributions
+            in the same form as :py:func:`sample`, except that functions are
+            not allowed. Pairs and lists of values are modeled; constants are
+            not.
+        :type distribution: ``dict``
+        :param num_candidates: Number of random candidates from which each
+            parameter is chosen.
+        :type num_candidates: ``int``
+        :param seed: Seed of random numbers.
+        :type seed: ``int``
+
+        """
+        self.distribution = distribution
+        self.num_candidates = num_candidates
+        self.seed = seed
+
+    def __call__(self, num_samples, observations):
+        """Proposes parameters.
+
+        :param num_samples: Number of parameters to propose.
+        :type num_samples: ``int``
+        :param observations: Pairs of a parameter and its score; larger scores
+            are better.
+        :type observations: ``list`` of ``tuple``
+        :return: Proposed parameters.
+        :rtype: ``list`` of ``dict``
+
+        """
+        random = np.random.RandomState([self.seed, len(observations)])
+        if not observations:
+            return self._sample(num_samples, random)
+
+        # Discrete spaces may be exhausted.
+        observed = set(self._key(p) for p, _ in observations)
+        candidates = []
+        for candidate in self._sample(self.num_candidates, random):
+            if self._key(candidate) not in observed:
+                observed.add(self._key(candidate))
+                candidates.append(candidate)
+        if not candidates:
+            return []
+
+        x = self._encode([p for p, _ in observations])
+        y = np.array([score for _, score in observations], dtype=float)
+        y = (y - y.mean()) / (y.std() or 1.0)
+        candidate_x = self._encode(candidates)
+        scale = np.sqrt(max(x.shape[1], 1))
+        lengthscale = max(
+            [l * scale for l in (0.2, 0.5, 1.0, 2.0)],
+            key=lambda l: _gp_log_likelihood(x, y, l))
+
+        best = y.max()
+        chosen = []
+        for _ in range(min(num_samples, len(candidates))):
+            mean, std = _gp_predict(x, y, candidate_x, lengthscale)
+            improvement = _expected_improvement(mean, std, best)
+            improvement[chosen] = -1.0
+            i = int(np.argmax(improvement))
+            chosen.append(i)
+            x = np.vstack([x, candidate_x[i]])
+            y = np.append(y, mean[i])
+            best = max(best, mean[i])
+        return [candidates[i] for i in chosen]
+
+    def _sample(self, num_samples, random):
+        units = random.random_sample(
+            (num_samples, _count_axes(self.distribution)))
+        return _from_unit(num_samples, self.distribution, units)
+
+    def _key(self, parameter):
+        return tuple(parameter[key] for key in sorted(self.distribution))
+
+    def _encode(self, parameters):
+        # Intervals are scaled to [0, 1], and lists are one-hot encoded.
+        columns = []
+        for key in sorted(self.distribution):
+            value = _to_interval(self.distribution[key])
+            if isinstance(value, Interval):
+                columns.append(value.to_unit([p[key] for p in parameters]))
+            elif isinstance(value, list):
+                for v in value:
+                    columns.append([float(p[key] == v) for p in parameters])
+        return np.array(columns, dtype=float).T.reshape(
+            len(parameters), len(columns))
+
+
+_GP_NOISE = 1e-3
+
+
+def _gp_kernel(x1, x2, lengthscale):
+    distance = ((x1[:, np.newaxis, :] - x2[np.newaxis, :, :]) ** 2).sum(-1)
+    return np.exp(-0.5 * distance / lengthscale ** 2)
+
+
+def _gp_fit(x, y, lengthscale):
+    # The signal variance is estimated by maximum likelihood for the given
+    # lengthscale.
+    k = _gp_kernel(x, x, lengthscale) + _GP_NOISE * np.eye(len(x))
+    l = np.linalg.cholesky(k)
+    alpha = np.linalg.solve(l.T, np.linalg.solve(l, y))
+    variance = max(y.dot(alpha) / len(y), 1e-12)
+    return l, alpha, variance
+
+
+def _gp_log_likelihood(x, y, lengthscale):
+    l, _, variance = _gp_fit(x, y, lengthscale)
+    return -0.5 * len(y) * np.log(variance) - np.log(np.diag(l)).sum()
+
+
+def _gp_predict(x, y, new_x, lengthscale):
+    l, alpha, variance = _gp_fit(x, y, lengthscale)
+    k_new = _gp_kernel(x, new_x, lengthscale)
+    v = np.linalg.solve(l, k_new)
+    std = np.sqrt(variance * np.maximum(1.0 - (v ** 2).sum(0), 1e-12))
+    return k_new.T.dot(alpha), std
+
+
+_normal_cdf = np.vectorize(lambda z: 0.5 * (1.0 + math.erf(z / math.sqrt(2))))
+
+
+def _expected_improvement(mean, std, best):
+    z = (mean - best) / std
+    return (mean - best) * _normal_cdf(z) + \
+        std * np.exp(-0.5 * z ** 2) / np.sqrt(2 * np.pi)
+
+
 def set_random_seed(x):
     np.random.seed(x)
 
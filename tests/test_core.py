@@ -24,9 +24,27 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from maflib.core import *
+import maflib.core
+import maflib.test
 import tempfile
+import hashlib
+import logging
+import heapq
+import collections
+import itertools
+import json
+import time
+import waflib.Logs
+import waflib.Utils
+import multiprocessing
+import multiprocessing.connection
+import fcntl
+import pickle
 import os
+import sys
 import shutil
+import signal
+import threading
 import unittest
 import shutil
 
@@ -82,6 +100,86 @@ class TestParameter(unittest.TestCase):
         self.assertFalse(Parameter(a=1, b=2, c=3) in d)
 
 
+class TestFrozenParameter(unittest.TestCase):
+    def test_dict_like_access(self):
+        p = FrozenParameter({'b': 2, 'a': 1})
+        self.assertEqual(1, p['a'])
+        self.assertEqual(2, p.get('b'))
+        self.assertIsNone(p.get('c'))
+        self.assertIn('a', p)
+        self.assertNotIn('c', p)
+        self.assertEqual(['a', 'b'], list(p))
+        self.assertEqual({'a': 1, 'b': 2}, dict(p))
+        self.assertRaises(KeyError, lambda: p['c'])
+
+    def test_equal_to_parameter(self):
+        p = FrozenParameter(a=1, b=2)
+        self.assertEqual(Parameter(a=1, b=2), p)
+        self.assertEqual(p, Parameter(a=1, b=2))
+        self.assertNotEqual(Parameter(a=1), p)
+        self.assertEqual(hash(Parameter(a=1, b=2)), hash(p))
+
+    def test_dict_with_frozen_parameter_keys(self):
+        d = {}
+        d[FrozenParameter(a=1)] = 1
+        d[FrozenParameter(a=1, b=2)] = 2
+
+        self.assertEqual(1, d[FrozenParameter(a=1)])
+        self.assertEqual(2, d[Parameter(a=1, b=2)])
+        self.assertFalse(FrozenParameter(a=2) in d)
+
+    def test_conflicted_parameters(self):
+        p = FrozenParameter(a=1, b=2, c=3)
+        self.assertTrue(p.conflict_with(Parameter(a=2, b=2, d=4)))
+        self.assertFalse(p.conflict_with(FrozenParameter(a=1, b=2, d=4)))
+
+    def test_shares_key_tuple(self):
+        p = FrozenParameter(a=1, b=2)
+        q = FrozenParameter(a=3, b=4)
+        self.assertIs(p._keys, q._keys)
+
+    def test_pickle(self):
+        p = FrozenParameter(a=1, b='x')
+        self.assertEqual(p, pickle.loads(pickle.dumps(p)))
+
+    def test_from_sorted_items(self):
+        p = FrozenParameter.from_sorted_items(('a', 'b'), (1, 'x'))
+        self.assertEqual(FrozenParameter(a=1, b='x'), p)
+        self.assertEqual(hash(FrozenParameter(a=1, b='x')), hash(p))
+        self.assertIs(FrozenParameter(a=2, b='y')._keys, p._keys)
+
+
+class TestJoinParameters(unittest.TestCase):
+    def test_join_empty_list(self):
+        joined = maflib.core._join_parameters(
+            [[]], [Parameter(a=1), Parameter(a=2)])
+        self.assertEqual([[Parameter(a=1)], [Parameter(a=2)]], joined)
+
+    def test_join_skips_conflicted_parameters(self):
+        lists = [[Parameter(a=1, b=1)], [Parameter(a=2, b=1)]]
+        params = [Parameter(a=1, c=1), Parameter(a=1, c=2), Parameter(a=3)]
+        joined = maflib.core._join_parameters(lists, params)
+        self.assertEqual(
+            [[Parameter(a=1, b=1), Parameter(a=1, c=1)],
+             [Parameter(a=1, b=1), Parameter(a=1, c=2)]],
+            joined)
+
+    def test_join_heterogeneous_keys(self):
+        lists = [[Parameter(a=1)], [Parameter(a=2), Parameter(b=1)]]
+        params = [Parameter(), Parameter(a=1), Parameter(b=1), Parameter(b=2),
+                  Parameter(a=2, b=2)]
+        self._assert_same_as_nested_loop(lists, params)
+
+    def _assert_same_as_nested_loop(self, lists, params):
+        expect = []
+        for l in lists:
+            for p in params:
+                if not any(q.conflict_with(p) for q in l):
+                    expect.append(l + [p])
+        joined = maflib.core._join_parameters(lists, params)
+        self.assertEqual(sorted(expect), sorted(joined))
+
+
 class Setting(object):
     def __init__(self, a, b, c):
         self.a = a
@@ -124,6 +222,697 @@ class TestParameterIdGenerator(unittest.TestCase):
             clean_environment()
 
             
+class TestParameterIdGeneratorLog(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'id_table')
+        self.text_path = os.path.join(self.tmpdir, 'id_table.tsv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_flush_appends_only_new_ids(self):
+        id_generator = self._id_generator()
+        self.assertEqual('0', id_generator.get_id(Parameter(a=0)))
+        id_generator.flush()
+        self.assertFalse(os.path.exists(self.path))
+
+        id_generator = self._id_generator()
+        self.assertEqual('0', id_generator.get_id(Parameter(a=0)))
+        self.assertEqual('1', id_generator.get_id(Parameter(a=1)))
+        id_generator.flush()
+
+        id_generator = self._id_generator()
+        self.assertEqual(2, len(id_generator))
+        self.assertEqual(FrozenParameter(a=1), id_generator.get_parameter('1'))
+
+    def test_flush_in_batches(self):
+        id_generator = self._id_generator()
+        id_generator.flush_interval = 2
+        for i in range(3):
+            id_generator.get_id(Parameter(a=i))
+
+        self.assertEqual(2, len(self._id_generator()))
+
+    def test_save_merges_log(self):
+        id_generator = self._id_generator()
+        id_generator.get_id(Parameter(a=0))
+        id_generator.get_id(Parameter(a=1))
+        id_generator.save(background=True)
+        id_generator.get_id(Parameter(a=2))
+        id_generator.flush()
+
+        self.assertEqual(
+            [{'a': 0}, {'a': 1}], pickle.load(open(self.path, 'rb')))
+        self.assertEqual(3, len(self._id_generator()))
+
+    def test_truncate_broken_log(self):
+        id_generator = self._id_generator()
+        id_generator.get_id(Parameter(a=0))
+        id_generator.flush()
+        with open(self.path + '.log', 'ab') as f:
+            f.write(pickle.dumps([('1', {'a': 1})], 2)[:-3])
+
+        id_generator = self._id_generator()
+        self.assertEqual(1, len(id_generator))
+        self.assertEqual('1', id_generator.get_id(Parameter(a=2)))
+        id_generator.flush()
+        self.assertEqual(
+            FrozenParameter(a=2), self._id_generator().get_parameter('1'))
+
+    def test_share_table_among_processes(self):
+        processes = [
+            multiprocessing.Process(
+                target=_generate_ids, args=(self.path, self.text_path, i))
+            for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(0, process.exitcode)
+
+        id_generator = self._id_generator()
+        self.assertEqual(40, len(id_generator))
+        ids = set(id_generator.get_id(Parameter(a=i)) for i in range(40))
+        self.assertEqual(set(str(i) for i in range(40)), ids)
+
+        table = pickle.load(open(self.path, 'rb'))
+        self.assertEqual(40, len(table))
+        for i, dict_param in enumerate(table):
+            self.assertEqual(str(i), id_generator.get_id(Parameter(dict_param)))
+
+    def _id_generator(self):
+        return ParameterIdGenerator(self.path, self.text_path)
+
+
+def _generate_ids(path, text_path, offset):
+    # Processes generate ids of overlapping parameters in different orders.
+    id_generator = ParameterIdGenerator(path, text_path)
+    for i in range(30):
+        id_generator.get_id(Parameter(a=(i * 7 + offset * 10) % 40))
+        if i % 3 == 0:
+            id_generator.flush()
+    id_generator.save()
+
+
+class _SlowCompactionIdGenerator(ParameterIdGenerator):
+    def _compact(self):
+        lock = maflib.core._open_locked_file(self.lock_path)
+        time.sleep(0.5)
+        lock.close()
+
+
+class _PoolContext(object):
+    def __init__(self, id_generator):
+        self._parameter_id_generator = id_generator
+        self._experiment_graph = ExperimentGraph()
+        self._experiment_graph.add_call_object(CallObject(
+            source='a', target='b', process_pool=True))
+        self.jobs = 2
+
+
+class TestProcessPool(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lock_is_free_after_compaction(self):
+        path = os.path.join(self.tmpdir, 'id_table')
+        id_generator = _SlowCompactionIdGenerator(path, path + '.tsv')
+        id_generator.get_id(Parameter(a=0))
+        id_generator.save(background=True)
+
+        pool = ExperimentContext._create_process_pool.__func__(
+            _PoolContext(id_generator))
+        try:
+            id_generator._wait_compaction()
+            with open(id_generator.lock_path, 'a') as f:
+                # Raises IOError if a worker holds the lock.
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class TestExpansionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.id_table_path = os.path.join(self.tmpdir, 'id_table')
+        self.id_table_text_path = os.path.join(self.tmpdir, 'id_table.tsv')
+        self.cache_path = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_after_save(self):
+        tasks = [([FrozenParameter(a=1), FrozenParameter()],
+                  FrozenParameter(a=1, b=2))]
+        self._save(tasks)
+
+        cache = self._cache(self._id_generator())
+        self.assertEqual(tasks, cache.get('key'))
+        self.assertIsNone(cache.get('unknown'))
+
+    def test_discard_on_id_table_removal(self):
+        self._save([([FrozenParameter(a=1)], FrozenParameter(a=1, b=2))])
+        os.remove(self.id_table_path)
+
+        self.assertIsNone(self._cache(self._id_generator()).get('key'))
+
+    def test_discard_on_id_table_regrowth(self):
+        self._save([([FrozenParameter(a=1)], FrozenParameter(a=1, b=2))])
+        os.remove(self.id_table_path)
+        # A new table grows as large as the old one by an execution that
+        # stops before saving the cache.
+        id_generator = self._id_generator()
+        self._cache(id_generator)
+        id_generator.get_id(FrozenParameter(a=2))
+        id_generator.get_id(FrozenParameter(a=2, b=2))
+        id_generator.save()
+
+        self.assertIsNone(self._cache(self._id_generator()).get('key'))
+
+    def test_save_only_used_entries(self):
+        self._save([([], FrozenParameter(a=1))])
+        self._cache(self._id_generator()).save()
+
+        self.assertIsNone(self._cache(self._id_generator()).get('key'))
+
+    def test_expansion_key(self):
+        co1 = CallObject(source='a', target='b', parameters=[{'x': 1}])
+        co2 = CallObject(source='a', target='b', parameters=[{'x': 2}])
+        key1 = maflib.core._get_expansion_key(co1, [['k']])
+        self.assertEqual(key1, maflib.core._get_expansion_key(co1, [['k']]))
+        self.assertNotEqual(key1, maflib.core._get_expansion_key(co2, [['k']]))
+        self.assertNotEqual(key1, maflib.core._get_expansion_key(co1, [['l']]))
+        self.assertIsNone(maflib.core._get_expansion_key(co1, [[None]]))
+
+    def _save(self, tasks):
+        id_generator = self._id_generator()
+        cache = self._cache(id_generator)
+        cache.set('key', tasks)
+        id_generator.save()
+        cache.save()
+
+    def _id_generator(self):
+        return ParameterIdGenerator(
+            self.id_table_path, self.id_table_text_path)
+
+    def _cache(self, id_generator):
+        return ExpansionCache(self.cache_path, id_generator)
+
+
+class TestInputSignatureCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmpdir, 'cache')
+        self.data_path = os.path.join(self.tmpdir, 'data')
+        self._write('abc')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_signature_of_content(self):
+        cache = InputSignatureCache(self.cache_path)
+        self.assertEqual(waflib.Utils.h_file(self.data_path),
+                         cache.get_signature(self.data_path))
+
+    def test_trust_unchanged_stat(self):
+        self._save_signature()
+        # Same size and modification time
+        self._write('xyz')
+        cache = InputSignatureCache(self.cache_path)
+        self.assertEqual(self._h('abc'), cache.get_signature(self.data_path))
+
+    def test_rehash_on_stat_change(self):
+        self._save_signature()
+        self._write('abcd')
+        cache = InputSignatureCache(self.cache_path)
+        self.assertEqual(self._h('abcd'), cache.get_signature(self.data_path))
+
+    def test_verify(self):
+        self._save_signature()
+        self._write('xyz')
+        cache = InputSignatureCache(self.cache_path, verify=True)
+        self.assertEqual(self._h('xyz'), cache.get_signature(self.data_path))
+
+    def test_not_cache_recently_modified_file(self):
+        cache = InputSignatureCache(self.cache_path)
+        with open(self.data_path, 'w') as f:
+            f.write('abc')
+        cache.get_signature(self.data_path)
+        cache.save()
+        with open(self.data_path, 'w') as f:
+            f.write('xyz')
+
+        cache = InputSignatureCache(self.cache_path)
+        self.assertEqual(self._h('xyz'), cache.get_signature(self.data_path))
+
+    def _save_signature(self):
+        cache = InputSignatureCache(self.cache_path)
+        cache.get_signature(self.data_path)
+        cache.save()
+
+    def _write(self, content):
+        with open(self.data_path, 'w') as f:
+            f.write(content)
+        os.utime(self.data_path, (1000000000, 1000000000))
+
+    def _h(self, content):
+        return hashlib.md5(content).digest()
+
+
+class TestTaskRuntimeHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'runtimes')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_predict(self):
+        history = TaskRuntimeHistory(self.path)
+        self.assertEqual(0, history.predict(('train', '0')))
+        history.record(('train', '0'), 1.0)
+        history.record(('train', '1'), 2.0)
+        history.record(('train', '1'), 5.0)
+        self.assertEqual(5.0, history.predict(('train', '1')))
+        self.assertEqual(3.0, history.predict(('train', '2')))
+        self.assertEqual(0, history.predict(('test', '0')))
+
+    def test_save(self):
+        history = TaskRuntimeHistory(self.path)
+        history.record(('train', '0'), 1.0)
+        history.save()
+        history = TaskRuntimeHistory(self.path)
+        self.assertEqual(1.0, history.predict(('train', '0')))
+        self.assertEqual(1.0, history.predict(('train', '1')))
+
+
+class TestResultStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = ResultStore(os.path.join(self.tmpdir, 'a', '.maf_results'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _record(self, parameter_id, content):
+        path = os.path.join(self.tmpdir, parameter_id + '-a')
+        with open(path, 'w') as f:
+            f.write(content)
+        self.store.record(parameter_id, path)
+        return os.stat(path)
+
+    def test_record_and_read(self):
+        st = self._record('0', '{"x": 1, "y": 0.5}')
+        self._record('1', '[{"x": 2, "z": "a"}, {"x": 3}]')
+        results = self.store.read()
+        self.assertEqual((st.st_size, st.st_mtime, [{'x': 1, 'y': 0.5}]),
+                         results['0'])
+        self.assertEqual([{'x': 2, 'z': 'a'}, {'x': 3}], results['1'][2])
+
+    def test_types(self):
+        value = {'int': 1, 'float': 1.0, 'str': u'\u3042', 'true': True,
+                 'null': None, 'list': [1, {'a': 2}], 'long': 2 ** 70,
+                 'id': 'x', 'a"b': 1}
+        self._record('0', json.dumps(value))
+        result = self.store.read()['0'][2][0]
+        self.assertEqual(value, result)
+        self.assertIsInstance(result['float'], float)
+        self.assertIs(result['true'], True)
+
+    def test_read_parameter_ids(self):
+        for i in range(3):
+            self._record(str(i), '{"x": %d}' % i)
+        results = self.store.read(['2', '0', '5'])
+        self.assertEqual(['0', '2'], sorted(results))
+        self.assertEqual([{'x': 2}], results['2'][2])
+
+    def test_keys_differing_in_case(self):
+        self._record('0', '{"a": 1, "A": 2}')
+        self._record('1', '{"A": 3}')
+        results = self.store.read()
+        self.assertEqual([{'a': 1, 'A': 2}], results['0'][2])
+        self.assertEqual([{'A': 3}], results['1'][2])
+
+    def test_columns_added_by_another_store(self):
+        other = ResultStore(self.store.path)
+        try:
+            self._record('0', '{"x": 1}')
+            path = os.path.join(self.tmpdir, 'other')
+            with open(path, 'w') as f:
+                f.write('{"x": 2, "y": 3}')
+            other.record('1', path)
+        finally:
+            other.close()
+        self._record('2', '{"y": 4, "x": 5}')
+        self.assertEqual([{'x': 2, 'y': 3}], self.store.get('1')[2])
+        self.assertEqual([{'x': 5, 'y': 4}], self.store.read()['2'][2])
+
+    def test_rerecord(self):
+        self._record('0', '[{"x": 1}, {"x": 2}]')
+        self._record('0', '{"y": 1}')
+        self.assertEqual([{'y': 1}], self.store.read()['0'][2])
+        self._record('0', 'not json')
+        self.assertEqual({}, self.store.read())
+
+    def test_read_nonexistent_store(self):
+        self.assertEqual({}, self.store.read())
+
+
+class TestCriticalPathScheduler(unittest.TestCase):
+    class Task(object):
+        def __init__(self, name, runtime, run_after=(), cpus=1, memory=0):
+            self.name = name
+            self.runtime = runtime
+            self.run_after = set(run_after)
+            self.hasrun = 0
+            self.cpus = cpus
+            self.memory = memory
+
+    class Scheduler(CriticalPathScheduler):
+        def _predict(self, tsk):
+            return tsk.runtime
+
+    def test_order_by_critical_path(self):
+        a = self.Task('a', 1.0)
+        b = self.Task('b', 5.0, [a])
+        c = self.Task('c', 4.0)
+        d = self.Task('d', 2.0)
+        scheduler = self.Scheduler(None, 2, None)
+        scheduler._add_tasks([d, c, b, a])
+
+        self.assertEqual(['a', 'c', 'd'], self._pop_all(scheduler))
+        scheduler._release(a)
+        self.assertEqual(['b'], self._pop_all(scheduler))
+
+    def test_backfill(self):
+        big = self.Task('big', 10.0, cpus=4)
+        short = self.Task('short', 1.0, cpus=2)
+        long = self.Task('long', 3.0, cpus=2)
+        scheduler = self.Scheduler(None, 4, None)
+        scheduler._add_tasks([big, long, short])
+        self._run(scheduler, self.Task('running', 2.0, cpus=2))
+
+        # big is reserved after 2 seconds, and only short finishes before.
+        self.assertEqual('short', scheduler._pop_ready().name)
+        self._run(scheduler, short)
+        self.assertIsNone(scheduler._pop_ready())
+
+    def test_memory(self):
+        a = self.Task('a', 2.0, memory=6)
+        b = self.Task('b', 1.0, memory=6)
+        c = self.Task('c', 1.0, memory=20)
+        scheduler = self.Scheduler(None, 4, None, memory=10)
+        scheduler._add_tasks([a, b, c])
+
+        self.assertEqual('a', scheduler._pop_ready().name)
+        self._run(scheduler, a)
+        self.assertIsNone(scheduler._pop_ready())
+
+        # Task demanding more than available memory runs alone.
+        del scheduler._running[a]
+        scheduler._used_cpus = scheduler._used_memory = 0
+        self.assertEqual('b', scheduler._pop_ready().name)
+        self.assertEqual((1, 10), scheduler._get_demand(c))
+
+    def _run(self, scheduler, tsk):
+        demand = scheduler._get_demand(tsk)
+        scheduler._running[tsk] = (time.time() + tsk.runtime, demand)
+        scheduler._used_cpus += demand[0]
+        scheduler._used_memory += demand[1]
+
+    def _pop_all(self, scheduler):
+        names = []
+        while scheduler._ready:
+            names.append(scheduler._pop_ready().name)
+        return names
+
+
+def _serve(address, authkey, slots, heartbeat_interval):
+    # Worker process of TestCoordinator.
+    worker = Worker(slots)
+    worker.heartbeat_interval = heartbeat_interval
+    try:
+        worker.serve(
+            multiprocessing.connection.Client(address, authkey=authkey))
+    finally:
+        worker.close()
+
+
+def _get_worker_pid(seconds):
+    time.sleep(seconds)
+    return os.getppid()
+
+
+def _fail():
+    raise ValueError('broken job')
+
+
+def _exit():
+    sys.exit(1)
+
+
+def _kill():
+    os._exit(1)
+
+
+class _Coordinator(Coordinator):
+    heartbeat_timeout = 1.0
+
+
+class TestCoordinator(unittest.TestCase):
+    def setUp(self):
+        waflib.Logs.init_log()
+        waflib.Logs.log.setLevel(logging.ERROR)
+        self.coordinator = _Coordinator(('localhost', 0))
+        self.workers = []
+
+    def tearDown(self):
+        self.coordinator.close()
+        for worker in self.workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGCONT)
+                worker.terminate()
+            worker.join()
+
+    def test_apply(self):
+        worker = self._start_worker(2)
+        applications = [self._apply(_get_worker_pid, (0.1,))
+                        for _ in range(4)]
+        for thread, results in applications:
+            thread.join()
+            self.assertEqual([worker.pid], results)
+
+    def test_propagate_error(self):
+        self._start_worker(1)
+        with self.assertRaises(RuleProcessException) as context:
+            self.coordinator.apply(_fail)
+        self.assertIn('ValueError: broken job', str(context.exception))
+
+    def test_requeue_on_disconnection(self):
+        dead_worker = self._start_worker(1)
+        thread, results = self._apply(_get_worker_pid, (0.5,))
+        self._wait_for_running_job()
+        dead_worker.terminate()
+
+        worker = self._start_worker(1)
+        thread.join()
+        self.assertEqual([worker.pid], results)
+
+    def test_requeue_on_missing_heartbeats(self):
+        hung_worker = self._start_worker(1)
+        thread, results = self._apply(_get_worker_pid, (0.5,))
+        self._wait_for_running_job()
+        os.kill(hung_worker.pid, signal.SIGSTOP)
+
+        worker = self._start_worker(1)
+        thread.join()
+        self.assertEqual([worker.pid], results)
+
+    def test_fill_slots(self):
+        worker = self._start_worker(2)
+        thread, results = self._apply(_get_worker_pid, (0.5,), cpus=2)
+        self._wait_for_running_job()
+        self.assertEqual(0, self.coordinator._workers[0].free())
+        thread.join()
+        self.assertEqual([worker.pid], results)
+
+    def _start_worker(self, slots):
+        worker = multiprocessing.Process(target=_serve, args=(
+            self.coordinator.address, self.coordinator.authkey, slots, 0.1))
+        worker.start()
+        self.workers.append(worker)
+        return worker
+
+    def _apply(self, func, args, cpus=1):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.coordinator.apply(func, args, cpus)))
+        thread.start()
+        return thread, results
+
+    def _wait_for_running_job(self):
+        while not any(worker.jobs for worker in self.coordinator._workers):
+            time.sleep(0.01)
+
+
+class _CountingQueue(BatchQueue):
+    poll_interval = 0.01
+    max_batch_size = 3
+
+    def __init__(self):
+        self.results = {}
+        self.batch_sizes = []
+        self.max_outstanding = 0
+        self._job_ids = itertools.count()
+
+    def submit(self, jobs):
+        self.batch_sizes.append(len(jobs))
+        job_ids = []
+        for func, args in jobs:
+            job_ids.append(next(self._job_ids))
+            self.results[job_ids[-1]] = func(*args)
+        self.max_outstanding = max(self.max_outstanding, len(self.results))
+        return job_ids
+
+    def poll(self, job_ids):
+        # One job finishes at each poll.
+        job_id = min(job_ids)
+        return {job_id: (True, self.results.pop(job_id))}
+
+
+class TestBatchSubmitter(unittest.TestCase):
+    def test_submit(self):
+        queue = _CountingQueue()
+        submitter = BatchSubmitter(queue, 4)
+        results = []
+        done = threading.Event()
+        def callback(succeeded, value):
+            results.append(value)
+            if len(results) == 10:
+                done.set()
+        for i in range(10):
+            submitter.submit(abs, (-i,), callback)
+        done.wait(10)
+        submitter.close()
+
+        self.assertEqual(range(10), sorted(results))
+        self.assertEqual(4, queue.max_outstanding)
+        self.assertLessEqual(max(queue.batch_sizes), 3)
+        self.assertEqual(0, len(submitter))
+
+    def test_submission_error(self):
+        queue = _CountingQueue()
+        queue.submit = lambda jobs: 1 / 0
+        submitter = BatchSubmitter(queue, 4)
+        results = []
+        done = threading.Event()
+        submitter.submit(abs, (1,), lambda succeeded, value: (
+            results.append((succeeded, value)), done.set()))
+        done.wait(10)
+        submitter.close()
+
+        self.assertFalse(results[0][0])
+        self.assertIn('ZeroDivisionError', results[0][1])
+
+
+def _run_spool(path, slots):
+    # Spool runner process of TestFileSpoolQueue.
+    runner = SpoolRunner(FileSpoolQueue(path), slots)
+    runner.poll_interval = 0.01
+    try:
+        runner.serve(0.5)
+    finally:
+        runner.close()
+
+
+class TestFileSpoolQueue(unittest.TestCase):
+    def setUp(self):
+        waflib.Logs.init_log()
+        waflib.Logs.log.setLevel(logging.ERROR)
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_run_jobs(self):
+        queue = FileSpoolQueue(self.path)
+        job_ids = queue.submit([(abs, (-i,)) for i in range(5)] +
+                               [(_fail, ())])
+        runners = [multiprocessing.Process(target=_run_spool,
+                                           args=(self.path, 2))
+                   for _ in range(2)]
+        for runner in runners:
+            runner.start()
+
+        results = {}
+        while len(results) < len(job_ids):
+            results.update(queue.poll(job_ids))
+            time.sleep(0.01)
+        for runner in runners:
+            runner.join()
+
+        self.assertEqual([(True, i) for i in range(5)],
+                         [results[job_id] for job_id in job_ids[:5]])
+        succeeded, error = results[job_ids[5]]
+        self.assertFalse(succeeded)
+        self.assertIn('ValueError: broken job', error)
+        for name in ['queue', 'running', 'done']:
+            self.assertEqual([], os.listdir(os.path.join(self.path, name)))
+
+    def test_lost_jobs(self):
+        queue = FileSpoolQueue(self.path)
+        job_ids = queue.submit([(_exit, ()), (_kill, ())])
+        _run_spool(self.path, 2)
+        results = queue.poll(job_ids)
+
+        self.assertIn('SystemExit', results[job_ids[0]][1])
+        self.assertEqual((False, 'job process exited with code 1'),
+                         results[job_ids[1]])
+        self.assertEqual([], os.listdir(os.path.join(self.path, 'running')))
+
+    def test_expired_lease(self):
+        queue = FileSpoolQueue(self.path)
+        queue.max_retries = 1
+        job_id, = queue.submit([(abs, (1,))])
+        running = os.path.join(self.path, 'running', job_id + '@dead-1')
+        os.rename(os.path.join(self.path, 'queue', job_id), running)
+        self.assertEqual({}, queue.poll([job_id]))
+
+        # The lease expires, and the job is queued again.
+        os.utime(running, (0, 0))
+        self.assertEqual({}, queue.poll([job_id]))
+        self.assertEqual([job_id],
+                         os.listdir(os.path.join(self.path, 'queue')))
+
+        # The job is lost again and fails.
+        os.rename(os.path.join(self.path, 'queue', job_id), running)
+        os.utime(running, (0, 0))
+        self.assertEqual({job_id: (False, 'job was lost by 2 runners')},
+                         queue.poll([job_id]))
+        self.assertEqual([], os.listdir(os.path.join(self.path, 'running')))
+
+    def test_cancel(self):
+        queue = FileSpoolQueue(self.path)
+        job_ids = queue.submit([(abs, (1,))])
+        queue.cancel(job_ids)
+        self.assertEqual([], os.listdir(os.path.join(self.path, 'queue')))
+
+
+class TestParseMemory(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(1024, parse_memory(1024))
+        self.assertEqual(1024, parse_memory('1024'))
+        self.assertEqual(512 << 20, parse_memory('512M'))
+        self.assertEqual(3 << 29, parse_memory('1.5G'))
+        self.assertEqual(8 << 30, parse_memory('8gb'))
+
+
 class TestCallObject(unittest.TestCase):
     def test_listize_source(self):
         self._test_listize('source')
@@ -144,6 +933,13 @@ class TestCallObject(unittest.TestCase):
         co = CallObject()
         self.assertListEqual([Parameter()], co.parameters)
 
+    def test_iterable_parameters(self):
+        # Iterables other than lists are iterated when the call object is
+        # expanded.
+        parameters = ({ 'a': i } for i in range(2))
+        co = CallObject(parameters=parameters)
+        self.assertIs(parameters, co.parameters)
+
     def test_features_experiment(self):
         co = CallObject()
         self.assertIn('experiment', co.features)
@@ -162,6 +958,357 @@ class TestCallObject(unittest.TestCase):
                 self.assertIn(q, getattr(co, key))
 
 
+class TestRule(unittest.TestCase):
+    def test_dependson_not_shared(self):
+        rule1 = Rule(lambda task: None)
+        rule2 = Rule(lambda task: None)
+        self.assertEqual(1, len(rule1.dependson))
+        self.assertEqual(1, len(rule2.dependson))
+
+    def test_stred_dependson(self):
+        rule = Rule(lambda task: None, dependson=['x', 1])
+        stred = rule.stred_dependson()
+        self.assertEqual(['x', '1'], stred[:2])
+        self.assertEqual(get_fingerprint(rule.fun), stred[2])
+
+
+class TestRuleTask(unittest.TestCase):
+    def _create_task(self):
+        task = maflib.test.TestTask()
+        task.inputs = [ExperimentNode()]
+        task.outputs = [ExperimentNode()]
+        task.env.source_parameter = [Parameter({'a': 1})]
+        task.parameter = Parameter({'a': 1, 'b': 0.1})
+        task.cpus = 2
+        task.memory = 1024
+        return task
+
+    def test_pickle(self):
+        task = self._create_task()
+        task.inputs[0].write('input')
+
+        copied = pickle.loads(pickle.dumps(RuleTask(task)))
+        self.assertEqual('input', copied.inputs[0].read())
+        copied.outputs[0].write('output')
+        self.assertEqual('output', task.outputs[0].read())
+        self.assertEqual({'a': 1}, copied.env.source_parameter[0])
+        self.assertEqual([], copied.env.UNDEFINED)
+        self.assertEqual(task.parameter, copied.parameter)
+        self.assertEqual(2, copied.cpus)
+        self.assertEqual(1024, copied.memory)
+
+    def test_run_rule(self):
+        def rule(task):
+            task.outputs[0].write(task.inputs[0].read() + '!')
+        maflib.core._rules.append(rule)
+        task = self._create_task()
+        task.inputs[0].write('input')
+
+        ret, error = maflib.core._run_rule(
+            len(maflib.core._rules) - 1, RuleTask(task))
+        self.assertIsNone(ret)
+        self.assertIsNone(error)
+        self.assertEqual('input!', task.outputs[0].read())
+
+    def test_run_failing_rule(self):
+        def rule(task):
+            raise ValueError('broken rule')
+        maflib.core._rules.append(Rule(rule))
+
+        ret, error = maflib.core._run_rule(
+            len(maflib.core._rules) - 1, RuleTask(self._create_task()))
+        self.assertIn('ValueError: broken rule', error)
+
+
+class TestFingerprint(unittest.TestCase):
+    def test_ignore_comments_and_blank_lines(self):
+        f1 = self._define('def f(task):\n    return task + 1\n')
+        f2 = self._define(
+            '\n# comment\ndef f(task):\n\n    # comment\n    return task + 1\n')
+        self.assertEqual(get_fingerprint(f1), get_fingerprint(f2))
+
+    def test_code_change(self):
+        f1 = self._define('def f(task):\n    return task + 1\n')
+        f2 = self._define('def f(task):\n    return task - 1\n')
+        f3 = self._define('def f(task):\n    return task + 2\n')
+        self.assertNotEqual(get_fingerprint(f1), get_fingerprint(f2))
+        self.assertNotEqual(get_fingerprint(f1), get_fingerprint(f3))
+
+    def test_global_change(self):
+        f1 = self._define('y = 1\ndef f(task):\n    return task + y\n')
+        f2 = self._define('y = 2\ndef f(task):\n    return task + y\n')
+        self.assertNotEqual(get_fingerprint(f1), get_fingerprint(f2))
+
+    def test_referenced_function_change(self):
+        f1 = self._define(
+            'def g(x):\n    return x\ndef f(task):\n    return g(task)\n')
+        f2 = self._define(
+            'def g(x):\n    return -x\ndef f(task):\n    return g(task)\n')
+        self.assertNotEqual(get_fingerprint(f1), get_fingerprint(f2))
+
+    def test_closure_change(self):
+        def make(key):
+            def body(task):
+                return task[key]
+            return body
+        self.assertEqual(get_fingerprint(make('a')), get_fingerprint(make('a')))
+        self.assertNotEqual(
+            get_fingerprint(make('a')), get_fingerprint(make('b')))
+
+    def test_nested_function(self):
+        f1 = self._define(
+            'y = 1\ndef f(task):\n    return map(lambda x: x + y, task)\n')
+        f2 = self._define(
+            'y = 2\ndef f(task):\n    return map(lambda x: x + y, task)\n')
+        self.assertNotEqual(get_fingerprint(f1), get_fingerprint(f2))
+
+    def test_recursive_function(self):
+        f = self._define(
+            'def f(n):\n    return 1 if n == 0 else n * f(n - 1)\n')
+        self.assertEqual(40, len(get_fingerprint(f)))
+
+    def test_callable_object(self):
+        class Callable(object):
+            def __init__(self, n):
+                self.n = n
+                self.this = self
+
+            def __call__(self, task):
+                return task * self.n
+        self.assertEqual(get_fingerprint(Callable(1)),
+                         get_fingerprint(Callable(1)))
+        self.assertNotEqual(get_fingerprint(Callable(1)),
+                            get_fingerprint(Callable(2)))
+
+    def test_recursive_container(self):
+        f = self._define('L = [1]\nL.append(L)\ndef f():\n    return L\n')
+        g = self._define('L = [2]\nL.append(L)\ndef f():\n    return L\n')
+        self.assertNotEqual(get_fingerprint(f), get_fingerprint(g))
+
+    def _define(self, source):
+        namespace = {}
+        exec(source, namespace)
+        return namespace['f']
+
+
+class TestPromotedParameters(unittest.TestCase):
+    def test_promote_best(self):
+        call_object = CallObject(parameters=[
+            {'x': x, 'pass': 1} for x in range(9)])
+        results = [(FrozenParameter({'x': x, 'pass': 1}), {'v': -abs(x - 4)})
+                   for x in range(9)]
+        promoted = PromotedParameters(
+            [(call_object, 'result')], 'pass', 3, 'v', 3, True)
+        self.assertEqual(
+            [{'x': 4, 'pass': 3}, {'x': 3, 'pass': 3}, {'x': 5, 'pass': 3}],
+            promoted.evaluate(lambda node: results))
+
+    def test_promote_minimum(self):
+        call_object = CallObject(parameters=[
+            {'x': x, 'pass': 1} for x in range(4)])
+        results = [(FrozenParameter({'x': x, 'pass': 1}), {'v': x})
+                   for x in range(4)]
+        promoted = PromotedParameters(
+            [(call_object, 'result')], 'pass', 3, 'v', 2, False)
+        self.assertEqual([{'x': 0, 'pass': 3}, {'x': 1, 'pass': 3}],
+                         promoted.evaluate(lambda node: results))
+
+    def test_average_results(self):
+        # Results of downstream parameters and lists of results are averaged.
+        call_object = CallObject(parameters=[
+            {'x': x, 'pass': 1} for x in range(4)])
+        results = []
+        for x in range(4):
+            for fold in range(2):
+                results.append(
+                    (FrozenParameter({'x': x, 'pass': 1, 'fold': fold}),
+                     [{'v': x * fold}, {'v': 1}]))
+        promoted = PromotedParameters(
+            [(call_object, 'result')], 'pass', 3, 'v', 4, True)
+        self.assertEqual([{'x': 3, 'pass': 3}],
+                         promoted.evaluate(lambda node: results))
+
+    def test_merge_rungs(self):
+        rungs = []
+        results = {}
+        for i in range(2):
+            call_object = CallObject(parameters=[
+                {'x': x, 'pass': i} for x in range(3)])
+            rungs.append((call_object, i))
+            results[i] = [(FrozenParameter({'x': x, 'pass': i}),
+                           {'v': x * (1 - 2 * i)}) for x in range(3)]
+        promoted = PromotedParameters(rungs, 'pass', 9, 'v', 3, True)
+        promoted.parameters.append({'x': 5, 'pass': 9})
+        self.assertEqual(
+            [{'x': 5, 'pass': 9}, {'x': 2, 'pass': 9}, {'x': 0, 'pass': 9}],
+            promoted.evaluate(results.get))
+
+
+class TestProposedParameters(unittest.TestCase):
+    def test_pass_observations(self):
+        rounds = []
+        results = {}
+        for i in range(2):
+            call_object = CallObject(parameters=[
+                {'x': i * 2 + j} for j in range(2)])
+            rounds.append((call_object, i))
+            # Results of the second parameter of the last round are missing.
+            results[i] = [(FrozenParameter({'x': i * 2 + j, 'y': 0}),
+                           {'v': i * 2 + j}) for j in range(2 - i)]
+
+        observations = []
+        def sampler(num_samples, o):
+            observations.extend(o)
+            return [{'x': 5}] * num_samples
+
+        proposed = ProposedParameters(rounds, sampler, 2, 'v', False)
+        self.assertEqual([0, 1], proposed.nodes)
+        self.assertEqual([{'x': 5}], proposed.evaluate(results.get))
+        self.assertEqual([({'x': 0}, 0.0), ({'x': 1}, -1.0), ({'x': 2}, -2.0)],
+                         observations)
+
+    def test_drop_parameters_already_run(self):
+        call_object = CallObject(parameters=[{'x': 0}, {'x': 1}])
+        results = {0: [(FrozenParameter({'x': 0}), {'v': 0})]}
+        # The sampler repeats parameters of the former round, including one
+        # without its result.
+        sampler = lambda num_samples, o: [{'x': 1}, {'x': 2}, {'x': 0}]
+
+        proposed = ProposedParameters([(call_object, 0)], sampler, 3, 'v',
+                                      True)
+        self.assertEqual([{'x': 2}], proposed.evaluate(results.get))
+
+
+class _NodeTable(object):
+    def __init__(self, nodes):
+        self._nodes = nodes
+
+
+class _LevelTask(object):
+    def __init__(self):
+        self.run_after = set()
+
+    def hash_constraints(self):
+        return 0
+
+
+class _LazyContext(object):
+    # Context expanding each call object, given as a number of tasks, in the
+    # current group.
+    def __init__(self, levels):
+        self._levels = levels
+        self._num_lazy_tasks = 0
+        self.groups = []
+        self.current_group = 0
+        self.returned_tasks = []
+
+    def add_group(self):
+        self.groups.append([])
+        self.current_group = len(self.groups) - 1
+
+    def _process_call_object(self, num_tasks):
+        self.groups[self.current_group] += [
+            _LevelTask() for _ in range(num_tasks)]
+
+    def post_group(self):
+        pass
+
+    def get_tasks_group(self, index):
+        return list(self.groups[index])
+
+
+class TestLazyBuildIterator(unittest.TestCase):
+    def test_total_counts_former_levels(self):
+        context = _LazyContext([[3, 2], [1], [0], [4]])
+        biter = ExperimentContext._get_lazy_build_iterator.__func__(context)
+        processed = 0
+        for _ in range(3):
+            processed += len(next(biter))
+            self.assertLessEqual(
+                processed, ExperimentContext.total.__func__(context))
+        self.assertEqual([], next(biter))
+        self.assertEqual(10, ExperimentContext.total.__func__(context))
+
+
+class TestGenerateTasks(unittest.TestCase):
+    def _generate(self, nodes, empty_nodes, source):
+        context = _NodeTable(collections.defaultdict(set, nodes))
+        context._empty_nodes = set(empty_nodes)
+        call_object = CallObject(source=source, target='z',
+                                 parameters=[{'p': 0}])
+        call_object.parameters = [FrozenParameter(p)
+                                  for p in call_object.parameters]
+        return ExperimentContext._generate_tasks.__func__(
+            context, call_object)
+
+    def test_physical_source(self):
+        self.assertEqual(
+            [([{}, {'a': 1}], {'a': 1, 'p': 0})],
+            self._generate({'y': {FrozenParameter(a=1)}}, [], 'x y'))
+
+    def test_empty_meta_source(self):
+        self.assertEqual([], self._generate(
+            {'y': {FrozenParameter(a=1)}}, ['x'], 'x y'))
+
+
+class TestAggregationTasks(unittest.TestCase):
+    def setUp(self):
+        self.context = _NodeTable({'x': [
+            FrozenParameter(a=1, b=1), FrozenParameter(a=1, b=2),
+            FrozenParameter(a=2, b=1), FrozenParameter(a=1, b=2, c=0),
+            FrozenParameter(a=1)]})
+
+    def _generate(self, key_type, **kw):
+        call_object = CallObject(source='x', target='y', **kw)
+        return ExperimentContext._generate_aggregation_tasks.__func__(
+            self.context, call_object, key_type)
+
+    def test_for_each(self):
+        self.context._nodes['x'].pop()
+        self.assertEqual([
+            ([{'a': 1, 'b': 1}, {'a': 1, 'b': 2}, {'a': 1, 'b': 2, 'c': 0}],
+             {'a': 1}),
+            ([{'a': 2, 'b': 1}], {'a': 2}),
+        ], self._generate('for_each', for_each='a'))
+
+    def test_for_each_missing_key(self):
+        self.assertRaises(KeyError, self._generate, 'for_each', for_each='b')
+
+    def test_aggregate_by(self):
+        self.assertEqual([
+            ([{'a': 1, 'b': 1}, {'a': 1, 'b': 2}, {'a': 1}], {'a': 1}),
+            ([{'a': 2, 'b': 1}], {'a': 2}),
+            ([{'a': 1, 'b': 2, 'c': 0}], {'a': 1, 'c': 0}),
+        ], self._generate('aggregate_by', aggregate_by='b'))
+
+    def test_aggregate_by_all_keys(self):
+        tasks = self._generate('aggregate_by', aggregate_by='a b c')
+        self.assertEqual([(self.context._nodes['x'], {})], tasks)
+
+
+class TestPhysicalCallObject(unittest.TestCase):
+    def test_template_excludes_meta_arguments(self):
+        co = CallObject(source='a', target='b', for_each='x', rule='cp',
+                        parameters=[{'x': 1}, {'x': 2}])
+        template = PhysicalCallObject.create_template(co)
+        self.assertNotIn('parameters', template)
+        self.assertNotIn('for_each', template)
+        self.assertEqual('cp', template['rule'])
+
+    def test_share_template(self):
+        co = CallObject(source='a', target='b', rule='cp')
+        template = PhysicalCallObject.create_template(co)
+        p1 = PhysicalCallObject(template, ['a/0-a'], ['b/0-b'])
+        p2 = PhysicalCallObject(template, ['a/1-a'], ['b/1-b'])
+
+        self.assertIs(p1.features, p2.features)
+        self.assertEqual('cp', p1.rule)
+        self.assertEqual(['a/1-a'], p2.to_kwargs()['source'])
+        self.assertEqual(['b/1-b'], p2.to_kwargs()['target'])
+        self.assertEqual(['a'], co.source)
+        self.assertRaises(AttributeError, lambda: p1.aggregate_by)
+
+
 class TestExperimentGraph(unittest.TestCase):
     def test_empty_graph(self):
         g = ExperimentGraph()
@@ -234,6 +1381,34 @@ class TestExperimentGraph(unittest.TestCase):
                  ('b', 'e')],
                 [])
 
+    def test_levels(self):
+        cos = [CallObject(source=src, target=tgt) for src, tgt in
+               [('c', 'd'), ('a', 'b'), ('x', 'c'), ('b d', 'e'), ('a', 'c')]]
+        g = ExperimentGraph()
+        for co in cos:
+            g.add_call_object(co)
+
+        levels = g.get_call_object_levels()
+        self.assertEqual(3, len(levels))
+        self.assertItemsEqual([cos[1], cos[2], cos[4]], levels[0])
+        self.assertEqual([cos[0]], levels[1])
+        self.assertEqual([cos[3]], levels[2])
+
+    def test_levels_of_promoted_parameters(self):
+        first = CallObject(source='a', target='b', parameters=[{'p': 1}])
+        result = CallObject(source='b', target='c')
+        second = CallObject(
+            source='a', target='d',
+            parameters=PromotedParameters([(first, 'c')], 'p', 3, 'v', 3,
+                                          True))
+        g = ExperimentGraph()
+        for co in (second, first, result):
+            g.add_call_object(co)
+
+        self.assertEqual([result, second], g.get_sorted_call_objects()[1:])
+        levels = g.get_call_object_levels()
+        self.assertEqual([[first], [result], [second]], levels)
+
     def _test_graph(self, edges, order):
         cos = [CallObject(source=src, target=tgt) for src, tgt in edges]
         g = ExperimentGraph()
@@ -268,6 +1443,13 @@ class TestUtility(unittest.TestCase):
         self._write_and_read(abspath)
         shutil.rmtree(".maflib_test_utility_tmp_dir_abs")
 
+    def test_shard_path(self):
+        self.assertEqual('', maflib.core._get_shard_path('12', 0))
+        path = maflib.core._get_shard_path('12', 2)
+        self.assertRegexpMatches(path, r'^[0-9a-f]{2}/[0-9a-f]{2}$')
+        self.assertEqual(path[:2], maflib.core._get_shard_path('12', 1))
+        self.assertNotEqual(path, maflib.core._get_shard_path('13', 2))
+
     def _write_and_read(self, path):
         import maflib.core
         with maflib.core._create_file(path) as f: f.write("aaa")
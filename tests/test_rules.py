@@ -34,6 +34,48 @@ class TestAggregationTask(unittest.TestCase):
         result = task.json_output(0)
         self.assertEqual(result, {"param1": 1, "key1": 5, "key2": 30})
 
+    def test_max_of_arrays(self):
+        task = TestTask()
+        task.env.source_parameter = [{"param1": 0}, {"param1": 1}]
+
+        task.set_input_by_json(0, [{"key1": 1}, {"key1": 7}])
+        task.set_input_by_json(1, [{"key1": 7}, {"key1": 3}])
+
+        rules.max("key1").fun(task)
+        self.assertEqual(task.json_output(0), {"param1": 0, "key1": 7})
+
+    def test_max_and_min_with_empty_input(self):
+        task = TestTask()
+        task.env.source_parameter = [{"p": 0}, {"p": 1}, {"p": 2}, {"p": 3}]
+
+        task.set_input_by_json(0, [])
+        task.set_input_by_json(1, {"a": 1})
+        task.set_input_by_json(2, [])
+        task.set_input_by_json(3, {"a": 3})
+
+        rules.max("a").fun(task)
+        self.assertEqual(task.json_output(0), {"p": 3, "a": 3})
+        rules.min("a").fun(task)
+        self.assertEqual(task.json_output(0), {"p": 1, "a": 1})
+
+    def test_max_of_no_input(self):
+        task = TestTask()
+        task.env.source_parameter = []
+        rules.max("key1").fun(task)
+        self.assertEqual(task.json_output(0), {})
+
+    def test_average(self):
+        task = TestTask()
+        task.env.source_parameter = [{"param1": 0}, {"param1": 1}]
+
+        task.set_input_by_json(0, [{"key1": 1, "key2": "a", "key3": 1},
+                                   {"key1": 2, "key2": "b"}])
+        task.set_input_by_json(1, {"key1": 6, "key2": "c", "key3": 2})
+
+        rules.average(task)
+        self.assertEqual(task.json_output(0), {
+            "param1": 1. / 3, "key1": 3., "key2": "a", "key3": 1})
+
 
 class MulticlassEvaluationTask(object):
     """This is dummy class for the use of a test below.
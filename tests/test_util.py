@@ -24,9 +24,159 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from maflib.util import *
-from maflib.core import Parameter
+from maflib.core import Parameter, ResultStore
+from maflib.test import TestTask
+import json
+import maflib.util
+import os
+import shutil
+import tempfile
 import unittest
 
+class TestAggregator(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = ResultStore(os.path.join(self.tmpdir, '.maf_results'))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def _aggregate(self, task):
+        @aggregator
+        def collect(values, abspath, parameter):
+            return json.dumps(values)
+        collect(task)
+        return task.json_output(0)
+
+    def _aggregate_by_streaming(self, task):
+        streaming_aggregator(
+            list, lambda s, v: s + [v], lambda s, t: s + t,
+            lambda s, p: s)(task)
+        return task.json_output(0)
+
+    def test_load_inputs_in_parallel(self):
+        task = TestTask()
+        for i in range(10):
+            task.set_input(i, json.dumps([{'x': i}] * (i % 3)))
+        task.env.source_parameter = [{'p': i} for i in range(10)]
+        expected = [{'x': i, 'p': i} for i in range(10) for _ in range(i % 3)]
+        task.env.input_loaders = 4
+        self.assertEqual(expected, self._aggregate(task))
+
+    def test_aggregate_from_result_store(self):
+        self._test_result_store(self._aggregate)
+
+    def test_stream_from_result_store(self):
+        self._test_result_store(self._aggregate_by_streaming)
+
+    def _test_result_store(self, aggregate):
+        task = TestTask()
+        task.set_input(0, '{"x": 1}')
+        task.set_input(1, '[{"x": 2}, {"x": 3}]')
+        task.env.source_parameter = [{'p': 0}, {'p': 1}]
+        path = task.inputs[0].abspath()
+        os.utime(path, (1000, 1000))
+        for node in task.inputs.list[:2]:
+            self.store.record(os.path.basename(node.abspath()),
+                              node.abspath())
+        task.env.result_store = self.store.path
+
+        # Rows in the store are used while the file looks the same.
+        task.set_input(0, '{"x": 4}')
+        os.utime(path, (1000, 1000))
+        self.assertEqual([{'x': 1, 'p': 0}, {'x': 2, 'p': 1},
+                          {'x': 3, 'p': 1}], aggregate(task))
+
+        # Modified files are read again.
+        task.set_input(1, '{"x": 5}')
+        self.assertEqual([{'x': 1, 'p': 0}, {'x': 5, 'p': 1}],
+                         aggregate(task))
+
+
+class TestStreamingAggregator(unittest.TestCase):
+    def _iter_json(self, content, chunk_size):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(content)
+            f.flush()
+            return list(maflib.util._iter_json(f.name, chunk_size))
+
+    def test_iter_json(self):
+        values = [{'x': i, 'y': 'a' * i} for i in range(20)] + [12345]
+        content = json.dumps(values, indent=1)
+        for chunk_size in (1, 3, 64, 1 << 16):
+            self.assertEqual(values, self._iter_json(content, chunk_size))
+
+    def test_iter_json_of_other_values(self):
+        self.assertEqual([{'x': 1}], self._iter_json(' {"x": 1}\n', 2))
+        self.assertEqual([], self._iter_json(' [ ] ', 2))
+        self.assertRaises(ValueError, self._iter_json, '[{"x": 1}', 2)
+        self.assertRaises(ValueError, self._iter_json, '[1 2]', 2)
+        self.assertRaises(ValueError, self._iter_json, '[1] 2', 2)
+
+    def test_fold(self):
+        task = TestTask()
+        task.set_input(0, '[{"x": 1}, {"x": 2}]')
+        task.set_input(1, '{"x": 3}')
+        task.env.source_parameter = [{'p': 0}, {'p': 1}]
+        task.parameter = {'q': object()}
+
+        def update(state, value):
+            return state + [value]
+
+        def finalize(state, parameter):
+            return [state, str(parameter['q'])[:7]]
+
+        streaming_aggregator(
+            list, update, lambda s, t: s + [t], finalize)(task)
+        self.assertEqual(
+            [[[{'x': 1, 'p': 0}, {'x': 2, 'p': 0}], [{'x': 3, 'p': 1}]],
+             '<object'], task.json_output(0))
+
+
+class TestIncrementalAggregation(unittest.TestCase):
+    def setUp(self):
+        self.task = TestTask()
+        self.task.set_input(0, '[{"x": 1}, {"x": 2}]')
+        self.task.set_input(1, '{"x": 3}')
+        self.task.inputs[0].signature_ = 'a'
+        self.task.inputs[1].signature_ = 'b'
+        self.task.env.source_parameter = [{'p': 0}, {'p': 1}]
+        self.task.env.incremental_aggregation = True
+        self.states_path = maflib.util._get_states_path(
+            self.task.outputs[0].abspath())
+
+    def tearDown(self):
+        if os.path.exists(self.states_path):
+            os.remove(self.states_path)
+
+    def _sum(self, task, update=lambda s, v: s + v['x']):
+        streaming_aggregator(
+            int, update, lambda s, t: s + t, lambda s, p: s)(task)
+        return task.json_output(0)
+
+    def test_read_only_changed_inputs(self):
+        self.assertEqual(6, self._sum(self.task))
+        self.task.set_input(0, 'broken')
+        self.task.set_input(1, '{"x": 10}')
+        self.task.inputs[1].signature_ = 'c'
+        self.assertEqual(13, self._sum(self.task))
+
+    def test_drop_removed_inputs(self):
+        self._sum(self.task)
+        self.task.inputs.list.pop(0)
+        self.task.env.source_parameter = [{'p': 1}]
+        self.assertEqual(3, self._sum(self.task))
+        with open(self.states_path) as f:
+            self.assertEqual(1, len(json.load(f)['states']))
+
+    def test_discard_states_of_other_rule(self):
+        self._sum(self.task)
+        self.task.set_input(0, '{"x": 0}')
+        self.assertEqual(
+            4, self._sum(self.task, lambda s, v: s + v['x'] + v['p']))
+
+
 class TestProduct(unittest.TestCase):
     def test_empty_input(self):
         self.assertEqual([{}], product({}))
@@ -52,6 +202,53 @@ class TestProduct(unittest.TestCase):
         self.assertEqual([], params)
 
 
+class TestLazyProduct(unittest.TestCase):
+    def test_same_as_product(self):
+        space = { 'a': [0, 1, 2], 'b': ['x', 'y'] }
+        self.assertListEqual(product(space), list(lazy_product(space)))
+        self.assertListEqual([{}], list(lazy_product({})))
+
+    def test_iterate_twice(self):
+        params = lazy_product({ 'a': [0, 1] })
+        self.assertListEqual(list(params), list(params))
+
+    def test_where(self):
+        params = lazy_product({ 'a': [0, 1, 2], 'b': [0, 1, 2] },
+                              where=[lambda p: p['a'] < p['b'],
+                                     lambda p: p['b'] != 1])
+        self.assertListEqual([{ 'a': 0, 'b': 2 }, { 'a': 1, 'b': 2 }],
+                             list(params))
+
+    def test_conditional_axis(self):
+        params = lazy_product({
+            'b': lambda p: [1, -1] if p['s'] == 0 else None,
+            's': [0, 1] })
+        expect = [{ 's': 0, 'b': 1 }, { 's': 0, 'b': -1 }, { 's': 1 }]
+        self.assertListEqual(expect, list(params))
+
+    def test_nested_axes(self):
+        params = lazy_product({
+            'opt': { 'sgd': { 'lr': [1, 2] }, 'ada': None },
+            'c': [0, 1] })
+        expect = [{ 'c': 0, 'opt': 'ada' },
+                  { 'c': 0, 'opt': 'sgd', 'lr': 1 },
+                  { 'c': 0, 'opt': 'sgd', 'lr': 2 },
+                  { 'c': 1, 'opt': 'ada' },
+                  { 'c': 1, 'opt': 'sgd', 'lr': 1 },
+                  { 'c': 1, 'opt': 'sgd', 'lr': 2 }]
+        self.assertListEqual(expect, list(params))
+
+    def test_union(self):
+        params = lazy_product([{ 'a': [0] }, { 'b': [1, 2] }])
+        self.assertListEqual([{ 'a': 0 }, { 'b': 1 }, { 'b': 2 }],
+                             list(params))
+
+    def test_duplicated_key(self):
+        params = lazy_product({ 'a': { 0: { 'a': [1] } } })
+        with self.assertRaises(ValueError):
+            list(params)
+
+
 class TestSample(unittest.TestCase):
     def test_zero_sample(self):
         params = sample(0, { 'key': [0, 1] })
@@ -73,6 +270,11 @@ class TestSample(unittest.TestCase):
         for param in params:
             self.assertIn(param['key'], values)
 
+    def test_sample_from_interval_object(self):
+        params = sample(100, { 'key': Interval(1, 3, integer=True) })
+        for param in params:
+            self.assertIn(param['key'], [1, 2, 3])
+
     def test_sample_from_function(self):
         i = [0]
         def gen():
@@ -83,3 +285,85 @@ class TestSample(unittest.TestCase):
         params = sample(6, { 'key': gen })
         for param, expect in zip(params, expects):
             self.assertEqual(expect, param['key'])
+
+
+class TestGaussianProcessSampler(unittest.TestCase):
+    def test_sample_without_observations(self):
+        sampler = GaussianProcessSampler({'x': (-2, 3), 'k': ['a', 'b'], 'c': 1})
+        params = sampler(10, [])
+        self.assertEqual(10, len(params))
+        for param in params:
+            self.assertGreaterEqual(param['x'], -2)
+            self.assertLess(param['x'], 3)
+            self.assertIn(param['k'], ['a', 'b'])
+            self.assertEqual(1, param['c'])
+
+    def test_deterministic(self):
+        sampler = GaussianProcessSampler({'x': (0, 1)})
+        observations = [({'x': 0.1}, 1.0), ({'x': 0.5}, 2.0)]
+        self.assertEqual(sampler(3, observations), sampler(3, observations))
+
+    def test_approach_maximum(self):
+        sampler = GaussianProcessSampler({'x': (0, 1)})
+        observations = []
+        for _ in range(5):
+            for param in sampler(3, observations):
+                observations.append((param, -(param['x'] - 0.6) ** 2))
+        best = max(observations, key=lambda o: o[1])[0]
+        self.assertAlmostEqual(0.6, best['x'], delta=0.05)
+
+    def test_skip_observed_values(self):
+        sampler = GaussianProcessSampler({'k': [0, 1, 2, 3]})
+        observations = [({'k': 0}, 0.0), ({'k': 1}, 1.0)]
+        params = sampler(4, observations)
+        self.assertItemsEqual([{'k': 2}, {'k': 3}], params)
+
+
+class TestQuasiSample(unittest.TestCase):
+    def test_ranges(self):
+        distribution = {'x': (-2, 3), 'k': ['a', 'b', 'c'], 'c': 1,
+                        'log': Interval(1e-3, 1e3, log=True),
+                        'int': Interval(1, 5, integer=True),
+                        'log_int': Interval(1, 1000, log=True, integer=True)}
+        for method in ('sobol', 'halton', 'latin_hypercube'):
+            params = quasi_sample(100, distribution, method)
+            self.assertEqual(100, len(params))
+            for param in params:
+                self.assertGreaterEqual(param['x'], -2)
+                self.assertLess(param['x'], 3)
+                self.assertIn(param['k'], ['a', 'b', 'c'])
+                self.assertEqual(1, param['c'])
+                self.assertGreaterEqual(param['log'], 1e-3)
+                self.assertLess(param['log'], 1e3)
+                self.assertIn(param['int'], range(1, 6))
+                self.assertIsInstance(param['log_int'], int)
+                self.assertGreaterEqual(param['log_int'], 1)
+                self.assertLessEqual(param['log_int'], 1000)
+            self.assertEqual(set(range(1, 6)),
+                             set(p['int'] for p in params))
+            self.assertEqual(params, quasi_sample(100, distribution, method))
+
+    def test_stratified(self):
+        # Each of 2 ** k intervals of an axis contains one of the first 2 ** k
+        # points of a Sobol sequence, and one of 2 ** k points of a Latin
+        # hypercube.
+        for method in ('sobol', 'latin_hypercube'):
+            params = quasi_sample(64, {'x': (0, 1), 'y': (0, 1)}, method)
+            for key in ('x', 'y'):
+                self.assertEqual(
+                    range(64), sorted(int(p[key] * 64) for p in params))
+
+    def test_log_scale(self):
+        params = quasi_sample(
+            1024, {'x': Interval(1e-2, 1e2, log=True)}, 'halton')
+        self.assertAlmostEqual(
+            0.5, sum(p['x'] < 1 for p in params) / 1024.0, delta=0.01)
+
+    def test_empty_distribution(self):
+        self.assertEqual([{}, {}], quasi_sample(2, {}))
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            quasi_sample(1, {'x': (0, 1)}, 'unknown')
+        with self.assertRaises(ValueError):
+            quasi_sample(1, dict((i, (0, 1)) for i in range(41)))